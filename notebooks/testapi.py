@@ -28,7 +28,7 @@ import requests
 
 # %%
 sys.path.append("..")
-from idr.api import extract_fields_document, read_and_classify_document
+from idr.batch import batch_process
 from idr.storage.blobs import get_document
 
 # %% [markdown]
@@ -80,13 +80,9 @@ docs = await asyncio.gather(*getdoc_jobs)
 # (rnc)
 
 # %%
-rnc_jobs = []
+rnc_results = [result async for result in batch_process(docs, stage="read_and_classify")]
 
-
-for ex_doc in docs:
-    rnc_jobs.append(read_and_classify_document(document=ex_doc))
-
-rnc_df = pl.DataFrame(await asyncio.gather(*rnc_jobs))
+rnc_df = pl.DataFrame([result["result"] for result in rnc_results if result["status"] == "done"])
 
 
 # %% [markdown]
@@ -118,12 +114,9 @@ print("\n".join(rnc_df["classification_notes"]))
 # (ext)
 
 # %%
-ext_jobs = []
-
-for ex_doc in docs:
-    ext_jobs.append(extract_fields_document(document=ex_doc))
+ext_results = [result async for result in batch_process(docs, stage="extract_fields")]
 
-ext_responses = await asyncio.gather(*ext_jobs)
+ext_responses = [result["result"] for result in ext_results if result["status"] == "done"]
 ext_df = pl.DataFrame(ext_responses)
 
 # %% [markdown]
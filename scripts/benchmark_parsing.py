@@ -0,0 +1,83 @@
+"""Micro-benchmark of the parsing of the LLM completions
+
+Parses the completions recorded by benchmark_replay.py, or generated extraction completions when no fixtures are given,
+with the previous regex parser and with parse_json_object (the parser of parse_response_json):
+    python scripts/benchmark_parsing.py --fixtures benchmarks/fixtures --number 100
+"""
+
+import argparse
+import json
+import re
+import timeit
+from pathlib import Path
+
+from idr.document.utils import ResponseParseError, json_loads, parse_json_object
+
+# pattern of the previous parser, which backtracks on nested braces
+previous_pattern = re.compile(r"{(?:[^{}]|(.*))*}")
+
+
+def previous_parse(response: str) -> dict:
+    try:
+        return json.loads(re.search(previous_pattern, response).group())  # type: ignore
+    except Exception:
+        return {}
+
+
+def current_parse(response: str) -> dict:
+    # parse_response_json without the error logs
+    try:
+        return parse_json_object(response)
+    except ResponseParseError:
+        return {}
+
+
+def recorded_completions(fixtures: Path) -> list[str]:
+    """Content of the ChatCompletions recorded in the fixtures directory"""
+    completions = []
+    for path in sorted((fixtures / "completions").glob("*.json")):
+        content = json.loads(path.read_text())["choices"][0]["message"]["content"]
+        if content:
+            completions.append(content)
+    return completions
+
+
+def generated_completions(items: int) -> list[str]:
+    """Extraction completions with many invoiced items, as is, in a code fence, pretty printed and truncated"""
+    completion = json.dumps(
+        {
+            "document_issue_date": "19/03/2024",
+            "invoiced_items_description": [f'Artigo {{ref {number}}} - "{number}"' for number in range(items)],
+            "invoiced_items_quantity": [1.0] * items,
+            "unit_price": [number / 100 for number in range(items)],
+            "missing_mandatory_fields": [],
+            "missing_optional_fields": ["iban"],
+        }
+    )
+    return [
+        completion,
+        f"```json\n{completion}\n```",
+        json.dumps(json.loads(completion), indent=2),
+        completion[: len(completion) // 2],
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", help="fixtures directory recorded by benchmark_replay.py")
+    parser.add_argument("--items", type=int, default=200, help="invoiced items of the generated completions")
+    parser.add_argument("--number", type=int, default=100, help="times each completion is parsed")
+    args = parser.parse_args()
+
+    completions = recorded_completions(Path(args.fixtures)) if args.fixtures else generated_completions(args.items)
+    print(
+        f"{len(completions)} completions, {sum(map(len, completions))} characters, json backend {json_loads.__module__}"
+    )
+    for name, parse in (("previous", previous_parse), ("parse_json_object", current_parse)):
+        parsed = sum(bool(parse(completion)) for completion in completions)
+        seconds = timeit.timeit(lambda: [parse(completion) for completion in completions], number=args.number)
+        print(f"{name:>20}: {seconds / args.number / len(completions) * 1e6:10.1f} us per completion, {parsed} parsed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Offline benchmark of the pipeline, replaying recorded Azure service responses
+
+Record the fixtures once, with the live services configured in the .env file:
+    python scripts/benchmark_replay.py record benchmarks/fixtures invoices/some_invoice.pdf invoices/other.pdf
+
+Replay them without network access (e.g. in CI), with injected service latencies:
+    python scripts/benchmark_replay.py replay benchmarks/fixtures --concurrency 16 --repeat 10 --ocr-latency 3
+"""
+
+import argparse
+import asyncio
+import json
+
+from dotenv import load_dotenv
+
+from idr.replay import FixtureStore, Latency, configure_replay_environment
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="record the documents and live service responses")
+    record.add_argument("fixtures", help="fixtures directory")
+    record.add_argument("file_paths", nargs="+", help="paths of the documents in the documents container")
+
+    replay = commands.add_parser("replay", help="replay the recorded documents and report the performance")
+    replay.add_argument("fixtures", help="fixtures directory")
+    replay.add_argument("--concurrency", type=int, default=8, help="documents processed at a time")
+    replay.add_argument("--repeat", type=int, default=1, help="times each document is processed")
+    replay.add_argument("--ocr-latency", type=float, default=0.0, help="Document Intelligence latency (s)")
+    replay.add_argument("--llm-latency", type=float, default=0.0, help="chat completion latency (s)")
+    replay.add_argument("--blob-latency", type=float, default=0.0, help="blob read and write latency (s)")
+    replay.add_argument("--workers", default="process", choices=("process", "thread"), help="worker pool")
+    replay.add_argument("--output", help="write the report to this json file")
+
+    for command in (record, replay):
+        command.add_argument(
+            "--stages", nargs="+", default=["read_and_classify", "extract_fields"], help="stages to run"
+        )
+        command.add_argument("--no-llm-cache", action="store_true", help="do not read the cached completions")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
+    from idr.document.workers import start_workers, stop_workers
+    from idr.llm.llm_caller import use_llm_cache
+    from idr.replay import peak_rss_mb, record_fixtures, run_benchmark
+
+    use_llm_cache.set(not args.no_llm_cache)
+    store = FixtureStore(args.fixtures)
+    if args.command == "record":
+        start_workers()
+        try:
+            await record_fixtures(store, args.file_paths, tuple(args.stages))
+        finally:
+            stop_workers()
+        return
+
+    start_workers(pool=args.workers)
+    try:
+        report = await run_benchmark(
+            store,
+            concurrency=args.concurrency,
+            repeat=args.repeat,
+            ocr_latency=Latency(args.ocr_latency),
+            llm_latency=Latency(args.llm_latency),
+            blob_latency=Latency(args.blob_latency),
+            stages=tuple(args.stages),
+        )
+    finally:
+        stop_workers()
+    # the peak memory of the worker processes is only known once they exited
+    report.peak_rss_mb = peak_rss_mb()
+
+    print(f"{report.documents} documents ({report.failed} failed) in {report.seconds:.2f}s")
+    print(f"{report.documents_per_second:.2f} documents/s at concurrency {report.concurrency}")
+    print(f"peak RSS: {report.peak_rss_mb} MB")
+    print(f"{'stage':<32}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, values in report.stages.items():
+        print(f"{stage:<32}{values['count']:>8}{values['p50']:>10.3f}{values['p95']:>10.3f}{values['p99']:>10.3f}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report.to_dict(), file, indent=2)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.command == "record":
+        load_dotenv()
+    else:
+        configure_replay_environment()
+    asyncio.run(main(arguments))
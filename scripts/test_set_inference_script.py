@@ -9,12 +9,14 @@ from dotenv import load_dotenv
 from pprint import pprint
 from idr.storage.blobs import read_blob, get_document_from_file
 import polars as pl
-from idr.api import extract_fields_document, read_and_classify_document
+from idr.batch import batch_process
 from idr.document.document import Document
 
 load_dotenv()
 
 DOCUMENT_FOLDER = "data_extractions"
+# False to call the LLM again instead of reading the completions cached by the previous runs
+USE_LLM_CACHE = True
 
 async def save_file(filepath: str | Path, content: bytes):
     async with aiofiles.open(filepath, "wb") as f:
@@ -49,21 +51,16 @@ def download_sample_files():
     asyncio.run(download_files(unique_doclist))
 
 async def classify_documents(docs: list[Document]) ->list[dict]:
-    rnc_jobs = []
-    for ex_doc in docs:
-        
-        rnc_jobs.append(read_and_classify_document(document=ex_doc))
-    class_results = await asyncio.gather(*rnc_jobs)
-    return class_results
+    class_results = [result async for result in batch_process(docs, stage="read_and_classify", use_cache=USE_LLM_CACHE)]
+    for failed in [result for result in class_results if result["status"] == "failed"]:
+        print(f"Failed {failed['file_path']}: {failed['error']}")
+    return [result["result"] for result in class_results if result["status"] == "done"]
 
 async def extract_doc_data(docs: list[Document]) ->list[dict]:
-    rnc_jobs = []
-    for ex_doc in docs:
-        
-        rnc_jobs.append(extract_fields_document(document=ex_doc))
-
-    extraction_results = await asyncio.gather(*rnc_jobs)
-    return extraction_results
+    extraction_results = [result async for result in batch_process(docs, stage="extract_fields", use_cache=USE_LLM_CACHE)]
+    for failed in [result for result in extraction_results if result["status"] == "failed"]:
+        print(f"Failed {failed['file_path']}: {failed['error']}")
+    return [result["result"] for result in extraction_results if result["status"] == "done"]
 
 if __name__ == "__main__":
 
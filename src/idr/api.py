@@ -1,13 +1,23 @@
 import importlib.metadata
+import json
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from loguru import logger
 from pydantic import BaseModel
 
-from idr.logic import extract_fields_document, read_and_classify_document
+from idr.batch import BATCH_STAGES, STREAM_STAGES, batch_process, process_file, stream_file
+from idr.config import WORKER_POOL, WORKER_PROCESSES
+from idr.document.workers import start_workers, stop_workers
+from idr.jobs import get_job, jobs_enabled, start_jobs, stop_jobs, submit_job
+from idr.metrics import render_metrics
 from idr.storage.blobs import (
+    close_storage,
     get_blob_list,
-    get_document,
+    open_storage,
+    wait_for_pending_writes,
 )
 
 
@@ -16,10 +26,46 @@ class FileInput(BaseModel):
     file_path: str  # path to file inside the container
 
 
+class JobInput(FileInput):
+    callback_url: str | None = None  # the finished job is POSTed to this url
+
+
+class BatchInput(BaseModel):
+    file_paths: list[str] = []  # paths to files inside the container
+    prefix: str = ""  # path prefix inside the container, all files under it are processed
+
+
 version = importlib.metadata.version("idr")
 
 
-app = FastAPI(version=version)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Keeps long-lived service connections open for the lifetime of the API"""
+    await open_storage()
+    start_workers(WORKER_PROCESSES, WORKER_POOL)
+    await start_jobs()
+    yield
+    await stop_jobs()
+    await wait_for_pending_writes()
+    await close_storage()
+    stop_workers()
+
+
+app = FastAPI(version=version, lifespan=lifespan)
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    """Latency of each processing stage, token usage and cache hits, in the Prometheus text format
+
+    Returns:
+        PlainTextResponse: metrics to be scraped by Prometheus
+            - idr_stage_duration_seconds: histogram by stage (download, mime_detection, pdf_parsing, ocr,
+              classification, extraction, *_postprocessing, blob_write, ...) and status (ok or error)
+            - idr_llm_tokens_total: tokens by process, model and type (prompt, completion or cached_prompt)
+            - idr_cache_hits_total, idr_cache_misses_total: by cache
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/list_documents/{path:path}")
@@ -45,7 +91,7 @@ async def list_document(path: str) -> dict:
 
 
 @app.post("/read_and_classify/")
-async def read_and_classify(file: FileInput) -> dict:
+async def read_and_classify(file: FileInput, use_cache: bool = True) -> dict:
     """API to scan and classify documents (used in camunda)
         - uses Document Intelligence
         - uses chatGPT 4o-mini
@@ -54,12 +100,14 @@ async def read_and_classify(file: FileInput) -> dict:
         file (FileInput): json with url and path to the blob storage location of the file to be extracted
             - file_url: url to the file in the blob storage (currently not used)
             - file_path: path to the file in the blob storage (rooted in the documents container)
+        use_cache (bool, query): false to call the LLM again instead of reading the completions cached by a previous
+            processing (e.g. after a bad answer)
 
     Returns:
         dict: dict to be read as a json in camunda
             - file_url: url to the file in the blob storage (input)
             - file_path: path to the file in the blob storage (input)
-            - text: full text of the document
+            - text: full text of the document (one element per page, null for pages not read by the OCR yet)
             - has_atcud: flag indicating if the document has a QR code
             - scanned_copy: flag indicating if the document was scanned successfully
             - original_copy: flag indicating if the document was originally a copy
@@ -77,19 +125,11 @@ async def read_and_classify(file: FileInput) -> dict:
             - all_fields: dict of all fields extracted since the document was read
     """
 
-    try:
-        document = await get_document(file.file_path, file.file_url)
-    except Exception as e:
-        logger.error(f"Error while accessing the document, make sure the path is valid {file.file_path}")
-        raise e
-
-    out = await read_and_classify_document(document)
-    out.update({"file_url": file.file_url})
-    return out
+    return await process_file(file.file_path, "read_and_classify", file.file_url, use_cache)
 
 
 @app.post("/extract_fields/")
-async def extract_fields(file: FileInput) -> dict:
+async def extract_fields(file: FileInput, use_cache: bool = True) -> dict:
     """API to extract more fields from documents (used in camunda)
         - uses chatGPT 4
 
@@ -97,6 +137,8 @@ async def extract_fields(file: FileInput) -> dict:
         file (FileInput): json with url and path to the blob storage location of the file to be extracted
             - file_url: url to the file in the blob storage (currently not used)
             - file_path: path to the file in the blob storage (rooted in the documents container)
+        use_cache (bool, query): false to call the LLM again instead of reading the completions cached by a previous
+            processing (e.g. after a bad answer)
 
     Returns:
         dict: dict to be read as a json in camunda
@@ -107,19 +149,162 @@ async def extract_fields(file: FileInput) -> dict:
             - missing_optional_fields: list of missing optional fields
             - all_fields: dict of all fields extracted since the document was read
     """
+    return await process_file(file.file_path, "extract_fields", file.file_url, use_cache)
+
+
+@app.post("/read_classify_and_extract/")
+async def read_classify_and_extract(file: FileInput, use_cache: bool = True) -> dict:
+    """API to scan, classify and extract the fields of documents in a single call
+        - uses Document Intelligence
+        - uses chatGPT 4o-mini and chatGPT 4o, concurrently when the QR code gives the document type
+
+    Args:
+        file (FileInput): json with url and path to the blob storage location of the file to be extracted
+            - file_url: url to the file in the blob storage (currently not used)
+            - file_path: path to the file in the blob storage (rooted in the documents container)
+        use_cache (bool, query): false to call the LLM again instead of reading the completions cached by a previous
+            processing (e.g. after a bad answer)
+
+    Returns:
+        dict: output of /read_and_classify/ with the fields of /extract_fields/
+            - extracted_fields: dict of fields extracted in this process
+            - missing_mandatory_fields: list of missing mandatory fields
+            - missing_optional_fields: list of missing optional fields
+            - all_fields: dict of all fields extracted (classification and extraction)
+    """
+    return await process_file(file.file_path, "read_classify_and_extract", file.file_url, use_cache)
+
+
+async def sse_events(events: AsyncIterator[tuple[str, dict]]) -> AsyncIterator[str]:
     try:
-        document = await get_document(file.file_path, file.file_url)
+        async for event, data in events:
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
     except Exception as e:
-        logger.error(f"Error while accessing the document, make sure the path is valid {file.file_path}")
-        raise e
+        logger.error(f"Error while streaming: {e}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+
+@app.post("/stream/{stage}")
+async def stream(stage: str, file: FileInput, use_cache: bool = True) -> StreamingResponse:
+    """API to process a document giving the classification fields for the decisions as soon as they are known
+    (server-sent events, used in camunda gateways)
+
+    Args:
+        stage: read_and_classify or read_classify_and_extract
+        file (FileInput): json with url and path to the blob storage location of the file
+            - file_url: url to the file in the blob storage (currently not used)
+            - file_path: path to the file in the blob storage (rooted in the documents container)
+        use_cache (bool, query): false to call the LLM again instead of reading the completions cached by a previous
+            processing (e.g. after a bad answer)
+
+    Returns:
+        StreamingResponse: server-sent events (text/event-stream) with a json data
+            - fields: document_type, supplier_vat and/or valid_document, as soon as they are generated
+            - classification: output of the classification (read_classify_and_extract only)
+            - result: same output as the /<stage>/ endpoint, last event
+            - error: error message, last event when the processing failed
+    """
+    if stage not in STREAM_STAGES:
+        raise HTTPException(status_code=404, detail=f"Invalid stage: {stage}")
+    return StreamingResponse(
+        sse_events(stream_file(file.file_path, stage, file.file_url, use_cache)), media_type="text/event-stream"
+    )
+
+
+@app.post("/jobs/{stage}", status_code=202)
+async def submit(stage: str, file: JobInput) -> dict:
+    """API to queue the processing of a document, without waiting for it (used in camunda)
+
+    The same stage of a file_path is processed once at a time, submitting it while it is queued or running
+    returns the job in flight (its callback_url is kept).
+
+    Args:
+        stage: read_and_classify, extract_fields or read_classify_and_extract
+        file (JobInput): json with url and path to the blob storage location of the file
+            - file_url: url to the file in the blob storage (currently not used)
+            - file_path: path to the file in the blob storage (rooted in the documents container)
+            - callback_url: url called with a POST of the job (same output as /jobs/{job_id}) when it finishes
+
+    Returns:
+        dict: the job, see /jobs/{job_id}
+    """
+    if not jobs_enabled():
+        raise HTTPException(status_code=503, detail="The job queue is disabled (JOB_QUEUE)")
+    if stage not in BATCH_STAGES:
+        raise HTTPException(status_code=404, detail=f"Invalid stage: {stage}")
+    job = await submit_job(stage, file.file_path, file.file_url, file.callback_url)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str) -> dict:
+    """API to get the status and output of a job
+
+    Args:
+        job_id: id returned when the job was submitted
+
+    Returns:
+        dict: the job
+            - job_id: id of the job
+            - stage: processing of the job
+            - file_path, file_url, callback_url: inputs of the job
+            - status: "queued", "running", "done" or "failed"
+            - result: same output as the /<stage>/ endpoint (when done)
+            - error: error message (when failed)
+            - created, updated: timestamps of the submission and of the last status change
+    """
+    if not jobs_enabled():
+        raise HTTPException(status_code=503, detail="The job queue is disabled (JOB_QUEUE)")
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job.to_dict()
+
+
+async def ndjson_lines(results: AsyncIterator[dict]) -> AsyncIterator[str]:
+    async for result in results:
+        yield json.dumps(result) + "\n"
+
+
+@app.post("/batch/read_and_classify")
+async def batch_read_and_classify(batch: BatchInput, use_cache: bool = True) -> StreamingResponse:
+    """API to scan and classify a set of documents (useful for testing and reprocessing)
+
+    Args:
+        batch (BatchInput): json with the documents to process
+            - file_paths: paths to the files in the blob storage (rooted in the documents container)
+            - prefix: path prefix in the blob storage, all files under it are processed
+        use_cache (bool, query): false to call the LLM again instead of reading the cached completions
+
+    Returns:
+        StreamingResponse: one json per line (NDJSON) for each document, in order of completion
+            - file_path: path to the file in the blob storage
+            - status: "done" or "failed"
+            - result: same output as /read_and_classify/ (when done)
+            - error: error message (when failed)
+    """
+    logger.info(f"Batch read and classify of {len(batch.file_paths)} documents and prefix '{batch.prefix}'")
+    results = batch_process(batch.file_paths, stage="read_and_classify", prefix=batch.prefix, use_cache=use_cache)
+    return StreamingResponse(ndjson_lines(results), media_type="application/x-ndjson")
+
 
-    out = await extract_fields_document(document)
+@app.post("/batch/extract_fields")
+async def batch_extract_fields(batch: BatchInput, use_cache: bool = True) -> StreamingResponse:
+    """API to extract more fields from a set of documents (useful for testing and reprocessing)
 
-    return {
-        "file_url": file.file_url,
-        "file_path": file.file_path,
-        "extracted_fields": out,
-        "missing_mandatory_fields": out["missing_mandatory_fields"],
-        "missing_optional_fields": out["missing_optional_fields"],
-        "all_fields": document.fields,
-    }
+    Args:
+        batch (BatchInput): json with the documents to process
+            - file_paths: paths to the files in the blob storage (rooted in the documents container)
+            - prefix: path prefix in the blob storage, all files under it are processed
+        use_cache (bool, query): false to call the LLM again instead of reading the cached completions
+
+    Returns:
+        StreamingResponse: one json per line (NDJSON) for each document, in order of completion
+            - file_path: path to the file in the blob storage
+            - status: "done" or "failed"
+            - result: dict of fields extracted in this process (when done)
+            - error: error message (when failed)
+    """
+    logger.info(f"Batch extraction of {len(batch.file_paths)} documents and prefix '{batch.prefix}'")
+    results = batch_process(batch.file_paths, stage="extract_fields", prefix=batch.prefix, use_cache=use_cache)
+    return StreamingResponse(ndjson_lines(results), media_type="application/x-ndjson")
@@ -0,0 +1,166 @@
+"""
+IDR 2024
+
+Processing of sets of documents with bounded concurrency
+"""
+
+import asyncio
+from collections.abc import AsyncIterator
+
+from loguru import logger
+
+from idr.config import BATCH_CONCURRENCY
+from idr.document import Document
+from idr.llm.llm_caller import use_llm_cache
+from idr.logic import (
+    extract_fields_document,
+    read_and_classify_document,
+    read_classify_and_extract_document,
+    stream_read_and_classify_document,
+    stream_read_classify_and_extract_document,
+)
+from idr.storage.blobs import get_blob_list, get_document
+
+BATCH_STAGES = {
+    "read_and_classify": read_and_classify_document,
+    "extract_fields": extract_fields_document,
+    "read_classify_and_extract": read_classify_and_extract_document,
+}
+# stages giving the classification fields as soon as they are generated (server-sent events)
+STREAM_STAGES = {
+    "read_and_classify": stream_read_and_classify_document,
+    "read_classify_and_extract": stream_read_classify_and_extract_document,
+}
+# parts of the documents downloaded up front by each stage, the others are only downloaded if needed
+STAGE_DOCUMENT_PARTS = {
+    "read_and_classify": ("stream",),
+    "extract_fields": ("text",),
+    "read_classify_and_extract": ("stream",),
+}
+
+
+async def process_file(file_path: str, stage: str, file_url: str = "", use_cache: bool = True) -> dict:
+    """Run a stage on a file of the documents container, with the output of the stage API endpoint
+
+    Args:
+        file_path: path to the file in the documents container
+        stage: processing to run, one of BATCH_STAGES
+        file_url: url of the file (only returned)
+        use_cache: if False the completions cached by a previous processing are not read (see use_llm_cache)
+
+    Raises:
+        ValueError: if the stage is unknown or the file does not exist
+
+    Returns:
+        output of the /<stage>/ endpoint
+    """
+    if stage not in BATCH_STAGES:
+        raise ValueError(f"Invalid stage: {stage}. \n Valid stages: {', '.join(BATCH_STAGES)}")
+    use_llm_cache.set(use_cache)
+    try:
+        document = await get_document(file_path, file_url, load=STAGE_DOCUMENT_PARTS[stage])
+    except Exception as e:
+        logger.error(f"Error while accessing the document, make sure the path is valid {file_path}")
+        raise e
+
+    out = await BATCH_STAGES[stage](document)
+    if stage == "extract_fields":
+        return {
+            "file_url": file_url,
+            "file_path": file_path,
+            "extracted_fields": out,
+            "missing_mandatory_fields": out["missing_mandatory_fields"],
+            "missing_optional_fields": out["missing_optional_fields"],
+            "all_fields": document.fields,
+        }
+    out.update({"file_url": file_url})
+    return out
+
+
+async def stream_file(
+    file_path: str, stage: str, file_url: str = "", use_cache: bool = True
+) -> AsyncIterator[tuple[str, dict]]:
+    """Run a stage on a file of the documents container, giving the early classification fields first
+
+    Args:
+        file_path: path to the file in the documents container
+        stage: processing to run, one of STREAM_STAGES
+        file_url: url of the file (only returned)
+        use_cache: if False the completions cached by a previous processing are not read (see use_llm_cache)
+
+    Raises:
+        ValueError: if the stage is unknown or the file does not exist
+
+    Yields:
+        (event, data) of the stage (see logic.stream_read_and_classify_document), the "result" is the output
+        of the /<stage>/ endpoint
+    """
+    if stage not in STREAM_STAGES:
+        raise ValueError(f"Invalid stage: {stage}. \n Valid stages: {', '.join(STREAM_STAGES)}")
+    use_llm_cache.set(use_cache)
+    document = await get_document(file_path, file_url, load=STAGE_DOCUMENT_PARTS[stage])
+    async for event, data in STREAM_STAGES[stage](document):
+        if event == "result":
+            data.update({"file_url": file_url})
+        yield event, data
+
+
+async def batch_process(
+    documents: list[str | Document] | None = None,
+    stage: str = "read_and_classify",
+    prefix: str | None = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    use_cache: bool = True,
+) -> AsyncIterator[dict]:
+    """Process a set of documents, yielding the result of each one as soon as it finishes
+
+    At most `concurrency` documents are processed at a time, the calls to each stage are further limited
+    by the stage limits shared with the rest of the API. A failed document does not stop the batch.
+
+    Args:
+        documents: paths in the documents container, or already loaded Documents
+        stage: processing to run, one of BATCH_STAGES
+        prefix: path prefix in the documents container, all the documents under it are processed
+        concurrency: maximum number of documents processed at a time
+        use_cache: if False the completions cached by a previous processing are not read (see use_llm_cache)
+
+    Raises:
+        ValueError: if the stage is unknown
+
+    Yields:
+        dict for each document, in order of completion
+            - file_path: path of the document
+            - status: "done" or "failed"
+            - result: output of the stage (when done)
+            - error: error message (when failed)
+    """
+    if stage not in BATCH_STAGES:
+        raise ValueError(f"Invalid batch stage: {stage}. \n Valid stages: {', '.join(BATCH_STAGES)}")
+
+    documents = list(documents or [])
+    if prefix:
+        documents += await get_blob_list(prefix)
+    semaphore = asyncio.Semaphore(concurrency)
+    use_llm_cache.set(use_cache)  # copied to the context of the tasks
+
+    async def process(document: str | Document) -> dict:
+        file_path = document.doc_id if isinstance(document, Document) else document
+        async with semaphore:
+            try:
+                if not isinstance(document, Document):
+                    document = await get_document(file_path, load=STAGE_DOCUMENT_PARTS[stage])
+                result = await BATCH_STAGES[stage](document)
+                return {"file_path": file_path, "status": "done", "result": result}
+            except Exception as e:
+                logger.error(f"Error while processing {file_path} in a {stage} batch: {e}")
+                return {"file_path": file_path, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+    logger.info(f"Starting {stage} batch of {len(documents)} documents")
+    tasks = [asyncio.create_task(process(document)) for document in documents]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # the consumer stopped early (e.g. client disconnected)
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,199 @@
+"""
+IDR 2024
+
+Async key-value caches used to avoid repeating calls to the Azure services for the same input
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from loguru import logger
+
+CACHE_BACKENDS = ("none", "memory", "disk", "blob")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def make_cache_key(*parts: bytes | str) -> str:
+    """SHA-256 hex digest of the given parts (each part is delimited, so ("ab", "c") != ("a", "bc"))"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode() if isinstance(part, str) else part
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class Cache(ABC):
+    """Base class for the caches, values must be json serializable
+
+    Errors in the backend are logged and treated as a miss, a cache never breaks the processing.
+    """
+
+    def __init__(self, name: str, ttl: float | None = None, max_entries: int | None = None):
+        """
+        Args:
+            name: cache name, used in logs and metrics
+            ttl: time to live of the entries in seconds, None to never expire
+            max_entries: maximum number of entries, the least recently used are evicted first. None for no limit
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+
+    async def get(self, key: str) -> dict | list | str | None:
+        try:
+            value = await self._get(key)
+        except Exception as e:
+            logger.warning(f"Error while reading {key} from the {self.name} cache: {e}")
+            value = None
+
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value: dict | list | str) -> None:
+        try:
+            await self._set(key, value)
+        except Exception as e:
+            logger.warning(f"Error while writing {key} to the {self.name} cache: {e}")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    @abstractmethod
+    async def _get(self, key: str) -> dict | list | str | None: ...
+
+    @abstractmethod
+    async def _set(self, key: str, value: dict | list | str) -> None: ...
+
+
+class MemoryCache(Cache):
+    """In-process LRU cache"""
+
+    def __init__(self, name: str, ttl: float | None = None, max_entries: int | None = 256):
+        super().__init__(name, ttl, max_entries)
+        self._entries: OrderedDict[str, tuple[float, dict | list | str]] = OrderedDict()
+
+    async def _get(self, key: str) -> dict | list | str | None:
+        if key not in self._entries:
+            return None
+        created, value = self._entries[key]
+        if self._expired(created):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def _set(self, key: str, value: dict | list | str) -> None:
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while self.max_entries is not None and len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class DiskCache(Cache):
+    """Cache stored as json files in a local directory
+
+    The file modification time is used as the last access time for the LRU eviction.
+    """
+
+    def __init__(self, name: str, directory: str | Path, ttl: float | None = None, max_entries: int | None = 10000):
+        super().__init__(name, ttl, max_entries)
+        self.directory = Path(directory)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _read(self, key: str) -> dict | list | str | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        with open(path) as file:
+            entry = json.load(file)
+        if self._expired(entry["created"]):
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        return entry["value"]
+
+    def _write(self, key: str, value: dict | list | str) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"created": time.time(), "value": value}, file)
+        tmp_path.replace(path)
+        self._evict()
+
+    def _evict(self) -> None:
+        if self.max_entries is None:
+            return
+        files = list(self.directory.glob("*.json"))
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda file: file.stat().st_mtime)
+        for file in files[: len(files) - self.max_entries]:
+            file.unlink(missing_ok=True)
+
+    async def _get(self, key: str) -> dict | list | str | None:
+        return await asyncio.to_thread(self._read, key)
+
+    async def _set(self, key: str, value: dict | list | str) -> None:
+        await asyncio.to_thread(self._write, key, value)
+
+
+def make_cache(
+    backend: str,
+    name: str,
+    ttl: float | None = None,
+    max_entries: int | None = None,
+    directory: str = ".cache",
+    env_container: str = "CACHE_CONTAINER",
+) -> Cache | None:
+    """Create a cache from its configuration
+
+    Args:
+        backend: one of CACHE_BACKENDS ("none" disables the cache)
+        name: cache name, also used as sub directory or blob prefix
+        ttl: time to live of the entries in seconds, None to never expire
+        max_entries: maximum number of entries (not applied to the blob backend)
+        directory: root directory of the disk backend
+        env_container: name of the environment variable with the container of the blob backend
+
+    Raises:
+        ValueError: if the backend is unknown
+
+    Returns:
+        the cache, or None if disabled
+    """
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return MemoryCache(name, ttl=ttl, max_entries=max_entries)
+    if backend == "disk":
+        return DiskCache(name, Path(directory, name), ttl=ttl, max_entries=max_entries)
+    if backend == "blob":
+        from idr.storage.cache import BlobCache
+
+        return BlobCache(name, env_container=env_container, ttl=ttl)
+    raise ValueError(f"Invalid cache backend: {backend}. \n Valid backends: {', '.join(CACHE_BACKENDS)}")
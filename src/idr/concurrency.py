@@ -0,0 +1,46 @@
+"""
+IDR 2024
+
+Limits on the number of concurrent calls to each processing stage
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class StageLimits:
+    """One semaphore per processing stage (e.g. "ocr", "classification", "extraction")
+
+    The semaphores are shared by all requests, so that bursts and batches do not overload the Azure services.
+    They are recreated when used from a new event loop (e.g. consecutive asyncio.run calls in scripts).
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        """
+        Args:
+            limits: maximum number of concurrent calls per stage, stages not listed are not limited
+        """
+        self.limits = limits
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def semaphore(self, stage: str) -> asyncio.Semaphore | None:
+        if stage not in self.limits:
+            return None
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._semaphores = {}
+            self._loop = loop
+        if stage not in self._semaphores:
+            self._semaphores[stage] = asyncio.Semaphore(self.limits[stage])
+        return self._semaphores[stage]
+
+    @asynccontextmanager
+    async def __call__(self, stage: str):
+        """Wait for a free slot in the stage: async with stage_limits("ocr"): ..."""
+        semaphore = self.semaphore(stage)
+        if semaphore is None:
+            yield
+            return
+        async with semaphore:
+            yield
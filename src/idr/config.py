@@ -9,6 +9,69 @@ load_dotenv()
 FORM_KEY = os.getenv("FORM_KEY")
 FORM_ENDPOINT = os.getenv("FORM_ENDPOINT")
 
+STORAGE_CONNECTION_STRING = os.getenv("STORAGE_CONNECTION_STRING")
+# maximum number of simultaneous connections kept open to the blob storage account
+BLOB_POOL_SIZE = int(os.getenv("BLOB_POOL_SIZE", "20"))
+# write results to the blob storage without waiting for the uploads before answering
+BLOB_BACKGROUND_WRITES = os.getenv("BLOB_BACKGROUND_WRITES", "false").lower() == "true"
+# documents bigger than this (in bytes) are downloaded by chunks to a temporary file instead of memory
+STREAM_SPOOL_THRESHOLD = int(os.getenv("STREAM_SPOOL_THRESHOLD", str(16 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(4 * 1024 * 1024)))
+STREAM_SPOOL_DIR = os.getenv("STREAM_SPOOL_DIR") or None  # defaults to the system temporary directory
+
+# when to call Document Intelligence: "always", or "auto" to use the PDF text layer when it is good enough
+OCR_POLICY = os.getenv("OCR_POLICY", "always")
+OCR_MIN_TEXT_LENGTH = int(os.getenv("OCR_MIN_TEXT_LENGTH", "300"))
+OCR_MAX_GARBLED_RATIO = float(os.getenv("OCR_MAX_GARBLED_RATIO", "0.05"))
+# only OCR the pages that fit in the prompts (and the QR code page), the others are read if extraction needs them
+OCR_PAGE_SELECTION = os.getenv("OCR_PAGE_SELECTION", "false").lower() == "true"
+
+# decode the QR code from the file before (or instead of) the OCR, searching at most QR_MAX_PAGES pages
+LOCAL_QR_DECODING = os.getenv("LOCAL_QR_DECODING", "true").lower() == "true"
+QR_MAX_PAGES = int(os.getenv("QR_MAX_PAGES", "2"))
+# workers for CPU bound document processing (QR decoding, PDF reading): "process" or "thread" pool
+WORKER_POOL = os.getenv("WORKER_POOL", "process")
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "2")) or None  # 0 for the number of CPUs
+# big PDFs are read in parallel by ranges of this number of pages
+PDF_PAGES_PER_WORKER = int(os.getenv("PDF_PAGES_PER_WORKER", "20"))
+
+# maximum number of concurrent calls to each stage (shared by all requests) and of documents processed in a batch
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "8"))
+CLASSIFICATION_CONCURRENCY = int(os.getenv("CLASSIFICATION_CONCURRENCY", "16"))
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", "8"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# cache of Document Intelligence results: none, memory, disk or blob (stored in the container named in the variable
+# OCR_CACHE_CONTAINER, by default a dedicated CACHE_CONTAINER, apart from the document sidecars)
+OCR_CACHE = os.getenv("OCR_CACHE", "memory")
+OCR_CACHE_TTL = float(os.getenv("OCR_CACHE_TTL", "604800")) or None  # seconds, 0 to never expire
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "256")) or None  # 0 for no limit
+OCR_CACHE_CONTAINER = os.getenv("OCR_CACHE_CONTAINER", "CACHE_CONTAINER")
+# cache of LLM completions (deterministic for the same deployment and prompt): none, memory, disk or blob
+LLM_CACHE = os.getenv("LLM_CACHE", "memory")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400")) or None  # seconds, 0 to never expire
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")) or None  # 0 for no limit
+LLM_CACHE_CONTAINER = os.getenv("LLM_CACHE_CONTAINER", "CACHE_CONTAINER")
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+SPECULATIVE_EXTRACTION = os.getenv("SPECULATIVE_EXTRACTION", "false").lower() == "true"
+# re-extraction of an already extracted document only asks the fields that are missing or invalid
+INCREMENTAL_EXTRACTION = os.getenv("INCREMENTAL_EXTRACTION", "false").lower() == "true"
+# documents longer than the extraction prompt are extracted by chunks of pages (header fields and invoiced items apart)
+CHUNKED_EXTRACTION = os.getenv("CHUNKED_EXTRACTION", "false").lower() == "true"
+EXT_CHUNK_TOKENS = int(os.getenv("EXT_CHUNK_TOKENS", "4000"))
+EXT_MAX_CHUNKS = int(os.getenv("EXT_MAX_CHUNKS", "20"))
+
+# asynchronous jobs (/jobs/ endpoints): persistent queue backend (none to disable them) and database,
+# and jobs processed at a time per stage
+JOB_QUEUE = os.getenv("JOB_QUEUE", "none")
+JOB_DB = os.getenv("JOB_DB", ".jobs/jobs.sqlite")
+JOB_WORKERS = {
+    stage: int(os.getenv(f"JOB_WORKERS_{stage.upper()}", "4"))
+    for stage in ("read_and_classify", "extract_fields", "read_classify_and_extract")
+}
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "604800")) or None  # seconds finished jobs are kept, 0 for ever
+
 openai_config_classifier = AzureOpenAIConfig.from_env(suffix="_v4o_mini")
 openai_config_extractor = AzureOpenAIConfig.from_env(suffix="_v4o")
 
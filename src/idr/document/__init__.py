@@ -2,10 +2,19 @@ from .document import Document as Document
 from .processing import (
     async_classify as async_classify,
 )
+from .processing import (
+    async_classify_stream as async_classify_stream,
+)
 from .processing import (
     async_extract as async_extract,
 )
+from .processing import (
+    async_read_filetype as async_read_filetype,
+)
 from .processing import (
     async_read_ocr as async_read_ocr,
 )
+from .processing import (
+    async_read_qr_code as async_read_qr_code,
+)
 from .qr_codes import read_barcode_from_ocr as read_barcode_from_ocr
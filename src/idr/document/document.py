@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
+import os
+import weakref
+from collections.abc import Awaitable, Callable
+from contextlib import AbstractContextManager, suppress
 from datetime import datetime
+from typing import BinaryIO
 
 import magic
 from loguru import logger
 
 from idr.document.invoice_items import format_invoice_items
-from idr.document.pdf_reader import read_pdf
+from idr.document.pdf_reader import open_source, read_pdf
 from idr.llm.extraction_prompts import ALL_FIELDS
 
 # QRcodes translation from SAF-T PT to camunda fields
@@ -32,31 +39,81 @@ QR2FIELDS = {
     # "certificate_number": "R",
     "other_information": "S",
 }
+# number of bytes used to detect the file type
+MAGIC_HEADER_SIZE = 2048
+# big parts of a document that can be loaded from the storage on first use (see Document.load)
+LAZY_PARTS = ("stream", "text")
+
+
+def get_file_kind(file_type: str) -> str:
+    """Kind of file from the libmagic description
+
+    Raises:
+        ValueError: When the document type is not valid
+
+    Returns:
+        "pdf" or "image"
+    """
+    if "PDF" in file_type:
+        return "pdf"
+    elif "image" in file_type:
+        return "image"
+    logger.error(f"Invalid document type: {file_type}")
+    raise ValueError("Invalid document type. \n Valid types: PDF, jpeg, PNG)")
+
+
+def remove_file(path: str) -> None:
+    with suppress(FileNotFoundError):
+        os.remove(path)
 
 
 class Document:
     """Class to store multiple documentation info
 
+    The file content (stream) and the text can be loaded from the storage only when a stage needs them
+    (see Document.load), reading them before raises a ValueError.
+
     Raises:
         ValueError: When the document type is not valid
 
     """
 
-    #
-
-    def __init__(self, id: str, url: str = ""):
+    __slots__ = (
+        "doc_id",
+        "url",
+        "_stream",
+        "stream_path",
+        "_content_hash",
+        "_text",
+        "is_image",
+        "qr_info",
+        "valid",
+        "doc_type",
+        "fields",
+        "comments",
+        "_loader",
+        "__weakref__",
+    )
+
+    def __init__(self, id: str, url: str = "", loader: Callable[["Document", str], Awaitable[None]] | None = None):
         """Initiates the document class with the ID and default variables
 
         Args:
             id (str): file ID (working as it's path)
             url (str, optional): file url. Defaults to "".
+            loader (optional): async function loading a part of the document (one of LAZY_PARTS) from the storage,
+                when given the stream and the text are not loaded until Document.load is called
         """
         self.doc_id: str = id
         self.url: str = url
-        self.stream: bytes
+        self._stream: bytes | None = None
+        # local file with the content of a big document, instead of keeping it in memory (see set_stream_file)
+        self.stream_path: str | None = None
+        self._content_hash: str | None = None
 
         # each element should be a page (for image files or text-less PDF the fist element should be empty)
-        self.text: list[str] = []
+        # pages that were not read by the OCR yet are None
+        self._text: list[str | None] | None = None if loader is not None else []
 
         self.is_image: bool = False
         self.qr_info: dict = {}
@@ -64,6 +121,56 @@ class Document:
         self.doc_type: str = ""
         self.fields = {}
         self.comments: list[str] = []
+        self._loader = loader
+
+    @property
+    def stream(self) -> bytes:
+        """Binary file data (see source for a document read from a local file)"""
+        if self._stream is None:
+            raise ValueError(f"The file content of {self.doc_id} is not loaded (await document.load('stream'))")
+        return self._stream
+
+    @stream.setter
+    def stream(self, stream: bytes) -> None:
+        self._stream = stream
+        self._content_hash = None
+
+    @property
+    def view(self) -> memoryview:
+        """Read-only view of the binary file data, sliced without copying it (e.g. view[start:end] of a big PDF)
+
+        The content itself is kept as bytes: a memoryview can not be pickled to the worker processes,
+        and libmagic and BytesIO would copy it back to bytes.
+        """
+        return memoryview(self.stream).toreadonly()
+
+    @property
+    def text(self) -> list[str | None]:
+        if self._text is None:
+            raise ValueError(f"The text of {self.doc_id} is not loaded (await document.load('text'))")
+        return self._text
+
+    @text.setter
+    def text(self, text: list[str | None]) -> None:
+        self._text = text
+
+    def is_loaded(self, part: str) -> bool:
+        """Whether a part of the document is available (parts other than LAZY_PARTS always are)"""
+        if part == "stream":
+            return self._stream is not None or self.stream_path is not None
+        if part == "text":
+            return self._text is not None
+        return True
+
+    async def load(self, *parts: str) -> None:
+        """Load the parts of the document that were not loaded yet, concurrently
+
+        Args:
+            parts: parts to load, from LAZY_PARTS (e.g. "stream" before reading the file)
+        """
+        missing = [part for part in parts if not self.is_loaded(part)]
+        if missing and self._loader is not None:
+            await asyncio.gather(*[self._loader(self, part) for part in missing])
 
     def read_filetype(self) -> None:
         """Detects file type for further processing.
@@ -73,15 +180,71 @@ class Document:
             ValueError: When the document type is not valid
         """
 
-        file_type = magic.from_buffer(self.stream)
+        file_type = magic.from_buffer(self.read_header())
 
-        if "PDF" in file_type:
-            self.text = read_pdf(self.stream)
-        elif "image" in file_type:
-            self.text = [""]
+        if get_file_kind(file_type) == "pdf":
+            self.text = read_pdf(self.source)
         else:
-            logger.error(f"Invalid document type: {file_type}")
-            raise ValueError("Invalid document type. \n Valid types: PDF, jpeg, PNG)")
+            self.is_image = True
+            self.text = [""]
+
+    @property
+    def source(self) -> bytes | str:
+        """File content, or path of the local file with the content (both accepted by the PDF and QR readers)"""
+        return self.stream_path if self.stream_path is not None else self.stream
+
+    def set_stream_file(self, path: str, temporary: bool = False) -> None:
+        """Use a local file as the document content, without loading it in memory
+
+        Args:
+            path: path of the file
+            temporary: delete the file when the document is garbage collected (e.g. a spooled download)
+        """
+        self.stream_path = path
+        self._content_hash = None
+        if temporary:
+            weakref.finalize(self, remove_file, path)
+
+    def open_stream(self) -> AbstractContextManager[BinaryIO]:
+        """Open the file content for reading: with document.open_stream() as file: ..."""
+        return open_source(self.source)
+
+    def read_header(self, size: int = MAGIC_HEADER_SIZE) -> bytes:
+        """First bytes of the file content (e.g. to detect the file type)"""
+        if self.stream_path is None:
+            return self.stream[:size]
+        with open(self.stream_path, "rb") as file:
+            return file.read(size)
+
+    def content_hash(self) -> str:
+        """SHA-256 hex digest of the file content, a local file is hashed by chunks (computed once)"""
+        if self._content_hash is None:
+            with self.open_stream() as file:
+                self._content_hash = hashlib.file_digest(file, "sha256").hexdigest()
+        return self._content_hash
+
+    def get_text(self) -> str:
+        """Text of the pages already read, separated by form feeds"""
+        return "\f".join(page for page in self.text if page is not None)
+
+    def unread_pages(self) -> list[int]:
+        """Page numbers (starting at 1) that were not read by the OCR yet"""
+        return [number for number, page in enumerate(self.text, start=1) if page is None]
+
+    def set_ocr_text(self, page_texts: dict[int, str], page_count: int | None = None) -> None:
+        """Sets the text of the pages read by the OCR
+        TODO: THIS MODIFIES THE INPUT OBJECT
+
+        Args:
+            page_texts: text of each page read, by page number (starting at 1)
+            page_count: number of pages of the document, when given all other pages are marked as not read
+        """
+        if page_count is not None:
+            self.text = [None] * page_count
+        page_count = max([len(self.text), *page_texts])
+        self.text = self.text + [None] * (page_count - len(self.text))
+        for number, page_text in page_texts.items():
+            self.text[number - 1] = page_text
 
     def has_qr(self) -> bool:
         return len(self.qr_info) > 0
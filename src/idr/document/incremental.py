@@ -0,0 +1,124 @@
+"""
+IDR 2024
+
+Incremental extraction: only the fields missing or invalid in a previous extraction are asked again
+"""
+
+import json
+import re
+
+from idr.cache import make_cache_key
+from idr.document.invoice_items import INVOICE_ITEMS_FIELDS
+from idr.llm.extraction_prompts import ALL_FIELDS
+from idr.llm.prompt_formatting import prompt_fields
+
+DATE_PATTERN = re.compile(r"^\d{2}/\d{2}/\d{4}$")
+NUMBER_PATTERN = re.compile(r"^-?\d+(\.\d+)?\b")
+# format of the extracted values that can be checked, other fields are only checked to be filled
+FIELD_PATTERNS = {
+    "document_issue_date": DATE_PATTERN,
+    "document_due_date": DATE_PATTERN,
+    "currency": re.compile(r"^[A-Z]{3}$"),
+    "total_tax_amount": NUMBER_PATTERN,
+    "document_total_with_tax": NUMBER_PATTERN,
+}
+MISSING_FIELDS = ("missing_mandatory_fields", "missing_optional_fields")
+# document field with the hash of the text and document type an extraction was made from
+EXTRACTION_SOURCE_FIELD = "extraction_source"
+
+
+def extraction_source(text: list[str | None], doc_type: str) -> str:
+    """Hash of the text and document type of an extraction (see EXTRACTION_SOURCE_FIELD)"""
+    return make_cache_key(json.dumps(text), doc_type)
+
+
+def has_extraction(fields: dict, source: str) -> bool:
+    """Check if the document fields hold a previous extraction of the same text and document type
+
+    Args:
+        fields: document fields
+        source: extraction_source of the current text and document type, an extraction of a replaced file
+            or of another document type is not reused
+    """
+    return "missing_mandatory_fields" in fields and fields.get(EXTRACTION_SOURCE_FIELD) == source
+
+
+def is_valid_field(field: str, value) -> bool:
+    """Check if an extracted value is filled and in the expected format"""
+    if value is None or value == "" or value == []:
+        return False
+    pattern = FIELD_PATTERNS.get(field)
+    return pattern is None or bool(pattern.match(str(value).strip()))
+
+
+def fields_to_extract(fields: dict, doc_type: str, has_qr: bool) -> list[str]:
+    """Fields of the extraction prompt that are missing or invalid in the previous extraction
+
+    The mandatory fields are asked when flagged as missing, empty or not in the expected format, the optional
+    fields only when not in the expected format (they can be missing from the document).
+    The invoiced items are asked together (their arrays must have the same number of entries).
+
+    Args:
+        fields: document fields with a previous extraction (postprocessed)
+        doc_type: document type from SAF-T PT
+        has_qr: whether the document has a QR code (the fields in the QR code are not asked)
+
+    Returns:
+        names of the fields to ask, in the order of the prompt
+    """
+    missing = set(fields.get("missing_mandatory_fields", []))
+    asked = []
+    for field, kind in prompt_fields(doc_type, has_qr).items():
+        if field in INVOICE_ITEMS_FIELDS:
+            invalid = not fields.get("invoiced_items") or field in missing
+        elif kind == "optional":
+            invalid = field in FIELD_PATTERNS and fields.get(field) and not is_valid_field(field, fields[field])
+        else:
+            invalid = field in missing or not is_valid_field(field, fields.get(field))
+        if invalid:
+            asked.append(field)
+    if any(field in INVOICE_ITEMS_FIELDS for field in asked):
+        asked = [field for field in asked if field not in INVOICE_ITEMS_FIELDS] + list(INVOICE_ITEMS_FIELDS)
+    return asked
+
+
+def previous_extraction(fields: dict) -> dict:
+    """Extraction completion equivalent to the extracted document fields (before postprocessing)
+
+    Args:
+        fields: document fields with a previous extraction
+
+    Returns:
+        completion with the extracted fields, the missing fields and the invoiced items as arrays
+    """
+    completion = {field: fields[field] for field in ALL_FIELDS if field in fields and field not in INVOICE_ITEMS_FIELDS}
+    items = fields.get("invoiced_items") or []
+    completion["invoiced_items_description"] = [item["description"] for item in items]
+    completion["invoiced_items_quantity"] = [item["quantity"] for item in items]
+    completion["unit_price"] = [item["unit_price"] for item in items]
+    for missing in MISSING_FIELDS:
+        completion[missing] = list(fields.get(missing, []))
+    return completion
+
+
+def merge_extraction(previous: dict, completion: dict, asked: list[str]) -> dict:
+    """Merge the extraction of the asked fields into the previous extraction, to be postprocessed
+
+    Args:
+        previous: previous extraction (see previous_extraction)
+        completion: extraction of the reduced prompt
+        asked: fields of the reduced prompt
+
+    Returns:
+        the previous extraction with the new values and missing fields of the asked fields
+    """
+    # a field left out of the completion keeps its previous value and missing flag
+    answered = [field for field in asked if field in completion]
+    merged = dict(previous)
+    for field in answered:
+        merged[field] = completion[field]
+    for missing in MISSING_FIELDS:
+        merged[missing] = [field for field in previous.get(missing, []) if field not in answered] + [
+            field for field in completion.get(missing, []) if field in answered
+        ]
+    return merged
@@ -4,6 +4,21 @@ IDR 2024
 Module to post-process invoice items
 """
 
+import re
+from itertools import zip_longest
+
+from loguru import logger
+
+# array fields extracted by the LLM that are formatted into the single "invoiced_items" field
+INVOICE_ITEMS_FIELDS = ("invoiced_items_description", "invoiced_items_quantity", "unit_price")
+# whole description of the rows carrying the subtotal of the previous page over, which are not invoiced items
+# ("Transporte de mercadorias" is an item, "Transporte" alone is a carried-over subtotal)
+CARRIED_OVER_PATTERN = re.compile(
+    r"^\W*((a\s+)?transport(e|ar|ado)|(carried|brought)\s+(forward|over)|sub-?total)\W*$", re.IGNORECASE
+)
+# amount of an extracted cell, e.g. "1.234,56", "1234.56" or "45,00 €"
+AMOUNT_PATTERN = re.compile(r"-?\d[\d.,\s]*")
+
 
 def format_invoice_items(extraction_data: dict[str, str | list]) -> dict[str, str | list[dict]]:
     """Format list of invoice items from GenAI from dict of lists to list of dicts
@@ -30,12 +45,77 @@ def format_invoice_items(extraction_data: dict[str, str | list]) -> dict[str, st
         ...
     }
     """
-    descriptions = extraction_data.pop("invoiced_items_description")
-    quantities = extraction_data.pop("invoiced_items_quantity")
-    unit_prices = extraction_data.pop("unit_price")
+    # fields not asked or flagged as missing are not lists
+    descriptions, quantities, unit_prices = (
+        value if isinstance(value := extraction_data.pop(field, []), list) else [] for field in INVOICE_ITEMS_FIELDS
+    )
+    if not len(descriptions) == len(quantities) == len(unit_prices):
+        logger.warning(
+            f"Invoiced items arrays of different lengths: {len(descriptions)}, {len(quantities)}, {len(unit_prices)}"
+        )
     extraction_data["invoiced_items"] = [
         {"description": desc, "quantity": qty, "unit_price": price}
-        for desc, qty, price in zip(descriptions, quantities, unit_prices)
+        for desc, qty, price in zip_longest(descriptions, quantities, unit_prices, fillvalue="")
     ]
 
     return extraction_data
+
+
+def parse_amount(value: object) -> float | None:
+    """Number of an extracted amount, with a decimal comma or point (e.g. "1.234,56"), None if it has no number"""
+    match = AMOUNT_PATTERN.search(str(value))
+    if match is None:
+        return None
+    number = re.sub(r"\s", "", match.group()).rstrip(".,")
+    separators = re.findall(r"[.,]", number)
+    if separators and separators.count(separators[-1]) == 1:  # the last separator is the decimal one
+        integer, decimals = re.split(r"[.,](?=[^.,]*$)", number)
+        number = re.sub(r"[.,]", "", integer) + "." + decimals
+    else:
+        number = re.sub(r"[.,]", "", number)
+    return float(number)
+
+
+def item_amount(item: dict) -> float | None:
+    """Amount of an extracted row, its quantity (1 if it has none) times its unit price"""
+    unit_price = parse_amount(item.get("unit_price", ""))
+    if unit_price is None:
+        return None
+    quantity = parse_amount(item.get("quantity", ""))
+    return unit_price * (1 if quantity is None else quantity)
+
+
+def is_table_header(item: dict) -> bool:
+    """Check if an extracted row is the header of the items table (its quantity and unit price have no numbers)"""
+    return not any(re.search(r"\d", str(item.get(column, ""))) for column in ("quantity", "unit_price"))
+
+
+def merge_invoice_items(chunks: list[list[dict]]) -> list[dict]:
+    """Merge the invoiced items extracted from consecutive chunks of a document, in order
+
+    The chunks do not share pages, so every item is kept (the same article can be billed on consecutive rows).
+    Only the rows that are not items are dropped: the table header repeated at the start of a chunk, and the
+    subtotals carried over to the next page ("Transporte", "A transportar"), at the start or the end of a chunk or,
+    on a page break inside a chunk, with the subtotal of the previous items as their amount.
+
+    Args:
+        chunks: invoiced items of each chunk (see format_invoice_items)
+
+    Returns:
+        invoiced items of the document
+    """
+    items = []
+    subtotal = 0.0
+    for chunk in chunks:
+        for index, item in enumerate(chunk):
+            boundary = index in (0, len(chunk) - 1)
+            if boundary and is_table_header(item):
+                continue
+            amount = item_amount(item)
+            if CARRIED_OVER_PATTERN.search(str(item.get("description", ""))) and (
+                boundary or (amount is not None and abs(amount - subtotal) < 0.01)
+            ):
+                continue
+            items.append(item)
+            subtotal += amount or 0
+    return items
@@ -1,25 +1,103 @@
+import re
+import unicodedata
+from collections.abc import Iterator
+from contextlib import contextmanager
 from io import BytesIO
+from typing import BinaryIO
 
 import pypdf
 from loguru import logger
 
+ATCUD_PATTERN = re.compile(r"\bATCUD\b", re.IGNORECASE)
+# unicode categories of characters that show up when a PDF font has no usable text mapping
+GARBLED_CATEGORIES = {"Cc", "Co", "Cn", "Cs"}
 
-def read_pdf(stream: bytes) -> list[str]:
+
+@contextmanager
+def open_source(source: bytes | str) -> Iterator[BinaryIO]:
+    """Open the file content, in memory or in a local file (read on demand, the whole file is never loaded)
+
+    Args:
+        source: binary file data, or path of a local file with the data
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            yield file
+    else:
+        yield BytesIO(source)
+
+
+def read_pdf(stream: bytes | str) -> list[str]:
     """Process PDF using pypdf. Extracts text per page and decodes a QR code (with zbar) that has a valid SAF-T PT format.
 
     Args:
-        stream: binary file data.
+        stream: binary file data, or path of a local file with the data.
     Returns:
         detected text from the pdf
     """
 
-    # PdfReader accepts BytesIO or local paths, BytesIO is used
-
-    reader = pypdf.PdfReader(BytesIO(stream))
-    text = []
-    for page in reader.pages:
-        text.append(page.extract_text())
+    # PdfReader loads a whole file given by its path in memory, an open file is read on demand
+    with open_source(stream) as file:
+        reader = pypdf.PdfReader(file)
+        text = []
+        for page in reader.pages:
+            text.append(page.extract_text())
 
     if not text:
         logger.info("No text found")
     return text
+
+
+def read_pdf_pages(stream: bytes | str, first: int, last: int) -> tuple[list[str], int]:
+    """Extract the text of a range of pages (meant to run in a worker, each worker reads a part of a big PDF)
+
+    Args:
+        stream: binary file data, or path of a local file with the data (only the path is sent to the worker)
+        first: index of the first page (starting at 0)
+        last: index after the last page
+
+    Returns:
+        tuple of detected text of each page in the range and number of pages of the PDF
+    """
+    with open_source(stream) as file:
+        reader = pypdf.PdfReader(file)
+        page_count = len(reader.pages)
+        return [reader.pages[index].extract_text() for index in range(first, min(last, page_count))], page_count
+
+
+def garbled_ratio(text: str) -> float:
+    """Fraction of characters in the text that can not be read (replacement, control or private use characters)
+
+    Args:
+        text: text extracted from the pdf
+
+    Returns:
+        ratio between 0 and 1 (0 for an empty text)
+    """
+    text = re.sub(r"\s", "", text)
+    if not text:
+        return 0.0
+    garbled = sum(1 for char in text if char == "\ufffd" or unicodedata.category(char) in GARBLED_CATEGORIES)
+    # glyphs without unicode mapping are extracted as (cid:123)
+    garbled += sum(len(cid) for cid in re.findall(r"\(cid:\d+\)", text))
+    return garbled / len(text)
+
+
+def is_text_layer_usable(pages: list[str], min_length: int, max_garbled_ratio: float) -> bool:
+    """Check if the text extracted from the pdf can replace the OCR
+
+    Args:
+        pages: text of each page extracted from the pdf
+        min_length: minimum number of characters of the whole document
+        max_garbled_ratio: maximum fraction of unreadable characters
+
+    Returns:
+        whether the text is long enough and readable
+    """
+    text = "".join(pages)
+    return len(text.strip()) >= min_length and garbled_ratio(text) <= max_garbled_ratio
+
+
+def mentions_atcud(pages: list[str]) -> bool:
+    """Check if the text mentions an ATCUD code, meaning that a SAF-T PT QR code should be present"""
+    return any(ATCUD_PATTERN.search(page) for page in pages)
@@ -4,101 +4,396 @@ Async methods to process documents
 
 """
 
+import asyncio
 import time
+from collections.abc import AsyncIterator
 
+import magic
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, ContentFormat, DocumentAnalysisFeature
+from azure.ai.documentintelligence.models import (
+    AnalyzeResult,
+    ContentFormat,
+    DocumentAnalysisFeature,
+)
 from loguru import logger
 from openai import AsyncAzureOpenAI
 
-from idr.document.document import Document
-from idr.document.qr_codes import read_barcode_from_ocr
+from idr.cache import Cache, make_cache_key
+from idr.document.document import Document, get_file_kind
+from idr.document.incremental import merge_extraction
+from idr.document.pdf_reader import read_pdf_pages
+from idr.document.qr_codes import decode_qr_from_file, qr_decoding_available, read_barcode_from_ocr
 from idr.document.utils import parse_response_json
-from idr.llm import call_chat_completions
+from idr.document.workers import run_in_worker, worker_count
+from idr.llm import call_chat_completions, stream_chat_completions
+from idr.llm.json_stream import JsonStreamParser
 from idr.llm.prompt_formatting import make_classification_prompt, make_extraction_prompt
+from idr.llm.rate_limiter import RateLimiter
+from idr.llm.token_budget import TokenBudget
+from idr.llm.tokens import count_tokens
+from idr.metrics import span
 
+OCR_MODEL_ID = "prebuilt-layout"
+OCR_FEATURES = [DocumentAnalysisFeature.BARCODES]
+OCR_CONTENT_FORMAT = ContentFormat.MARKDOWN
+OCR_PAGE_BREAK = "<!-- PageBreak -->"
+OCR_CONTENT_TYPE = "application/octet-stream"
 
-async def async_read_ocr(document: Document, client: DocumentIntelligenceClient) -> tuple[str, dict[str, str]]:
+
+async def async_read_filetype(document: Document, pages_per_worker: int = 20) -> None:
+    """Detects file type and reads the PDF text in the worker pool, without blocking the event loop.
+    Big PDFs are split in ranges of pages read in parallel.
+    TODO: THIS MODIFIES THE INPUT OBJECT
+
+    Args:
+        document: Document to be read
+        pages_per_worker: number of pages read by each worker
+
+    Raises:
+        ValueError: When the document type is not valid
+    """
+    read_start = time.time()
+    await document.load("stream")
+
+    # libmagic only needs the beginning of the file, this is fast enough to run in the event loop
+    with span("mime_detection"):
+        file_kind = get_file_kind(magic.from_buffer(document.read_header()))
+    if file_kind == "image":
+        document.is_image = True
+        document.text = [""]
+        return
+
+    with span("pdf_parsing"):
+        text, page_count = await run_in_worker(read_pdf_pages, document.source, 0, pages_per_worker)
+        # the remaining pages are split in at most one range of pages per worker
+        remaining_pages = page_count - pages_per_worker
+        if remaining_pages > 0:
+            range_size = max(pages_per_worker, -(-remaining_pages // worker_count()))
+            texts = await asyncio.gather(
+                *[
+                    run_in_worker(read_pdf_pages, document.source, first, first + range_size)
+                    for first in range(pages_per_worker, page_count, range_size)
+                ]
+            )
+            text += [page_text for range_text, _ in texts for page_text in range_text]
+
+    document.text = text
+    logger.info(f"Read {page_count} PDF pages in time = {time.time()-read_start}")
+
+
+async def async_read_qr_code(document: Document, max_pages: int = 2) -> tuple[dict[str, str], int | None]:
+    """Decode the SAF-T PT QR code locally (without OCR) in a worker process
+
+    Args:
+        document: Document to be read (after read_filetype)
+        max_pages: maximum number of PDF pages to search
+
+    Returns:
+        tuple of dictionary with qrcode data (empty if not found) and index of the page with the code
+    """
+    if not qr_decoding_available():
+        logger.warning("zbar is not installed, the QR code can only be read with OCR")
+        return {}, None
+
+    qr_start = time.time()
+    await document.load("stream")
+    with span("qr_decoding"):
+        qr_data, qr_page = await run_in_worker(decode_qr_from_file, document.source, document.is_image, max_pages)
+    logger.info(f"Local QR code decoding found={bool(qr_data)} in time = {time.time()-qr_start}")
+    return qr_data, qr_page
+
+
+def ocr_cache_key(document: Document, pages: list[int] | None = None) -> str:
+    """Cache key of the OCR result: hash of the file content and of the analysis options"""
+    return make_cache_key(
+        document.content_hash(),
+        OCR_MODEL_ID,
+        ",".join(OCR_FEATURES),
+        OCR_CONTENT_FORMAT,
+        format_page_ranges(pages) if pages else "",
+    )
+
+
+def format_page_ranges(pages: list[int]) -> str:
+    """Format page numbers as Document Intelligence page ranges, e.g. [1, 2, 3, 5] -> "1-3,5" """
+    ranges = []
+    for page in sorted(set(pages)):
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def split_ocr_pages(ocr_result: AnalyzeResult) -> dict[int, str]:
+    """Split the markdown content of the OCR result by page
+
+    Args:
+        ocr_result: result of Document Intelligence Analysis
+
+    Returns:
+        text of each analyzed page, by page number (starting at 1)
+    """
+    page_numbers = [page.page_number for page in ocr_result.pages]
+    contents = ocr_result.content.split(OCR_PAGE_BREAK)
+    if len(contents) != len(page_numbers):
+        logger.warning("OCR content could not be split by page, keeping it in the first page")
+        contents = [ocr_result.content] + [""] * (len(page_numbers) - 1)
+    return {number: content.strip("\n") for number, content in zip(page_numbers, contents)}
+
+
+def select_ocr_pages(
+    document: Document, max_tokens: int, qr_page: int | None = None, min_page_tokens: int = 1000
+) -> list[int] | None:
+    """Select the pages whose text can reach the prompts, the other pages do not need to be read by the OCR
+
+    The tokens of each page are counted in the PDF text, with at least min_page_tokens (the text of scanned pages
+    is only known after the OCR), one extra page is added as a margin since the OCR markdown is longer than the
+    PDF text.
+
+    Args:
+        document: Document with the text read from the PDF (one element per page)
+        max_tokens: maximum tokens of the document text in the prompts (CLASS_MAX_TOKENS / EXT_MAX_TOKENS)
+        qr_page: index of the page with the QR code (starting at 0), always selected
+        min_page_tokens: estimated tokens of a page without text in the PDF
+
+    Returns:
+        page numbers to read (starting at 1), None for all pages
+    """
+    if document.is_image:
+        return None
+
+    pages = []
+    tokens = 0
+    for number, page_text in enumerate(document.text, start=1):
+        pages.append(number)
+        tokens += max(count_tokens(page_text or ""), min_page_tokens)
+        if tokens >= max_tokens:
+            break
+    if len(pages) < len(document.text):
+        pages.append(len(pages) + 1)
+    if qr_page is not None:
+        pages.append(qr_page + 1)
+
+    pages = sorted(set(pages))
+    if len(pages) >= len(document.text):
+        return None
+    return pages
+
+
+async def async_read_ocr(
+    document: Document,
+    client: DocumentIntelligenceClient,
+    cache: Cache | None = None,
+    pages: list[int] | None = None,
+) -> tuple[dict[int, str], dict[str, str]]:
     """Use OCR services to read text from an image asynchronously
 
     Args:
         document: Document to be read
         client: async client for the Document Intelligence servive in Azure
+        cache: cache of previous OCR results, the service is not called for an already analyzed file
+        pages: page numbers to read (starting at 1), all pages if None
 
     Returns:
-        tuple of document text and dictionary with qrcode data
+        tuple of text of each page read (by page number) and dictionary with qrcode data
     """
 
     ocr_start = time.time()
+    await document.load("stream")
 
-    logger.info(f"Starting OCR service for {document.doc_id=}")
+    if cache is not None:
+        # hashing a big file takes a while, out of the event loop
+        cache_key = await asyncio.to_thread(ocr_cache_key, document, pages)
+        cached_result = await cache.get(cache_key)
+        if cached_result is not None:
+            logger.info(f"OCR result for {document.doc_id=} found in the {cache.name} cache")
+            page_texts = {int(number): text for number, text in cached_result["pages"].items()}
+            return page_texts, cached_result["qr_data"]
 
-    poller = await client.begin_analyze_document(
-        model_id="prebuilt-layout",
-        analyze_request=AnalyzeDocumentRequest(bytes_source=document.stream),
-        features=[DocumentAnalysisFeature.BARCODES],
-        output_content_format=ContentFormat.MARKDOWN,
-    )
-    ocr_result = await poller.result()
+    logger.info(f"Starting OCR service for {document.doc_id=} {pages=}")
+
+    # the file is sent as the raw request body, streamed from memory or from the local file (a json
+    # AnalyzeDocumentRequest would hold a base64 copy of the whole file)
+    with span("ocr", pages=len(pages) if pages else 0), document.open_stream() as body:
+        poller = await client.begin_analyze_document(
+            model_id=OCR_MODEL_ID,
+            analyze_request=body,
+            content_type=OCR_CONTENT_TYPE,
+            pages=format_page_ranges(pages) if pages else None,
+            features=OCR_FEATURES,
+            output_content_format=OCR_CONTENT_FORMAT,
+        )
+        ocr_result = await poller.result()
     logger.info(f"Extracted text length = {len(ocr_result.content)} in time = {time.time()-ocr_start}")
 
+    page_texts = split_ocr_pages(ocr_result)
     qr_data = read_barcode_from_ocr(ocr_result)
 
-    return ocr_result.content, qr_data
+    if cache is not None:
+        await cache.set(cache_key, {"pages": page_texts, "qr_data": qr_data})
 
+    return page_texts, qr_data
 
-async def async_classify(document: Document, llm_client: AsyncAzureOpenAI, llm_model: str) -> dict[str, str]:
+
+async def async_classify(
+    document: Document,
+    llm_client: AsyncAzureOpenAI,
+    llm_model: str,
+    cache: Cache | None = None,
+    rate_limiter: RateLimiter | None = None,
+    max_retries: int = 5,
+    budget: TokenBudget | None = None,
+    use_cache: bool = True,
+) -> dict[str, str]:
     """Use openAI ChatGPT services to classify document text asynchronously
 
     Args:
         document: Document to be classified
         llm_client: async client for openAI ChatGPT
         llm_model: model name to use for classification
+        cache: cache of previous completions
+        rate_limiter: token bucket of the deployment
+        max_retries: retries of rate limited and transient errors
+        budget: context and output tokens of the model, to fit the document text in the prompt
+        use_cache: if False the cached completion is not read (see call_chat_completions)
 
     Returns:
         dict of the model's classification
     """
     logger.info(f"Classification starting for {document.doc_id=}")
 
-    text = "\f".join(document.text)
+    await document.load("text")
+    text = document.get_text()
     logger.info(f"Full text length: {len(text)}")
 
-    prompt = make_classification_prompt(text, document.has_qr(), document.qr_info)
-    completion = await call_chat_completions(
-        llm_client=llm_client, llm_model=llm_model, text=text, prompt=prompt, process_name="Classification"
-    )
+    prompt = make_classification_prompt(text, document.has_qr(), document.qr_info, budget)
+    with span("classification"):
+        completion = await call_chat_completions(
+            llm_client=llm_client,
+            llm_model=llm_model,
+            text=text,
+            prompt=prompt,
+            process_name="Classification",
+            cache=cache,
+            use_cache=use_cache,
+            rate_limiter=rate_limiter,
+            max_retries=max_retries,
+        )
 
     classification_completion = parse_response_json(completion)
 
     return classification_completion
 
 
-async def async_extract(document: Document, llm_client: AsyncAzureOpenAI, llm_model: str) -> dict[str, str]:
+async def async_classify_stream(
+    document: Document,
+    llm_client: AsyncAzureOpenAI,
+    llm_model: str,
+    cache: Cache | None = None,
+    rate_limiter: RateLimiter | None = None,
+    max_retries: int = 5,
+    budget: TokenBudget | None = None,
+    use_cache: bool = True,
+) -> AsyncIterator[tuple[str, dict]]:
+    """Classify the document text with a streamed completion, giving each field as soon as it is generated
+
+    Same arguments as async_classify.
+
+    Yields:
+        ("fields", fields completed by the last chunk) while the completion is generated,
+        then ("completion", dict of the model's classification)
+    """
+    logger.info(f"Streamed classification starting for {document.doc_id=}")
+
+    await document.load("text")
+    text = document.get_text()
+    prompt = make_classification_prompt(text, document.has_qr(), document.qr_info, budget)
+    parser = JsonStreamParser()
+    with span("classification"):
+        async for chunk in stream_chat_completions(
+            llm_client=llm_client,
+            llm_model=llm_model,
+            text=text,
+            prompt=prompt,
+            process_name="Classification",
+            cache=cache,
+            use_cache=use_cache,
+            rate_limiter=rate_limiter,
+            max_retries=max_retries,
+        ):
+            fields = parser.feed(chunk)
+            if fields:
+                yield "fields", fields
+
+    yield "completion", parse_response_json(parser.text or None)
+
+
+async def async_extract(
+    document: Document,
+    llm_client: AsyncAzureOpenAI,
+    llm_model: str,
+    cache: Cache | None = None,
+    text: str | None = None,
+    rate_limiter: RateLimiter | None = None,
+    max_retries: int = 5,
+    budget: TokenBudget | None = None,
+    doc_type: str | None = None,
+    fields: list[str] | None = None,
+    previous: dict | None = None,
+    use_cache: bool = True,
+) -> dict[str, str]:
     """Use openAI ChatGPT services to extract extra fields from document text, asynchronously
 
+    With `fields` only those fields are asked (incremental extraction), and merged into the `previous` extraction
+    before the postprocessing.
+
     Args:
         document: Document to be extracted
         llm_client: async client for openAI ChatGPT
         llm_model: model name to use for extraction
+        cache: cache of previous completions
+        text: text to extract from, defaults to the whole document text
+        rate_limiter: token bucket of the deployment
+        max_retries: retries of rate limited and transient errors
+        budget: context and output tokens of the model, to fit the document text in the prompt
+        doc_type: document type of the prompt, defaults to document.doc_type (e.g. a guess before the classification)
+        fields: only ask these fields, all the fields of the document type if None
+        previous: previous extraction completed by the asked fields (see idr.document.incremental)
+        use_cache: if False the cached completion is not read (see call_chat_completions)
 
     Returns:
         dict of the model's extraction
     """
     logger.info(f"Extraction starting for {document.doc_id}")
 
-    text = "\f".join(document.text)
+    if text is None:
+        await document.load("text")
+        text = document.get_text()
     logger.info(f"Full text length: {len(text)}")
 
-    prompt = make_extraction_prompt(text, document.doc_type, document.has_qr())
+    prompt = make_extraction_prompt(text, doc_type or document.doc_type, document.has_qr(), budget, fields)
 
-    completion = await call_chat_completions(
-        llm_client=llm_client, llm_model=llm_model, text=text, prompt=prompt, process_name="Extraction"
-    )
+    with span("extraction"):
+        completion = await call_chat_completions(
+            llm_client=llm_client,
+            llm_model=llm_model,
+            text=text,
+            prompt=prompt,
+            process_name="Extraction",
+            cache=cache,
+            use_cache=use_cache,
+            rate_limiter=rate_limiter,
+            max_retries=max_retries,
+        )
 
     extraction_completion = parse_response_json(completion)
+    if fields is not None:
+        extraction_completion = merge_extraction(previous or {}, extraction_completion, fields)
 
     try:
-        extraction_completion = document.postprocess_extraction_fields(extraction_completion)
+        with span("extraction_postprocessing"):
+            extraction_completion = document.postprocess_extraction_fields(extraction_completion)
     except Exception as e:
         logger.error(f"Error while postprocessing extraction fields: {e}")
         return {}
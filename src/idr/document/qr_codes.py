@@ -1,4 +1,27 @@
+from typing import BinaryIO
+
+import pypdf
 from azure.ai.documentintelligence.models import AnalyzeResult
+from loguru import logger
+from PIL import Image
+
+from idr.document.pdf_reader import open_source
+
+try:
+    from pyzbar.pyzbar import ZBarSymbol
+    from pyzbar.pyzbar import decode as zbar_decode
+except ImportError:  # the zbar shared library is not installed (libzbar0)
+    zbar_decode = None
+
+try:
+    import pypdfium2
+except ImportError:  # pypdfium2 is optional, without it the QR codes drawn as vector graphics are only read by the OCR
+    pypdfium2 = None
+
+# embedded images smaller than this (in pixels) can not hold a readable QR code
+QR_MIN_IMAGE_SIZE = 64
+# resolution of the pages rendered to search a QR code drawn as vector graphics
+QR_RENDER_DPI = 200
 
 
 def read_barcode_from_ocr(ocr_result: AnalyzeResult) -> dict[str, str]:
@@ -26,6 +49,114 @@ def read_barcode_from_ocr(ocr_result: AnalyzeResult) -> dict[str, str]:
     return qr_data
 
 
+def qr_decoding_available() -> bool:
+    return zbar_decode is not None
+
+
+def qr_candidate_pages(page_count: int, max_pages: int) -> list[int]:
+    """Pages most likely to have the SAF-T PT QR code: it is printed on the first or the last page
+
+    Args:
+        page_count: number of pages in the document
+        max_pages: maximum number of pages to return
+
+    Returns:
+        page indexes in the order they should be searched (first, last, second, second to last, ...)
+    """
+    pages = []
+    for i in range((page_count + 1) // 2):
+        pages.append(i)
+        if page_count - 1 - i != i:
+            pages.append(page_count - 1 - i)
+    return pages[:max_pages]
+
+
+def decode_qr_from_image(image: Image.Image) -> dict[str, str]:
+    """Decode the first valid SAF-T PT QR code in an image with zbar
+
+    Args:
+        image: image to search
+
+    Returns:
+        dict with the QR code data, empty if not found
+    """
+    if zbar_decode is None:
+        return {}
+    for symbol in zbar_decode(image, symbols=[ZBarSymbol.QRCODE]):
+        qr_code = symbol.data.decode("utf-8", errors="replace")
+        try:
+            if validate_qr_code(qr_code):
+                return qr_code_to_dict(qr_code)
+        except ValueError:  # not a SAF-T PT code (e.g. an url)
+            continue
+    return {}
+
+
+def decode_qr_from_file(stream: bytes | str, is_image: bool, max_pages: int = 2) -> tuple[dict[str, str], int | None]:
+    """Decode the SAF-T PT QR code locally, from an image file or from the images embedded in a PDF.
+
+    Only the pages most likely to have the code are searched (see qr_candidate_pages). When none of their embedded
+    images has the code, the pages are rendered to find a code drawn as vector graphics, if pypdfium2 is installed.
+    This is CPU bound, it is meant to run in a worker process.
+
+    Args:
+        stream: binary file data, or path of a local file with the data
+        is_image: whether the file is an image (otherwise a PDF)
+        max_pages: maximum number of PDF pages to search
+
+    Returns:
+        tuple of dict with the QR code data (empty if not found) and the index of the page where it was found
+    """
+    if zbar_decode is None:
+        return {}, None
+
+    with open_source(stream) as file:
+        if is_image:
+            qr_data = decode_qr_from_image(Image.open(file))
+            return qr_data, 0 if qr_data else None
+        qr_data, qr_page = decode_qr_from_pdf(pypdf.PdfReader(file), max_pages)
+        if not qr_data and pypdfium2 is not None:
+            file.seek(0)
+            qr_data, qr_page = decode_qr_from_rendered_pdf(file, max_pages)
+        return qr_data, qr_page
+
+
+def decode_qr_from_pdf(reader: pypdf.PdfReader, max_pages: int) -> tuple[dict[str, str], int | None]:
+    """Decode the SAF-T PT QR code from the images embedded in the candidate pages of a PDF"""
+    for page_index in qr_candidate_pages(len(reader.pages), max_pages):
+        try:
+            images = [page_image.image for page_image in reader.pages[page_index].images]
+        except Exception as e:
+            logger.warning(f"Error while reading the images of page {page_index}: {e}")
+            continue
+        images = [image for image in images if image is not None and min(image.size) >= QR_MIN_IMAGE_SIZE]
+        # QR codes are square, try the most square images first
+        images.sort(key=lambda image: abs(image.size[0] / image.size[1] - 1))
+        for image in images:
+            qr_data = decode_qr_from_image(image)
+            if qr_data:
+                return qr_data, page_index
+    return {}, None
+
+
+def decode_qr_from_rendered_pdf(file: BinaryIO, max_pages: int) -> tuple[dict[str, str], int | None]:
+    """Decode the SAF-T PT QR code from the candidate pages of a PDF rendered at QR_RENDER_DPI with pypdfium2"""
+    pdf = pypdfium2.PdfDocument(file)
+    try:
+        for page_index in qr_candidate_pages(len(pdf), max_pages):
+            try:
+                image = pdf[page_index].render(scale=QR_RENDER_DPI / 72, grayscale=True).to_pil()
+            except Exception as e:
+                logger.warning(f"Error while rendering page {page_index}: {e}")
+                continue
+            qr_data = decode_qr_from_image(image)
+            if qr_data:
+                return qr_data, page_index
+    finally:
+        pdf.close()
+    return {}, None
+
+
 def validate_qr_code(qr_code: str) -> bool:
     """Check if qr code has a valid SAF-T PT format.
 
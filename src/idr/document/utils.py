@@ -3,7 +3,78 @@ import re
 
 from loguru import logger
 
-json_pattern = re.compile(r"{(?:[^{}]|(.*))*}")
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, only faster
+    json_loads = json.loads
+
+
+# strings (skipped whole, an unclosed one to the end of the text) and braces, matched in linear time
+json_tokens_pattern = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?|[{}]', re.DOTALL)
+
+
+class ResponseParseError(ValueError):
+    """The LLM response has no valid json object"""
+
+
+def find_json_object(response: str) -> str:
+    """First balanced json object of a text, e.g. inside a markdown code fence, in a single pass over its strings and braces
+
+    Args:
+        response: text with a json object
+
+    Raises:
+        ResponseParseError: if the text has no object or it is not closed (e.g. a truncated completion)
+
+    Returns:
+        text of the object, from its opening to its closing brace
+    """
+    start = response.find("{")
+    if start < 0:
+        raise ResponseParseError("No json object in the response")
+    depth = 0
+    for token in json_tokens_pattern.finditer(response, start):
+        brace = token.group()
+        if brace == "{":
+            depth += 1
+        elif brace == "}":
+            depth -= 1
+            if depth == 0:
+                return response[start : token.end()]
+    raise ResponseParseError(f"The json object of the response is not closed ({len(response)} characters)")
+
+
+def parse_json_object(response: str | None) -> dict:
+    """Parse an LLM response to a json dictionary
+
+    The whole response is parsed first (json_object response format), then the text from its first to its last brace,
+    then the first balanced json object in it (e.g. followed by text with braces).
+
+    Args:
+        response: llm response, json string
+
+    Raises:
+        ResponseParseError: if the response has no valid json object
+
+    Returns:
+        parsed json dictionary
+    """
+    if response is None:
+        raise ResponseParseError("No response")
+    try:
+        parsed = json_loads(response)
+    except ValueError:
+        try:
+            # text around the object, e.g. a markdown code fence
+            parsed = json_loads(response[response.find("{") : response.rfind("}") + 1])
+        except ValueError:
+            try:
+                parsed = json_loads(find_json_object(response))
+            except ValueError as e:  # including ResponseParseError
+                raise ResponseParseError(f"Invalid json in the response: {e}") from e
+    if not isinstance(parsed, dict):
+        raise ResponseParseError(f"The response is a json {type(parsed).__name__}, not an object")
+    return parsed
 
 
 def parse_response_json(response: str | None) -> dict[str, str]:
@@ -13,12 +84,11 @@ def parse_response_json(response: str | None) -> dict[str, str]:
         response: llm response, json string
 
     Returns:
-        parsed json dictionary
+        parsed json dictionary, {} if the response has no valid json object (see parse_json_object to get the error)
     """
     try:
-        completion_json = re.search(json_pattern, response).group()  # type: ignore
-        extraction_completion = json.loads(completion_json)
-    except Exception as e:
+        extraction_completion = parse_json_object(response)
+    except ResponseParseError as e:
         logger.error(f"Error while encoding OpenAI completion: {e}")
         extraction_completion = {}
 
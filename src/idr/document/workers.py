@@ -0,0 +1,85 @@
+"""
+IDR 2024
+
+Worker pool to run CPU bound document processing without blocking the event loop
+"""
+
+import asyncio
+import multiprocessing
+import os
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+from loguru import logger
+
+WORKER_POOLS = ("process", "thread")
+
+_pool: Executor | None = None
+_pool_kind: str = "process"
+_max_workers: int | None = None
+
+
+def start_workers(max_workers: int | None = None, pool: str = "process") -> Executor:
+    """Start the worker pool (called on the API startup, otherwise started on first use)
+
+    Args:
+        max_workers: number of workers, defaults to the number of CPUs
+        pool: "process" for a process pool, "thread" for a thread pool (no parallelism for pure python code,
+            but no serialization of the arguments either)
+
+    Raises:
+        ValueError: if the pool kind is unknown
+    """
+    global _pool, _pool_kind, _max_workers
+
+    if pool not in WORKER_POOLS:
+        raise ValueError(f"Invalid worker pool: {pool}. \n Valid pools: {', '.join(WORKER_POOLS)}")
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+    _pool_kind = pool
+    _max_workers = max_workers or os.cpu_count() or 1
+    if pool == "process":
+        # spawn avoids forking a process that holds event loop and client threads
+        _pool = ProcessPoolExecutor(max_workers=_max_workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        _pool = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix="idr-worker")
+    logger.info(f"Started {_max_workers} document processing workers ({pool} pool)")
+    return _pool
+
+
+def stop_workers() -> None:
+    """Stop the worker pool (called on the API shutdown)"""
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def worker_count() -> int:
+    return _max_workers or os.cpu_count() or 1
+
+
+async def run_in_worker(function: Callable, *args: Any) -> Any:
+    """Run a function in the worker pool
+
+    If a worker process crashes (e.g. out of memory) the pool is restarted and the call is retried in a thread.
+
+    Args:
+        function: module level function (it must be picklable)
+        args: picklable arguments
+
+    Returns:
+        result of the function
+    """
+    pool = _pool or start_workers(_max_workers, _pool_kind)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, function, *args)
+    except BrokenProcessPool:
+        logger.warning(f"A document processing worker crashed while running {function.__name__}, retrying in a thread")
+        start_workers(_max_workers, _pool_kind)
+        return await asyncio.to_thread(function, *args)
@@ -0,0 +1,394 @@
+"""
+IDR 2024
+
+Asynchronous jobs: the API answers with a job id right away, workers drain a persistent queue of documents
+and the output is delivered by status polling or a webhook callback
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import aiohttp
+from loguru import logger
+
+from idr.batch import BATCH_STAGES, process_file
+from idr.config import JOB_DB, JOB_QUEUE, JOB_RETENTION, JOB_WORKERS
+
+JOB_QUEUES = ("none", "sqlite")
+JOB_STATUSES = ("queued", "running", "done", "failed")
+# seconds between checks of the queue by idle workers (new jobs of this API instance wake them up immediately)
+JOB_POLL_INTERVAL = 5.0
+CALLBACK_ATTEMPTS = 3
+CALLBACK_TIMEOUT = 30.0
+
+
+@dataclass
+class Job:
+    job_id: str
+    stage: str
+    file_path: str
+    file_url: str = ""
+    callback_url: str | None = None
+    status: str = "queued"
+    result: dict | None = None
+    error: str | None = None
+    created: float = 0.0
+    updated: float = 0.0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class JobStore(ABC):
+    """Base class for the persistent job queues
+
+    A file_path has at most one queued or running job per stage, submitting it again returns that job.
+    """
+
+    @abstractmethod
+    async def submit(
+        self, stage: str, file_path: str, file_url: str = "", callback_url: str | None = None
+    ) -> tuple[Job, bool]:
+        """Queue a job, unless the same stage is already queued or running for the file
+
+        Returns:
+            tuple of the job and whether it was created (False for the job already in flight)
+        """
+
+    @abstractmethod
+    async def claim(self, stage: str) -> Job | None:
+        """Mark the oldest queued job of the stage as running and return it, None if the queue is empty"""
+
+    @abstractmethod
+    async def finish(self, job_id: str, result: dict | None = None, error: str | None = None) -> Job:
+        """Mark a running job as done with its result, or as failed with an error message"""
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Job | None:
+        """Get a job by id, None if it does not exist"""
+
+    @abstractmethod
+    async def requeue_running(self) -> int:
+        """Queue again the jobs left running by a stopped API, returns their number"""
+
+    @abstractmethod
+    async def delete_finished(self, older_than: float) -> int:
+        """Delete the jobs finished more than older_than seconds ago, returns their number"""
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteJobStore(JobStore):
+    """Job queue in a local SQLite database (the calls run in a thread, the connection is shared)
+
+    The queue survives restarts of the API. Several processes can share the database, the claim of a job
+    is atomic, but requeue_running assumes that a single API instance processes the jobs.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = str(path)
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    file_url TEXT NOT NULL,
+                    callback_url TEXT,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (stage, status, created)")
+            # deduplication of the submissions in flight, also between processes
+            self._connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS jobs_in_flight ON jobs (stage, file_path) "
+                "WHERE status IN ('queued', 'running')"
+            )
+
+    @staticmethod
+    def _job(row: sqlite3.Row | None) -> Job | None:
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return Job(**job)
+
+    def _execute(self, query: str, *parameters) -> sqlite3.Row | None:
+        """Run a query and return its first row (all rows are fetched, so that the statement is done)"""
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return rows[0] if rows else None
+
+    def _count(self, query: str, *parameters) -> int:
+        """Run a query and return the number of changed rows"""
+        with self._lock:
+            return self._connection.execute(query, parameters).rowcount
+
+    def _submit(self, stage: str, file_path: str, file_url: str, callback_url: str | None) -> tuple[Job, bool]:
+        now = time.time()
+        try:
+            row = self._execute(
+                "INSERT INTO jobs (job_id, stage, file_path, file_url, callback_url, status, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?) RETURNING *",
+                uuid.uuid4().hex,
+                stage,
+                file_path,
+                file_url,
+                callback_url,
+                now,
+                now,
+            )
+            return self._job(row), True
+        except sqlite3.IntegrityError:
+            row = self._execute(
+                "SELECT * FROM jobs WHERE stage = ? AND file_path = ? AND status IN ('queued', 'running')",
+                stage,
+                file_path,
+            )
+            if row is None:  # finished in the meantime
+                return self._submit(stage, file_path, file_url, callback_url)
+            return self._job(row), False
+
+    async def submit(
+        self, stage: str, file_path: str, file_url: str = "", callback_url: str | None = None
+    ) -> tuple[Job, bool]:
+        return await asyncio.to_thread(self._submit, stage, file_path, file_url, callback_url)
+
+    async def claim(self, stage: str) -> Job | None:
+        row = await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = 'running', updated = ? WHERE job_id = ("
+            "SELECT job_id FROM jobs WHERE stage = ? AND status = 'queued' ORDER BY created LIMIT 1) RETURNING *",
+            time.time(),
+            stage,
+        )
+        return self._job(row)
+
+    async def finish(self, job_id: str, result: dict | None = None, error: str | None = None) -> Job:
+        row = await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE job_id = ? RETURNING *",
+            "failed" if error is not None else "done",
+            json.dumps(result) if result is not None else None,
+            error,
+            time.time(),
+            job_id,
+        )
+        if row is None:
+            raise ValueError(f"Job not found: {job_id}")
+        return self._job(row)
+
+    async def get(self, job_id: str) -> Job | None:
+        return self._job(await asyncio.to_thread(self._execute, "SELECT * FROM jobs WHERE job_id = ?", job_id))
+
+    async def requeue_running(self) -> int:
+        return await asyncio.to_thread(self._count, "UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    async def delete_finished(self, older_than: float) -> int:
+        return await asyncio.to_thread(
+            self._count,
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+            time.time() - older_than,
+        )
+
+    async def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def make_job_store(backend: str = JOB_QUEUE, path: str | Path = JOB_DB) -> JobStore | None:
+    """Create a job queue from its configuration, None if the jobs are disabled ("none")
+
+    Raises:
+        ValueError: if the backend is unknown
+    """
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        return SQLiteJobStore(path)
+    raise ValueError(f"Invalid job queue: {backend}. \n Valid queues: {', '.join(JOB_QUEUES)}")
+
+
+async def send_callback(job: Job, attempts: int = CALLBACK_ATTEMPTS) -> bool:
+    """POST the finished job (as json) to its callback url, retrying with a backoff
+
+    Returns:
+        whether the callback was delivered
+    """
+    timeout = aiohttp.ClientTimeout(total=CALLBACK_TIMEOUT)
+    for attempt in range(attempts):
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(job.callback_url, json=job.to_dict()) as response:
+                    response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.warning(f"Error while calling back {job.callback_url} for job {job.job_id} ({attempt=}): {e}")
+            if attempt + 1 < attempts:
+                await asyncio.sleep(2**attempt)
+    logger.error(f"Callback of job {job.job_id} to {job.callback_url} failed")
+    return False
+
+
+class JobWorkers:
+    """Workers draining the job queue, with a number of workers (jobs processed at a time) per stage"""
+
+    def __init__(
+        self,
+        store: JobStore,
+        concurrency: dict[str, int] = JOB_WORKERS,
+        process: Callable[[str, str, str], Awaitable[dict]] = process_file,
+        poll_interval: float = JOB_POLL_INTERVAL,
+    ):
+        """
+        Args:
+            store: job queue
+            concurrency: number of workers of each stage (stages without workers are only queued)
+            process: processing of a job, process(file_path, stage, file_url) -> output
+            poll_interval: seconds between checks of an empty queue
+        """
+        self.store = store
+        self.concurrency = concurrency
+        self.process = process
+        self.poll_interval = poll_interval
+        self._events = {stage: asyncio.Event() for stage in concurrency}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        for stage, workers in self.concurrency.items():
+            self._tasks += [asyncio.create_task(self._work(stage)) for _ in range(workers)]
+        logger.info(f"Started the job workers {self.concurrency}")
+
+    async def stop(self) -> None:
+        """Stop the workers, the jobs being processed are queued again on the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self, stage: str) -> None:
+        """Wake up the idle workers of a stage (a job was submitted)"""
+        if stage in self._events:
+            self._events[stage].set()
+
+    async def _work(self, stage: str) -> None:
+        event = self._events[stage]
+        while True:
+            # cleared before claiming, so that a job submitted after the claim wakes the worker up
+            event.clear()
+            try:
+                job = await self.store.claim(stage)
+            except Exception as e:
+                logger.error(f"Error while claiming a {stage} job: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(event.wait(), self.poll_interval)
+                except TimeoutError:
+                    pass
+                continue
+            try:
+                await self.run(job)
+            except Exception as e:
+                # e.g. the store could not save the output, the job is queued again on the next start
+                logger.error(f"Error while finishing {stage} job {job.job_id}: {e}")
+
+    async def run(self, job: Job) -> Job:
+        """Process a claimed job, store its output and call back"""
+        logger.info(f"Starting {job.stage} job {job.job_id} of {job.file_path}")
+        try:
+            result = await self.process(job.file_path, job.stage, job.file_url)
+            job = await self.store.finish(job.job_id, result=result)
+        except Exception as e:
+            logger.error(f"Error while processing {job.stage} job {job.job_id} of {job.file_path}: {e}")
+            job = await self.store.finish(job.job_id, error=f"{type(e).__name__}: {e}")
+        if job.callback_url:
+            await send_callback(job)
+        return job
+
+
+_store: JobStore | None = None
+_workers: JobWorkers | None = None
+
+
+async def start_jobs(store: JobStore | None = None, concurrency: dict[str, int] = JOB_WORKERS) -> JobWorkers | None:
+    """Open the job queue and start its workers (called on the API startup), nothing is started when JOB_QUEUE is "none"
+
+    Jobs interrupted by the previous shutdown are queued again, and old finished jobs are deleted.
+    """
+    global _store, _workers
+
+    _store = store or make_job_store()
+    if _store is None:
+        logger.info("The job queue is disabled")
+        return None
+    requeued = await _store.requeue_running()
+    if requeued:
+        logger.info(f"Queued again {requeued} jobs interrupted by the last shutdown")
+    if JOB_RETENTION is not None:
+        await _store.delete_finished(JOB_RETENTION)
+    _workers = JobWorkers(_store, concurrency)
+    _workers.start()
+    return _workers
+
+
+async def stop_jobs() -> None:
+    """Stop the job workers and close the queue (called on the API shutdown)"""
+    global _store, _workers
+
+    if _workers is not None:
+        await _workers.stop()
+        _workers = None
+    if _store is not None:
+        await _store.close()
+        _store = None
+
+
+async def submit_job(stage: str, file_path: str, file_url: str = "", callback_url: str | None = None) -> Job:
+    """Queue a stage on a document, the job already in flight for the same stage and file is returned instead
+
+    Raises:
+        ValueError: if the stage is unknown or the job queue is not started
+    """
+    if stage not in BATCH_STAGES:
+        raise ValueError(f"Invalid stage: {stage}. \n Valid stages: {', '.join(BATCH_STAGES)}")
+    if _store is None:
+        raise ValueError("The job queue is not started")
+    job, created = await _store.submit(stage, file_path, file_url, callback_url)
+    if created:
+        logger.info(f"Queued {stage} job {job.job_id} of {file_path}")
+        if _workers is not None:
+            _workers.notify(stage)
+    else:
+        logger.info(f"{stage} of {file_path} is already in flight as job {job.job_id}")
+    return job
+
+
+def jobs_enabled() -> bool:
+    """Whether the job queue is started"""
+    return _store is not None
+
+
+async def get_job(job_id: str) -> Job | None:
+    if _store is None:
+        raise ValueError("The job queue is not started")
+    return await _store.get(job_id)
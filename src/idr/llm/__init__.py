@@ -1,3 +1,4 @@
 from .llm_caller import call_chat_completions as call_chat_completions
+from .llm_caller import stream_chat_completions as stream_chat_completions
 from .openai_config import AzureOpenAIConfig as AzureOpenAIConfig
 from .prompt_formatting import make_extraction_prompt as make_extraction_prompt
@@ -0,0 +1,106 @@
+"""Splitting the document text in chunks of pages and tables, to extract long documents by parts"""
+
+import re
+
+from idr.llm.token_budget import PAGE_SEPARATOR
+from idr.llm.tokens import count_tokens
+
+# separator line between the header and the rows of a markdown table, e.g. |---|:---:|
+MARKDOWN_SEPARATOR_PATTERN = re.compile(r"^\|[\s|:-]+\|$")
+
+
+def split_page(page: str, max_tokens: int) -> list[str]:
+    """Split a page longer than max_tokens at line boundaries, never inside a table row
+
+    A table split in two is closed and opened again with its header rows, so that each part can be read on its own.
+
+    Args:
+        page: text of the page (markdown with html or markdown tables)
+        max_tokens: maximum tokens of each part (a single row longer than that is kept whole)
+
+    Returns:
+        parts of the page
+    """
+    parts = []
+    current: list[str] = []
+    tokens = 0
+    # lines starting the table open at the current line, repeated at the start of the next part
+    header: list[str] = []
+    html_table = in_row = in_header = False
+    markdown_rows = 0
+
+    for line in page.split("\n"):
+        line_tokens = count_tokens(line) + 1
+        if current and tokens + line_tokens > max_tokens and not in_row:
+            if html_table:
+                current.append("</table>")
+            parts.append("\n".join(current))
+            current = list(header)
+            tokens = sum(count_tokens(header_line) + 1 for header_line in header)
+        current.append(line)
+        tokens += line_tokens
+
+        stripped = line.strip()
+        if stripped.startswith("<table"):
+            html_table = in_header = True
+            header = [line]
+        elif in_header:
+            header.append(line)
+        if "<tr" in stripped:
+            in_row = True
+        if "</tr>" in stripped:
+            in_row = False
+            if in_header:
+                in_header = False
+                if "<th" not in "".join(header):  # the table has no header row, it is only opened again
+                    header = header[:1]
+        if "</table>" in stripped:
+            html_table = in_header = False
+            header = []
+
+        if not html_table:
+            if stripped.startswith("|"):
+                markdown_rows += 1
+                if markdown_rows == 1:
+                    header = [line]
+                elif markdown_rows == 2:
+                    header = header + [line] if MARKDOWN_SEPARATOR_PATTERN.match(stripped) else []
+            elif markdown_rows:
+                markdown_rows = 0
+                header = []
+
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+def chunk_pages(pages: list[str], max_tokens: int) -> list[str]:
+    """Group consecutive pages in chunks of at most max_tokens, splitting the longer pages
+
+    Args:
+        pages: text of each page
+        max_tokens: maximum tokens of each chunk
+
+    Returns:
+        text of each chunk, with the pages separated by form feeds
+    """
+    chunks = []
+    current: list[str] = []
+    tokens = 0
+    for page in pages:
+        parts = split_page(page, max_tokens) if count_tokens(page) > max_tokens else [page]
+        for part in parts:
+            part_tokens = count_tokens(part)
+            if current and tokens + part_tokens > max_tokens:
+                chunks.append(PAGE_SEPARATOR.join(current))
+                current, tokens = [], 0
+            current.append(part)
+            tokens += part_tokens
+    if current:
+        chunks.append(PAGE_SEPARATOR.join(current))
+    return chunks
+
+
+def header_text(pages: list[str]) -> str:
+    """Text of the first and last pages, where the header fields (dates, totals, taxes, payment) are"""
+    return PAGE_SEPARATOR.join(pages[:1] + pages[-1:] if len(pages) > 1 else pages)
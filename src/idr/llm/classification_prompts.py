@@ -70,4 +70,4 @@ Output rules:
 JSON with extracted info:
 """
 
-CLASS_MAX_LENGTH = 30000
+CLASS_MAX_TOKENS = 8000
@@ -46,6 +46,7 @@ JSON with extracted info:
 # RECIBO: "RE"
 # NOTA DE CRÉDITO: "NC"
 # Info present in QR code: "QR"
+EXT_DOC_TYPES = ("FR", "FS", "FT", "ND", "NC", "RE")
 
 EXT_MANDATORY_FIELDS = {
     ' - "document_issue_date" (Document issue date in the format DD/MM/YYYY)': {
@@ -226,7 +227,7 @@ EXT_OPTIONAL_FIELDS = {
     },
 }
 
-EXT_MAX_LENGTH = 30000
+EXT_MAX_TOKENS = 8000
 
 ALL_FIELDS = [
     "document_issue_date",
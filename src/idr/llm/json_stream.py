@@ -0,0 +1,80 @@
+"""Incremental parsing of a streamed json completion"""
+
+import json
+from typing import Any
+
+from loguru import logger
+
+
+class JsonStreamParser:
+    """Parser of a json object received in chunks, giving each top-level member as soon as it is complete
+
+    Each chunk is scanned once, only the text of the member being received is kept apart, so parsing the whole
+    completion is linear in its length. Text around the object (e.g. a markdown code fence) is ignored.
+    """
+
+    def __init__(self):
+        self._chunks: list[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._in_member = False  # in a member of the top-level object
+        self._member: list[str] = []  # text of the current member in the previous chunks
+        self.members: dict[str, Any] = {}
+
+    @property
+    def text(self) -> str:
+        """Text received so far"""
+        return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> dict[str, Any]:
+        """Add a chunk of the completion
+
+        Args:
+            chunk: next text of the completion
+
+        Returns:
+            members of the top-level object completed by this chunk
+        """
+        self._chunks.append(chunk)
+        completed: dict[str, Any] = {}
+        member_start = 0  # start of the current member in this chunk
+        for position, char in enumerate(chunk):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1 and char == "{" and not self.members and not self._in_member:
+                    self._in_member = True
+                    self._member, member_start = [], position + 1
+            elif char in "}]":
+                if self._depth == 1 and self._in_member:
+                    self._add_member(chunk[member_start:position], completed)
+                    self._in_member = False  # the object is closed
+                self._depth = max(self._depth - 1, 0)
+            elif char == "," and self._depth == 1 and self._in_member:
+                self._add_member(chunk[member_start:position], completed)
+                member_start = position + 1
+        if self._in_member:
+            self._member.append(chunk[member_start:])
+        return completed
+
+    def _add_member(self, end: str, completed: dict[str, Any]) -> None:
+        member = "".join(self._member) + end
+        self._member = []
+        if not member.strip():
+            return
+        try:
+            parsed = json.loads("{" + member + "}")
+        except ValueError as e:
+            logger.warning(f"Invalid member in the streamed completion: {member[:100]!r} ({e})")
+            return
+        self.members.update(parsed)
+        completed.update(parsed)
@@ -1,37 +1,261 @@
 """OpenAI Generic LLM caller interface"""
 
+import json
 import time
+from collections.abc import AsyncIterator
+from contextvars import ContextVar
+from dataclasses import dataclass
 
 from loguru import logger
 from openai import AsyncAzureOpenAI
+from openai.types import CompletionUsage
 from openai.types.chat import ChatCompletionMessageParam
 
+from idr.cache import Cache, CacheStats, make_cache_key
+from idr.llm.rate_limiter import RETRYABLE_ERRORS, RateLimiter, wait_before_retry
+from idr.llm.tokens import count_prompt_tokens, count_tokens
+from idr.metrics import observe_stage, record_tokens
+
+# sampling parameters are fixed so that the completions are (close to) deterministic and can be cached
+COMPLETION_PARAMETERS = {
+    "temperature": 0,
+    "top_p": 1,
+    "seed": 42,
+    "response_format": {"type": "json_object"},
+}
+# prompt tokens read from (hits) or not found in (misses) the Azure OpenAI prompt cache
+prompt_cache_stats = CacheStats()
+
+
+@dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+# usage of the calls made in the current context, when set (e.g. by a task to know what its calls cost)
+token_usage: ContextVar[TokenUsage | None] = ContextVar("token_usage", default=None)
+# whether the calls made in the current context read the cached completions (False to process a document again,
+# e.g. after a bad answer), set per request and passed as use_cache by the stages
+use_llm_cache: ContextVar[bool] = ContextVar("use_llm_cache", default=True)
+
+
+def record_usage(
+    usage: CompletionUsage,
+    process_name: str,
+    llm_model: str,
+    rate_limiter: RateLimiter | None = None,
+    estimated_tokens: int = 0,
+) -> None:
+    """Add the token usage of a call to the metrics, the context usage and the rate limiter"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+    prompt_cache_stats.hits += cached_tokens
+    prompt_cache_stats.misses += usage.prompt_tokens - cached_tokens
+    record_tokens(process_name, llm_model, usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+    context_usage = token_usage.get()
+    if context_usage is not None:
+        context_usage.prompt_tokens += usage.prompt_tokens
+        context_usage.completion_tokens += usage.completion_tokens
+    logger.info(
+        f"{process_name} tokens: prompt={usage.prompt_tokens} (cached={cached_tokens}), "
+        f"completion={usage.completion_tokens}"
+    )
+    if rate_limiter is not None:
+        rate_limiter.correct(estimated_tokens, usage.total_tokens)
+
+
+def is_cacheable(completion: str) -> bool:
+    """Whether a completion has a valid json object, a bad answer is not cached and replayed to the retries"""
+    from idr.document.utils import ResponseParseError, parse_json_object  # idr.document imports idr.llm
+
+    try:
+        parse_json_object(completion)
+    except ResponseParseError:
+        return False
+    return True
+
+
+def completion_cache_key(llm_model: str, prompt: list[ChatCompletionMessageParam]) -> str:
+    """Cache key of a completion: hash of the deployment, prompt messages and sampling parameters"""
+    return make_cache_key(
+        llm_model, json.dumps(prompt, sort_keys=True), json.dumps(COMPLETION_PARAMETERS, sort_keys=True)
+    )
+
 
 async def call_chat_completions(
-    llm_client: AsyncAzureOpenAI, llm_model: str, text: str, prompt: list[ChatCompletionMessageParam], process_name: str
+    llm_client: AsyncAzureOpenAI,
+    llm_model: str,
+    text: str,
+    prompt: list[ChatCompletionMessageParam],
+    process_name: str,
+    cache: Cache | None = None,
+    use_cache: bool = True,
+    rate_limiter: RateLimiter | None = None,
+    max_retries: int = 5,
+    completion_tokens: int = 1000,
 ) -> str | None:
-    try:
-        logger.info(f"{process_name} starting...")
-        class_start = time.time()
-        completion = await llm_client.chat.completions.create(
-            model=llm_model,
-            messages=prompt,
-            temperature=0,
-            top_p=1,
-            seed=42,
-            response_format={"type": "json_object"},
-        )
-        completion = completion.choices[0].message.content
-
-        logger.info(f"{process_name} collected in {time.time()-class_start}")
-    except Exception as e:
-        logger.info(
-            f"""Error while running {process_name} 
-            DOC_LEN: {len(text)} 
-            prompt : {prompt}
-            model_name: {llm_model}
-            \n{e}"""
-        )
-        completion = None
+    """Call the chat completions API with a json response
+
+    Args:
+        llm_client: async client for openAI ChatGPT
+        llm_model: deployment name of the model
+        text: document text (only used for logging)
+        prompt: list of prompt messages
+        process_name: name of the process for logging
+        cache: cache of previous completions
+        use_cache: if False the cache is bypassed for reading (the new completion is still stored)
+            only the completions with a valid json object are stored
+        rate_limiter: token bucket of the deployment, the call waits until it fits in the quota
+        max_retries: retries of rate limited (429), connection and server errors, with backoff
+        completion_tokens: expected completion tokens, reserved in the rate limiter with the prompt tokens
+
+    Returns:
+        completion content, None if the call failed
+    """
+    if cache is not None:
+        cache_key = completion_cache_key(llm_model, prompt)
+        if use_cache:
+            cached_completion = await cache.get(cache_key)
+            if cached_completion is not None:
+                logger.info(f"{process_name} completion found in the {cache.name} cache")
+                return cached_completion  # type: ignore
+
+    estimated_tokens = count_prompt_tokens(prompt) + completion_tokens if rate_limiter is not None else 0
+    completion = None
+    logger.info(f"{process_name} starting...")
+    class_start = time.time()
+    for attempt in range(max_retries + 1):
+        response = None
+        try:
+            if rate_limiter is not None:
+                waited = await rate_limiter.acquire(estimated_tokens)
+                observe_stage("rate_limit_wait", waited)
+                if waited > 1:
+                    logger.info(f"{process_name} waited {waited:.1f}s for the {llm_model} rate limit")
+            response = await llm_client.chat.completions.create(
+                model=llm_model,
+                messages=prompt,
+                **COMPLETION_PARAMETERS,  # type: ignore
+            )
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                record_usage(usage, process_name, llm_model, rate_limiter, estimated_tokens)
+            completion = response.choices[0].message.content
+
+            logger.info(f"{process_name} collected in {time.time()-class_start}")
+            break
+        except Exception as e:
+            if rate_limiter is not None and response is None:  # reserved again by the next attempt
+                rate_limiter.release(estimated_tokens)
+            if isinstance(e, RETRYABLE_ERRORS) and attempt < max_retries:
+                await wait_before_retry(e, attempt, rate_limiter, process_name)
+                continue
+            logger.info(
+                f"""Error while running {process_name} 
+                DOC_LEN: {len(text)} 
+                prompt : {prompt}
+                model_name: {llm_model}
+                \n{e}"""
+            )
+            break
+
+    if cache is not None and completion is not None and is_cacheable(completion):
+        await cache.set(cache_key, completion)
 
     return completion
+
+
+async def stream_chat_completions(
+    llm_client: AsyncAzureOpenAI,
+    llm_model: str,
+    text: str,
+    prompt: list[ChatCompletionMessageParam],
+    process_name: str,
+    cache: Cache | None = None,
+    use_cache: bool = True,
+    rate_limiter: RateLimiter | None = None,
+    max_retries: int = 5,
+    completion_tokens: int = 1000,
+) -> AsyncIterator[str]:
+    """Call the chat completions API with a json response, yielding the completion as it is generated
+
+    Same arguments and cache as call_chat_completions. A cached completion is yielded at once.
+    The call is only retried while nothing was yielded, an error after that ends the completion early.
+    The usage of the call is requested in the last chunk of the stream, the tokens are only counted locally
+    when the stream has none.
+
+    Yields:
+        chunks of the completion content
+    """
+    if cache is not None:
+        cache_key = completion_cache_key(llm_model, prompt)
+        if use_cache:
+            cached_completion = await cache.get(cache_key)
+            if cached_completion is not None:
+                logger.info(f"{process_name} completion found in the {cache.name} cache")
+                yield cached_completion  # type: ignore
+                return
+
+    prompt_tokens = count_prompt_tokens(prompt)
+    estimated_tokens = prompt_tokens + completion_tokens if rate_limiter is not None else 0
+    chunks: list[str] = []
+    logger.info(f"{process_name} streaming...")
+    start = time.time()
+    for attempt in range(max_retries + 1):
+        recorded = False
+        try:
+            if rate_limiter is not None:
+                waited = await rate_limiter.acquire(estimated_tokens)
+                observe_stage("rate_limit_wait", waited)
+            stream = await llm_client.chat.completions.create(
+                model=llm_model,
+                messages=prompt,
+                stream=True,
+                # the usage is sent in a last chunk without choices
+                stream_options={"include_usage": True},
+                **COMPLETION_PARAMETERS,  # type: ignore
+            )
+            usage = None
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                # the first chunk of Azure only has the content filter results of the prompt
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content:
+                    if not chunks:
+                        logger.info(f"{process_name} first tokens in {time.time()-start:.2f}s")
+                    chunks.append(content)
+                    yield content
+            if usage is None:  # not sent by older API versions
+                counted_tokens = count_tokens("".join(chunks))
+                usage = CompletionUsage(
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=counted_tokens,
+                    total_tokens=prompt_tokens + counted_tokens,
+                )
+            record_usage(usage, process_name, llm_model, rate_limiter, estimated_tokens)
+            recorded = True
+            logger.info(f"{process_name} collected in {time.time()-start}")
+            break
+        except Exception as e:
+            if rate_limiter is not None and not recorded:
+                # the tokens reserved by a failed attempt are given back, but those streamed before the error
+                used_tokens = prompt_tokens + count_tokens("".join(chunks)) if chunks else 0
+                rate_limiter.correct(estimated_tokens, used_tokens)
+            if isinstance(e, RETRYABLE_ERRORS) and attempt < max_retries and not chunks:
+                await wait_before_retry(e, attempt, rate_limiter, process_name)
+                continue
+            logger.info(
+                f"""Error while streaming {process_name}
+                DOC_LEN: {len(text)}
+                model_name: {llm_model}
+                \n{e}"""
+            )
+            return
+
+    if cache is not None and chunks and is_cacheable(completion := "".join(chunks)):
+        await cache.set(cache_key, completion)
@@ -3,6 +3,8 @@ from __future__ import annotations
 import os
 from dataclasses import dataclass
 
+from idr.llm.token_budget import TokenBudget
+
 
 @dataclass
 class AzureOpenAIConfig:
@@ -10,6 +12,12 @@ class AzureOpenAIConfig:
     key: str
     version: str
     deployment: str
+    # quota of the deployment, used to rate limit the calls on the client side (None for no limit)
+    tokens_per_minute: int | None = None
+    requests_per_minute: int | None = None
+    # context window of the model and tokens reserved for the completion
+    context_tokens: int = 128000
+    output_tokens: int = 16384
 
     @classmethod
     def from_env(cls, suffix: str = "") -> AzureOpenAIConfig:
@@ -17,8 +25,25 @@ class AzureOpenAIConfig:
         key = os.getenv("AZURE_OPENAI_API_KEY" + suffix)
         version = os.getenv("AZURE_OPENAI_VERSION" + suffix)
         deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT" + suffix)
+        tokens_per_minute = os.getenv("AZURE_OPENAI_TPM" + suffix)
+        requests_per_minute = os.getenv("AZURE_OPENAI_RPM" + suffix)
+        context_tokens = int(os.getenv("AZURE_OPENAI_CONTEXT_TOKENS" + suffix, "128000"))
+        output_tokens = int(os.getenv("AZURE_OPENAI_OUTPUT_TOKENS" + suffix, "16384"))
 
         if endpoint is None or key is None or version is None or deployment is None:
             raise ValueError("Invalid Credentials")
 
-        return cls(endpoint, key, version, deployment)
+        return cls(
+            endpoint,
+            key,
+            version,
+            deployment,
+            int(tokens_per_minute) if tokens_per_minute else None,
+            int(requests_per_minute) if requests_per_minute else None,
+            context_tokens,
+            output_tokens,
+        )
+
+    @property
+    def token_budget(self) -> TokenBudget:
+        return TokenBudget(self.context_tokens, self.output_tokens)
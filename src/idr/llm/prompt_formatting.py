@@ -1,3 +1,8 @@
+import re
+from collections.abc import Callable, Collection
+from dataclasses import dataclass
+from functools import cached_property
+
 from loguru import logger
 from openai.types.chat import (
     ChatCompletionMessageParam,
@@ -5,114 +10,227 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
+from idr.cache import CacheStats
 from idr.llm.classification_prompts import (
     CLASS_MAIN_PROMPT_TEMPLATE,
-    CLASS_MAX_LENGTH,
+    CLASS_MAX_TOKENS,
     CLASS_SIMPLE_PROMPT_TEMPLATE,
     CLASS_SYSTEM_PROMPT,
 )
 from idr.llm.extraction_prompts import (
+    EXT_DOC_TYPES,
     EXT_MAIN_PROMPT_TEMPLATE,
     EXT_MANDATORY_ARRAY_FIELDS,
     EXT_MANDATORY_FIELDS,
-    EXT_MAX_LENGTH,
+    EXT_MAX_TOKENS,
     EXT_OPTIONAL_FIELDS,
     EXT_SYSTEM_PROMPT,
 )
+from idr.llm.token_budget import TokenBudget, fit_text
+from idr.llm.tokens import count_prompt_tokens
+
+
+def fit_prompt(
+    make_prompt: Callable[[str], list[ChatCompletionMessageParam]],
+    text: str,
+    max_text_tokens: int,
+    budget: TokenBudget | None,
+    process_name: str,
+    prompt_tokens: int | None = None,
+) -> list[ChatCompletionMessageParam]:
+    """Build a prompt with the document text fitted to the token budget of the model
+
+    Args:
+        make_prompt: builds the prompt messages around a document text
+        text: document text
+        max_text_tokens: limit on the document text tokens
+        budget: context and output tokens of the model, defaults to TokenBudget()
+        process_name: name of the process for logging
+        prompt_tokens: tokens of the prompt without the document text, counted if not given
+
+    Returns:
+        list of prompt messages
+    """
+    budget = budget or TokenBudget()
+    if prompt_tokens is None:
+        prompt_tokens = count_prompt_tokens(make_prompt(""))
+    text, text_tokens = fit_text(text, budget.text_tokens(prompt_tokens, max_text_tokens))
+    logger.info(f"{process_name} prompt tokens: {prompt_tokens + text_tokens} (document text: {text_tokens})")
+    return make_prompt(text)
 
 
-def make_classification_prompt(text: str, has_qr: bool, qr_info: dict[str, str]) -> list[ChatCompletionMessageParam]:
+def make_classification_prompt(
+    text: str, has_qr: bool, qr_info: dict[str, str], budget: TokenBudget | None = None
+) -> list[ChatCompletionMessageParam]:
     """Format classification prompt
 
     Args:
         text: text to be classified
         has_qr: true if qr code was found
         qr_info: qr code info, empty dict if not found
+        budget: context and output tokens of the model
 
     Returns:
         list of messages  (system + user) to send as prompt
     """
-    if len(text) > CLASS_MAX_LENGTH:
-        text = text[:CLASS_MAX_LENGTH]
     if has_qr:
         sup_vat = qr_info["A"]
         aq_vat = qr_info["B"]
-        prompt = [
-            ChatCompletionSystemMessageParam(role="system", content=CLASS_SYSTEM_PROMPT),
-            ChatCompletionUserMessageParam(
-                role="user", content=CLASS_SIMPLE_PROMPT_TEMPLATE.format(sup_vat, aq_vat, text)
-            ),
-        ]
+
+        def make_prompt(text: str) -> list[ChatCompletionMessageParam]:
+            return [
+                ChatCompletionSystemMessageParam(role="system", content=CLASS_SYSTEM_PROMPT),
+                ChatCompletionUserMessageParam(
+                    role="user", content=CLASS_SIMPLE_PROMPT_TEMPLATE.format(sup_vat, aq_vat, text)
+                ),
+            ]
+
         logger.info("Classification with a simple prompt")
 
     else:
-        prompt = [
-            ChatCompletionSystemMessageParam(role="system", content=CLASS_SYSTEM_PROMPT),
-            ChatCompletionUserMessageParam(role="user", content=CLASS_MAIN_PROMPT_TEMPLATE.format(text)),
-        ]
+
+        def make_prompt(text: str) -> list[ChatCompletionMessageParam]:
+            return [
+                ChatCompletionSystemMessageParam(role="system", content=CLASS_SYSTEM_PROMPT),
+                ChatCompletionUserMessageParam(role="user", content=CLASS_MAIN_PROMPT_TEMPLATE.format(text)),
+            ]
+
         logger.info("Classification with a regular prompt")
-    return prompt
+    return fit_prompt(make_prompt, text, CLASS_MAX_TOKENS, budget, "Classification")
 
 
-def make_extraction_prompt(
-    text: str,
-    doc_type: str,
-    has_qr: bool,
-) -> list[ChatCompletionMessageParam]:
-    """Create a prompt for the ChatGPT model
+def include_field_in_prompt(doc_type: str, has_qr: bool, v: set[str]) -> bool:
+    """Check if field is to be extracted
 
     Args:
-        mandatory_fields: mandatory fields for the model
-        mandatory_array_fields: mandatory array fields for the model
-        optional_fields: optional fields for the model
-        text: text to be extracted
+        doc_type: document type from SAF-T PT
+        has_qr: whether the document has a QR code
+        v: set of valid document types that the field prompt is valid
 
     Returns:
-        list of prompt messages for the ChatGPT model
+        bool: whether the field prompt should be included
     """
+    if has_qr:
+        return (doc_type in v) and ("QR" not in v)
+    else:
+        return doc_type in v
 
-    "Create a prompt for just the valid fields for the file_type of the document"
 
-    mandatory_fields = "\n".join(
-        [k for k, v in EXT_MANDATORY_FIELDS.items() if include_field_in_prompt(doc_type, has_qr, v)]
-    )
-    mandatory_array_fields = "\n".join(
-        [k for k, v in EXT_MANDATORY_ARRAY_FIELDS.items() if include_field_in_prompt(doc_type, has_qr, v)]
-    )
-    optional_fields = "\n".join(
-        [k for k, v in EXT_OPTIONAL_FIELDS.items() if include_field_in_prompt(doc_type, has_qr, v)]
+def prompt_field_name(field_prompt: str) -> str:
+    """Name of the field of a line of the extraction prompt, e.g. ' - "currency" (...)' -> "currency" """
+    return re.search(r'"(\w+)"', field_prompt).group(1)
+
+
+def prompt_fields(doc_type: str, has_qr: bool) -> dict[str, str]:
+    """Fields asked in the extraction prompt of a document type
+
+    Returns:
+        kind of each field by name: "mandatory", "array" (mandatory array-like) or "optional"
+    """
+    return {
+        prompt_field_name(k): kind
+        for kind, field_prompts in (
+            ("mandatory", EXT_MANDATORY_FIELDS),
+            ("array", EXT_MANDATORY_ARRAY_FIELDS),
+            ("optional", EXT_OPTIONAL_FIELDS),
+        )
+        for k, v in field_prompts.items()
+        if include_field_in_prompt(doc_type, has_qr, v)
+    }
+
+
+# marks the position of the document text in the formatted extraction template
+TEXT_PLACEHOLDER = "\x00document_content\x00"
+
+
+@dataclass
+class ExtractionPrompt:
+    """Extraction prompt of a document type, formatted around the position of the document text
+
+    Everything before the document text is identical for all the documents of the same type,
+    so that it is reused by the Azure OpenAI prompt caching.
+    """
+
+    system: str
+    user_prefix: str
+    user_suffix: str
+
+    def messages(self, text: str) -> list[ChatCompletionMessageParam]:
+        return [
+            ChatCompletionSystemMessageParam(role="system", content=self.system),
+            ChatCompletionUserMessageParam(role="user", content=self.user_prefix + text + self.user_suffix),
+        ]
+
+    @cached_property
+    def tokens(self) -> int:
+        """Tokens of the prompt without the document text"""
+        return count_prompt_tokens(self.messages(""))
+
+
+def build_extraction_prompt(doc_type: str, has_qr: bool, fields: Collection[str] | None = None) -> ExtractionPrompt:
+    """Format the extraction prompt with the fields valid for a document type
+
+    Args:
+        doc_type: document type from SAF-T PT
+        has_qr: whether the document has a QR code (the fields in the QR code are not asked)
+        fields: only ask these fields (e.g. the fields missing from a previous extraction), all if None
+
+    Returns:
+        ExtractionPrompt of the document type
+    """
+
+    def include(k: str, v: set[str]) -> bool:
+        return include_field_in_prompt(doc_type, has_qr, v) and (fields is None or prompt_field_name(k) in fields)
+
+    mandatory_fields = "\n".join([k for k, v in EXT_MANDATORY_FIELDS.items() if include(k, v)])
+    mandatory_array_fields = "\n".join([k for k, v in EXT_MANDATORY_ARRAY_FIELDS.items() if include(k, v)])
+    optional_fields = "\n".join([k for k, v in EXT_OPTIONAL_FIELDS.items() if include(k, v)])
+    content = EXT_MAIN_PROMPT_TEMPLATE.format(
+        mandatory_fields, mandatory_array_fields, optional_fields, TEXT_PLACEHOLDER
     )
+    user_prefix, user_suffix = content.split(TEXT_PLACEHOLDER)
+    return ExtractionPrompt(EXT_SYSTEM_PROMPT, user_prefix, user_suffix)
 
-    if len(text) > EXT_MAX_LENGTH:  # limiting text length empirically to avoid getting to max prompts
-        text = text[:EXT_MAX_LENGTH]
 
-    prompt = [
-        ChatCompletionSystemMessageParam(role="system", content=EXT_SYSTEM_PROMPT),
-        ChatCompletionUserMessageParam(
-            role="user",
-            content=EXT_MAIN_PROMPT_TEMPLATE.format(
-                mandatory_fields,
-                mandatory_array_fields,
-                optional_fields,
-                text,
-            ),
-        ),
-    ]
-    return prompt
+EXTRACTION_PROMPTS = {
+    (doc_type, has_qr): build_extraction_prompt(doc_type, has_qr)
+    for doc_type in EXT_DOC_TYPES
+    for has_qr in (False, True)
+}
+extraction_prompt_stats = CacheStats()
 
 
-def include_field_in_prompt(doc_type: str, has_qr: bool, v: set[str]) -> bool:
-    """Check if field is to be extracted
+def get_extraction_prompt(doc_type: str, has_qr: bool) -> ExtractionPrompt:
+    """Precomputed extraction prompt of a document type, built on the fly for unknown types"""
+    extraction_prompt = EXTRACTION_PROMPTS.get((doc_type, has_qr))
+    if extraction_prompt is None:
+        extraction_prompt_stats.misses += 1
+        return build_extraction_prompt(doc_type, has_qr)
+    extraction_prompt_stats.hits += 1
+    return extraction_prompt
+
+
+def make_extraction_prompt(
+    text: str,
+    doc_type: str,
+    has_qr: bool,
+    budget: TokenBudget | None = None,
+    fields: Collection[str] | None = None,
+) -> list[ChatCompletionMessageParam]:
+    """Create a prompt for the ChatGPT model, with just the valid fields for the type of the document
 
     Args:
+        text: text to be extracted
         doc_type: document type from SAF-T PT
         has_qr: whether the document has a QR code
-        v: set of valid document types that the field prompt is valid
+        budget: context and output tokens of the model
+        fields: only ask these fields (reduced prompt of an incremental extraction), all valid fields if None
 
     Returns:
-        bool: whether the field prompt should be included
+        list of prompt messages for the ChatGPT model
     """
-    if has_qr:
-        return (doc_type in v) and ("QR" not in v)
+    if fields is None:
+        extraction_prompt = get_extraction_prompt(doc_type, has_qr)
     else:
-        return doc_type in v
+        extraction_prompt = build_extraction_prompt(doc_type, has_qr, fields)
+    return fit_prompt(extraction_prompt.messages, text, EXT_MAX_TOKENS, budget, "Extraction", extraction_prompt.tokens)
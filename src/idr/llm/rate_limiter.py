@@ -0,0 +1,127 @@
+"""Client side rate limiting of the calls to an Azure OpenAI deployment"""
+
+import asyncio
+import random
+import time
+
+import openai
+from loguru import logger
+
+
+class RateLimiter:
+    """Token bucket for the tokens per minute (TPM) and requests per minute (RPM) quota of a deployment
+
+    Calls wait in order (first in, first out) until the estimated tokens of their prompt fit in the quota,
+    so that bursts are queued instead of being rejected with 429 errors.
+    """
+
+    def __init__(self, tokens_per_minute: int | None = None, requests_per_minute: int | None = None):
+        """
+        Args:
+            tokens_per_minute: TPM quota of the deployment, None for no limit
+            requests_per_minute: RPM quota of the deployment, None for no limit
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._tokens = float(tokens_per_minute or 0)
+        self._requests = float(requests_per_minute or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock: asyncio.Lock | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or loop is not self._loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = self._paused_until - time.monotonic()
+        if self.tokens_per_minute and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int) -> float:
+        """Wait until the call fits in the quota and reserve it
+
+        Args:
+            tokens: estimated tokens of the call (prompt and completion)
+
+        Returns:
+            time waited in seconds
+        """
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)  # a bigger call would never fit
+        start = time.monotonic()
+        async with self._get_lock():
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._tokens -= tokens
+            self._requests -= 1
+        return time.monotonic() - start
+
+    def correct(self, estimated_tokens: int, used_tokens: int) -> None:
+        """Correct the reserved tokens with the real usage reported in the response"""
+        if self.tokens_per_minute:
+            self._tokens -= used_tokens - estimated_tokens
+
+    def release(self, tokens: int) -> None:
+        """Give back the tokens reserved for a call that failed without using them (e.g. rejected with a 429)"""
+        self.correct(tokens, 0)
+
+    def pause(self, seconds: float) -> None:
+        """Stop all calls for some time (when the service answers with a Retry-After)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def retry_after(error: openai.APIStatusError) -> float | None:
+    """Time to wait before retrying, from the Retry-After headers of the error response"""
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, maximum: float = 60.0) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+async def wait_before_retry(error: Exception, attempt: int, rate_limiter: RateLimiter | None, process_name: str):
+    """Wait before retrying a failed call, honoring the Retry-After of 429 responses"""
+    delay = None
+    if isinstance(error, openai.RateLimitError):
+        delay = retry_after(error)
+        if delay is not None and rate_limiter is not None:
+            rate_limiter.pause(delay)
+    if delay is None:
+        delay = backoff_delay(attempt)
+    logger.warning(
+        f"{process_name} failed with {type(error).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1})"
+    )
+    await asyncio.sleep(delay)
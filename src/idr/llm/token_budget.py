@@ -0,0 +1,117 @@
+"""Fitting the document text of a prompt to the token budget of a model"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+from idr.llm.tokens import CHARS_PER_TOKEN, DEFAULT_ENCODING, count_tokens, get_encoding
+
+PAGE_SEPARATOR = "\f"
+# page numbers added by Document Intelligence to the markdown, never useful for the prompts
+PAGE_NUMBER_PATTERN = re.compile(r"^<!-- PageNumber=.*-->$")
+# lines of the markdown tables, or of the html tables of Document Intelligence
+TABLE_LINE_PATTERN = re.compile(r"^(\||</?(table|thead|tbody|tr|th|td)\b)")
+# upper bound of characters per token, to avoid encoding much more text than the budget
+MAX_CHARS_PER_TOKEN = 10
+
+
+@dataclass
+class TokenBudget:
+    """Context window and tokens reserved for the completion of a model deployment"""
+
+    context_tokens: int = 128000
+    output_tokens: int = 16384
+
+    def text_tokens(self, prompt_tokens: int, max_text_tokens: int | None = None) -> int:
+        """Tokens left for the document text
+
+        Args:
+            prompt_tokens: tokens of the prompt without the document text
+            max_text_tokens: limit on the document text tokens, independent of the model
+
+        Returns:
+            number of tokens available for the document text
+        """
+        available = max(self.context_tokens - self.output_tokens - prompt_tokens, 0)
+        if max_text_tokens is not None:
+            available = min(available, max_text_tokens)
+        return available
+
+
+def normalize_line(line: str) -> str:
+    return " ".join(line.split()).lower()
+
+
+def remove_repeated_lines(text: str, min_pages: int = 2, min_page_ratio: float = 0.5) -> str:
+    """Remove the content repeated on every page (headers, footers and legal boilerplate)
+
+    A line is repeated when it appears on at least `min_pages` pages and on at least `min_page_ratio`
+    of the pages. It is kept on the first page where it appears. Table rows are never removed, since
+    identical item lines on several pages are real items.
+
+    Args:
+        text: document text with the pages separated by form feeds
+        min_pages: minimum number of pages with the line
+        min_page_ratio: minimum ratio of pages with the line
+
+    Returns:
+        text without the repeated lines and page numbers
+    """
+    pages = [page.split("\n") for page in text.split(PAGE_SEPARATOR)]
+    page_counts = Counter()
+    for lines in pages:
+        page_counts.update({normalize_line(line) for line in lines})
+    min_count = max(min_pages, min_page_ratio * len(pages))
+
+    seen = set()
+    reduced_pages = []
+    for lines in pages:
+        kept = []
+        for line in lines:
+            stripped = line.strip()
+            if PAGE_NUMBER_PATTERN.match(stripped):
+                continue
+            normalized = normalize_line(line)
+            if normalized and not TABLE_LINE_PATTERN.match(stripped) and page_counts[normalized] >= min_count:
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+            kept.append(line)
+        reduced_pages.append("\n".join(kept))
+    return PAGE_SEPARATOR.join(reduced_pages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> str:
+    """Keep the beginning of a text that fits in a number of tokens"""
+    text = text[: max_tokens * MAX_CHARS_PER_TOKEN]
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return text[: max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def fit_text(text: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> tuple[str, int]:
+    """Reduce a document text to a token budget (CLASS_MAX_TOKENS / EXT_MAX_TOKENS and the model context)
+
+    A text within the budget is kept whole: the repeated headers and footers carry the NIF or the ATCUD,
+    so they are only dropped when the text is over the budget, before truncating it.
+
+    Args:
+        text: document text with the pages separated by form feeds
+        max_tokens: tokens available for the text
+        encoding_name: tiktoken encoding of the model
+
+    Returns:
+        the fitted text and its number of tokens
+    """
+    for reduced in (text, remove_repeated_lines(text)):
+        # a text with more characters than this is over the budget, whatever its tokens
+        if len(reduced) <= max_tokens * MAX_CHARS_PER_TOKEN:
+            tokens = count_tokens(reduced, encoding_name)
+            if tokens <= max_tokens:
+                return reduced, tokens
+    text = truncate_to_tokens(reduced, max_tokens, encoding_name)
+    return text, count_tokens(text, encoding_name)
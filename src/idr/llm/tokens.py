@@ -0,0 +1,47 @@
+"""Token counting for the prompts sent to the Azure OpenAI deployments"""
+
+from functools import cache
+
+import tiktoken
+from loguru import logger
+from openai.types.chat import ChatCompletionMessageParam
+
+# encoding of the gpt-4o model family
+DEFAULT_ENCODING = "o200k_base"
+# rough estimate used when the encoding can not be loaded (tiktoken downloads it on first use)
+CHARS_PER_TOKEN = 4
+# tokens added by the chat format to each message and to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 3
+
+
+@cache
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding | None:
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"Error while loading the {encoding_name} token encoding, estimating from the text length: {e}")
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """Number of tokens of a text
+
+    Args:
+        text: text to count
+        encoding_name: tiktoken encoding of the model
+
+    Returns:
+        number of tokens (estimated from the length if the encoding is not available)
+    """
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_prompt_tokens(prompt: list[ChatCompletionMessageParam], encoding_name: str = DEFAULT_ENCODING) -> int:
+    """Number of tokens of a list of prompt messages, including the chat format overhead"""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for message in prompt:
+        tokens += count_tokens(str(message.get("content") or ""), encoding_name) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
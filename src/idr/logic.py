@@ -1,39 +1,174 @@
+import asyncio
+import re
+from collections import Counter, deque
+from collections.abc import AsyncIterator
+from pathlib import PurePosixPath
+
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from loguru import logger
 from openai import AsyncAzureOpenAI
 
+from idr.cache import CacheStats, make_cache
+from idr.concurrency import StageLimits
 from idr.config import (
-    BLOB_CONTAINER_MAPPING,
+    CACHE_DIR,
+    CHUNKED_EXTRACTION,
+    CLASSIFICATION_CONCURRENCY,
+    EXT_CHUNK_TOKENS,
+    EXT_MAX_CHUNKS,
+    EXTRACTION_CONCURRENCY,
     FORM_ENDPOINT,
     FORM_KEY,
+    INCREMENTAL_EXTRACTION,
+    LLM_CACHE,
+    LLM_CACHE_CONTAINER,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL,
+    LLM_MAX_RETRIES,
+    LOCAL_QR_DECODING,
+    OCR_CACHE,
+    OCR_CACHE_CONTAINER,
+    OCR_CACHE_MAX_ENTRIES,
+    OCR_CACHE_TTL,
+    OCR_CONCURRENCY,
+    OCR_MAX_GARBLED_RATIO,
+    OCR_MIN_TEXT_LENGTH,
+    OCR_PAGE_SELECTION,
+    OCR_POLICY,
+    PDF_PAGES_PER_WORKER,
+    QR_MAX_PAGES,
+    SPECULATIVE_EXTRACTION,
     openai_config_classifier,
     openai_config_extractor,
 )
 from idr.document import (
     Document,
     async_classify,
+    async_classify_stream,
     async_extract,
+    async_read_filetype,
     async_read_ocr,
+    async_read_qr_code,
+)
+from idr.document.incremental import (
+    EXTRACTION_SOURCE_FIELD,
+    extraction_source,
+    fields_to_extract,
+    has_extraction,
+    previous_extraction,
 )
+from idr.document.invoice_items import INVOICE_ITEMS_FIELDS, merge_invoice_items
+from idr.document.pdf_reader import is_text_layer_usable, mentions_atcud
+from idr.document.processing import select_ocr_pages
+from idr.llm.chunking import chunk_pages, header_text
+from idr.llm.classification_prompts import CLASS_MAX_TOKENS
+from idr.llm.extraction_prompts import EXT_DOC_TYPES, EXT_MAX_TOKENS
+from idr.llm.llm_caller import TokenUsage, prompt_cache_stats, token_usage, use_llm_cache
+from idr.llm.prompt_formatting import extraction_prompt_stats, prompt_fields
+from idr.llm.rate_limiter import RateLimiter
+from idr.llm.tokens import count_tokens
+from idr.metrics import register_cache_stats, span, timed, wasted_tokens
+from idr.single_flight import single_flight
 from idr.storage.blobs import (
-    write_blob,
+    save_document,
 )
 
 doc_intelligence_client = DocumentIntelligenceClient(
     endpoint=FORM_ENDPOINT,  # type: ignore
     credential=AzureKeyCredential(FORM_KEY),  # type: ignore
 )
+ocr_cache = make_cache(
+    OCR_CACHE,
+    "ocr-cache",
+    ttl=OCR_CACHE_TTL,
+    max_entries=OCR_CACHE_MAX_ENTRIES,
+    directory=CACHE_DIR,
+    env_container=OCR_CACHE_CONTAINER,
+)
+llm_cache = make_cache(
+    LLM_CACHE,
+    "llm-cache",
+    ttl=LLM_CACHE_TTL,
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    directory=CACHE_DIR,
+    env_container=LLM_CACHE_CONTAINER,
+)
+stage_limits = StageLimits(
+    {
+        "ocr": OCR_CONCURRENCY,
+        "classification": CLASSIFICATION_CONCURRENCY,
+        "extraction": EXTRACTION_CONCURRENCY,
+    }
+)
 llm_client_class = AsyncAzureOpenAI(
     azure_endpoint=openai_config_classifier.endpoint,
     api_key=openai_config_classifier.key,
     api_version=openai_config_classifier.version,
+    max_retries=0,  # retried in call_chat_completions, with the rate limiter
 )
 llm_client_ext = AsyncAzureOpenAI(
     azure_endpoint=openai_config_extractor.endpoint,
     api_key=openai_config_extractor.key,
     api_version=openai_config_extractor.version,
+    max_retries=0,
 )
+rate_limiter_class = RateLimiter(
+    openai_config_classifier.tokens_per_minute, openai_config_classifier.requests_per_minute
+)
+# both configs may point to the same deployment, which then shares its quota
+if (openai_config_extractor.endpoint, openai_config_extractor.deployment) == (
+    openai_config_classifier.endpoint,
+    openai_config_classifier.deployment,
+):
+    rate_limiter_ext = rate_limiter_class
+else:
+    rate_limiter_ext = RateLimiter(
+        openai_config_extractor.tokens_per_minute, openai_config_extractor.requests_per_minute
+    )
+if ocr_cache is not None:
+    register_cache_stats("ocr", ocr_cache.stats)
+if llm_cache is not None:
+    register_cache_stats("llm", llm_cache.stats)
+register_cache_stats("extraction_prompt_index", extraction_prompt_stats)
+# counted in prompt tokens
+register_cache_stats("openai_prompt_tokens", prompt_cache_stats)
+
+# SAF-T PT document type code in a file name, e.g. "SUPPLIER - FT 1FA.2024L_1409.pdf"
+DOC_TYPE_FILENAME_PATTERN = re.compile(rf"(?<![A-Z])({'|'.join(EXT_DOC_TYPES)})(?![A-Z])")
+# document types of the recent classifications, the most common is a guess of the speculative extraction
+recent_doc_types: deque[str] = deque(maxlen=100)
+# fields of the classification given by the streaming stages as soon as they are generated (gateway decisions)
+EARLY_CLASSIFICATION_FIELDS = ("document_type", "supplier_vat", "valid_document")
+# speculative extractions kept (hits) or discarded (misses)
+speculation_stats = CacheStats()
+register_cache_stats("speculative_extraction", speculation_stats)
+
+
+def ocr_required(document: Document) -> bool:
+    """Decide if the document must be read with Document Intelligence (following OCR_POLICY)
+
+    With the "auto" policy the PDF text layer is used when it is long and readable enough,
+    and a SAF-T PT QR code is not expected or already known.
+
+    Args:
+        document: Document with the text read from the file
+
+    Returns:
+        whether the OCR is needed
+    """
+    if OCR_POLICY == "always":
+        return True
+    if OCR_POLICY != "auto":
+        raise ValueError(f"Invalid OCR policy: {OCR_POLICY}. \n Valid policies: always, auto")
+
+    if not is_text_layer_usable(document.text, OCR_MIN_TEXT_LENGTH, OCR_MAX_GARBLED_RATIO):
+        logger.info("PDF text layer is too short or unreadable")
+        return True
+    if mentions_atcud(document.text) and not document.has_qr():
+        logger.info("PDF text layer mentions an ATCUD but the QR code was not read")
+        return True
+    return False
 
 
 async def read_document(document: Document) -> str:
@@ -45,7 +180,7 @@ async def read_document(document: Document) -> str:
     Returns:
         str: Y or N depending on whether the document was scanned (does not have text in PDF)
     """
-    document.read_filetype()
+    await async_read_filetype(document, pages_per_worker=PDF_PAGES_PER_WORKER)
 
     text_length = len("".join(document.text))
     if text_length < 100:
@@ -53,14 +188,36 @@ async def read_document(document: Document) -> str:
     else:
         is_scanned = "N"
 
+    qr_page = None
+    # when every page is read by the OCR, the OCR reads the QR code and the local decoding would only add latency
+    ocr_reads_all_pages = OCR_POLICY == "always" and not OCR_PAGE_SELECTION
+    if LOCAL_QR_DECODING and not ocr_reads_all_pages and not document.has_qr():
+        try:
+            qr_data, qr_page = await async_read_qr_code(document, max_pages=QR_MAX_PAGES)
+            if qr_data:
+                document.set_qr_code_data(qr_data)
+        except Exception as e:
+            logger.warning(f"Error while decoding the QR code locally, relying on OCR: {e}")
+
+    if not ocr_required(document):
+        logger.info(f"Scanned Document (Y/N): {is_scanned}. Using the PDF text layer, OCR skipped")
+        return is_scanned
+
     logger.info(f"Scanned Document (Y/N): {is_scanned}. Enriching with OCR...")
 
+    ocr_pages = None
+    if OCR_PAGE_SELECTION:
+        ocr_pages = select_ocr_pages(document, max(CLASS_MAX_TOKENS, EXT_MAX_TOKENS), qr_page)
+
     try:
-        ocr_text, qr_data = await async_read_ocr(
-            document,
-            client=doc_intelligence_client,
-        )
-        document.text = [ocr_text]
+        async with stage_limits("ocr"):
+            page_texts, qr_data = await async_read_ocr(
+                document,
+                client=doc_intelligence_client,
+                cache=ocr_cache,
+                pages=ocr_pages,
+            )
+        document.set_ocr_text(page_texts, page_count=len(document.text))
         if qr_data:
             document.set_qr_code_data(qr_data)
     except Exception as e:
@@ -94,15 +251,28 @@ async def classify_document(document: Document) -> dict:
     """
 
     try:
-        class_completion = await async_classify(
-            document,
-            llm_client=llm_client_class,
-            llm_model=openai_config_classifier.deployment,
-        )
+        async with stage_limits("classification"):
+            class_completion = await async_classify(
+                document,
+                llm_client=llm_client_class,
+                llm_model=openai_config_classifier.deployment,
+                cache=llm_cache,
+                use_cache=use_llm_cache.get(),
+                rate_limiter=rate_limiter_class,
+                max_retries=LLM_MAX_RETRIES,
+                budget=openai_config_classifier.token_budget,
+            )
     except Exception as e:
         raise e
 
-    document.parse_classification_fields(class_completion)
+    return classification_output(document, class_completion)
+
+
+def classification_output(document: Document, class_completion: dict) -> dict:
+    """Apply the classification completion to the document, with the output of classify_document"""
+    with span("classification_postprocessing"):
+        document.parse_classification_fields(class_completion)
+    recent_doc_types.append(document.doc_type)
 
     return {
         "original_copy": class_completion["original_copy"],
@@ -122,6 +292,122 @@ async def classify_document(document: Document) -> dict:
     }
 
 
+def early_classification_fields(document: Document, fields: dict) -> dict:
+    """Fields of the output of classify_document that can be given before the end of the classification
+
+    Args:
+        document: Document being classified
+        fields: fields of the classification completion generated so far (or {} for those of the QR code)
+
+    Returns:
+        the EARLY_CLASSIFICATION_FIELDS known from the QR code or from the given fields
+    """
+    early = {}
+    if document.has_qr():
+        # the QR code has precedence over the classification (see Document.parse_classification_fields)
+        fields = {**fields, "document_type": document.qr_info["D"], "supplier_vat": "PT" + document.qr_info["A"]}
+    for field in EARLY_CLASSIFICATION_FIELDS:
+        if field in fields:
+            early[field] = fields[field] == "Y" if field == "valid_document" else fields[field]
+    return early
+
+
+async def stream_classify_document(document: Document) -> AsyncIterator[tuple[str, dict]]:
+    """Classify a document like classify_document, giving the EARLY_CLASSIFICATION_FIELDS as soon as they are known
+
+    Yields:
+        ("fields", early fields) as they are known (from the QR code first), then ("classification", output of
+        classify_document)
+    """
+    sent = early_classification_fields(document, {})
+    if sent:
+        yield "fields", sent
+    async with stage_limits("classification"):
+        async for event, fields in async_classify_stream(
+            document,
+            llm_client=llm_client_class,
+            llm_model=openai_config_classifier.deployment,
+            cache=llm_cache,
+            use_cache=use_llm_cache.get(),
+            rate_limiter=rate_limiter_class,
+            max_retries=LLM_MAX_RETRIES,
+            budget=openai_config_classifier.token_budget,
+        ):
+            if event == "completion":
+                class_completion = fields
+                break
+            early = {
+                field: value
+                for field, value in early_classification_fields(document, fields).items()
+                if field not in sent
+            }
+            if early:
+                sent.update(early)
+                yield "fields", early
+    yield "classification", classification_output(document, class_completion)
+
+
+async def stream_read_and_classify_document(document: Document) -> AsyncIterator[tuple[str, dict]]:
+    """Read and classify a document like read_and_classify_document, giving the early classification fields first
+
+    Yields:
+        ("fields", early fields) as they are known, then ("result", output of read_and_classify_document)
+    """
+    is_scanned = await read_document(document)
+    async for event, data in stream_classify_document(document):
+        if event == "classification":
+            class_completion = data
+        else:
+            yield event, data
+    await save_document(document, parts=("text", "qr_info", "fields", "comments"))
+
+    result = {
+        "file_path": document.doc_id,
+        "text": document.text,
+        "scanned_copy": is_scanned,
+        **class_completion,
+    }
+    yield "result", result
+
+
+async def stream_read_classify_and_extract_document(document: Document) -> AsyncIterator[tuple[str, dict]]:
+    """Read, classify and extract a document like read_classify_and_extract_document, giving the early
+    classification fields first (the classification is not speculative)
+
+    Yields:
+        ("fields", early fields) as they are known, ("classification", output of classify_document) when the
+        classification ends, then ("result", output of read_classify_and_extract_document)
+    """
+    is_scanned = await read_document(document)
+    # when the QR code gives the document type the extraction runs during the classification
+    extraction = asyncio.create_task(run_extraction(document)) if document.has_qr() else None
+    try:
+        async for event, data in stream_classify_document(document):
+            if event == "classification":
+                class_completion = data
+            yield event, data
+        ext_completion, _ = await (extraction or run_extraction(document))
+    finally:
+        if extraction is not None and not extraction.done():
+            extraction.cancel()
+
+    apply_extraction(document, ext_completion)
+    await save_document(document, parts=("text", "qr_info", "fields", "comments"))
+
+    result = {
+        "file_path": document.doc_id,
+        "text": document.text,
+        "scanned_copy": is_scanned,
+        **class_completion,
+        "extracted_fields": ext_completion,
+        "missing_mandatory_fields": ext_completion.get("missing_mandatory_fields", []),
+        "missing_optional_fields": ext_completion.get("missing_optional_fields", []),
+    }
+    yield "result", result
+
+
+@timed("read_and_classify")
+@single_flight("read_and_classify")
 async def read_and_classify_document(document: Document) -> dict:
     """Read and classify document
 
@@ -135,25 +421,19 @@ async def read_and_classify_document(document: Document) -> dict:
     except Exception as e:
         logger.error(f"Error while scanning text from document {document.doc_id}")
         raise e
-    try:
-        await write_blob(file_path, document.text, BLOB_CONTAINER_MAPPING["text"])
-        await write_blob(file_path, document.qr_info, BLOB_CONTAINER_MAPPING["qr_info"])
-        if document.has_qr():
-            await write_blob(file_path, document.qr_info, BLOB_CONTAINER_MAPPING["qr_info"])
-    except Exception as e:
-        logger.error(f"Error while writing scan text from document {file_path}")
-        raise e
 
+    # the read results are saved during the classification, so that a failed classification keeps the OCR text
+    read_saved = asyncio.create_task(save_document(document, parts=("text", "qr_info")))
     try:
         class_completion = await classify_document(document)
     except Exception as e:
         logger.error("Error while classifying")
+        await asyncio.gather(read_saved, return_exceptions=True)
         raise e
     try:
-        await write_blob(file_path, document.fields, BLOB_CONTAINER_MAPPING["fields"])
-        await write_blob(file_path, document.comments, BLOB_CONTAINER_MAPPING["comments"])
+        await asyncio.gather(read_saved, save_document(document, parts=("fields", "comments")))
     except Exception as e:
-        logger.error("Error while writing classification results")
+        logger.error(f"Error while writing scan and classification results from document {file_path}")
         raise e
 
     return {
@@ -164,24 +444,326 @@ async def read_and_classify_document(document: Document) -> dict:
     }
 
 
-async def extract_fields_document(document: Document) -> dict:
-    try:
-        ext_completion = await async_extract(
+async def read_unread_pages(document: Document) -> dict[int, str]:
+    """Read the pages skipped by the OCR (see OCR_PAGE_SELECTION) and set their text
+
+    Returns:
+        text of each page read, by page number (starting at 1)
+    """
+    async with stage_limits("ocr"):
+        page_texts, _ = await async_read_ocr(
+            document, client=doc_intelligence_client, cache=ocr_cache, pages=document.unread_pages()
+        )
+    document.set_ocr_text(page_texts)
+    return page_texts
+
+
+async def extract_missing_from_unread_pages(document: Document, ext_completion: dict) -> dict:
+    """Read the pages skipped by the OCR and extract the missing mandatory fields from them
+
+    Args:
+        document: Document read with page selection (see OCR_PAGE_SELECTION)
+        ext_completion: postprocessed extraction of the pages already read
+
+    Returns:
+        the extraction completed with the fields found in the new pages
+    """
+    logger.info(
+        f"Missing mandatory fields {ext_completion['missing_mandatory_fields']}, reading pages {document.unread_pages()}"
+    )
+    page_texts = await read_unread_pages(document)
+    async with stage_limits("extraction"):
+        new_completion = await async_extract(
             document,
             llm_client=llm_client_ext,
             llm_model=openai_config_extractor.deployment,
+            cache=llm_cache,
+            use_cache=use_llm_cache.get(),
+            rate_limiter=rate_limiter_ext,
+            max_retries=LLM_MAX_RETRIES,
+            budget=openai_config_extractor.token_budget,
+            text="\f".join(page_texts.values()),
         )
-    except Exception as e:
-        logger.error("Error while extracting extra fields")
-        raise e
+    if not new_completion:
+        return ext_completion
+
+    def completion_field(field: str) -> str:
+        return "invoiced_items" if field in INVOICE_ITEMS_FIELDS else field
+
+    for field in ext_completion["missing_mandatory_fields"]:
+        if new_completion.get(completion_field(field)):
+            ext_completion[completion_field(field)] = new_completion[completion_field(field)]
+    ext_completion["missing_mandatory_fields"] = [
+        field for field in ext_completion["missing_mandatory_fields"] if not ext_completion.get(completion_field(field))
+    ]
+    return ext_completion
+
+
+async def extract_document(
+    document: Document,
+    doc_type: str | None = None,
+    fields: list[str] | None = None,
+    previous: dict | None = None,
+    text: str | None = None,
+) -> dict:
+    if CHUNKED_EXTRACTION and fields is None and text is None:
+        await document.load("text")
+        if count_tokens(document.get_text()) > EXT_MAX_TOKENS:
+            return await extract_in_chunks(document, doc_type)
+    async with stage_limits("extraction"):
+        return await async_extract(
+            document,
+            llm_client=llm_client_ext,
+            llm_model=openai_config_extractor.deployment,
+            cache=llm_cache,
+            use_cache=use_llm_cache.get(),
+            text=text,
+            rate_limiter=rate_limiter_ext,
+            max_retries=LLM_MAX_RETRIES,
+            budget=openai_config_extractor.token_budget,
+            doc_type=doc_type,
+            fields=fields,
+            previous=previous,
+        )
+
+
+async def extract_in_chunks(document: Document, doc_type: str | None = None) -> dict:
+    """Extract a document too long for the extraction prompt by parts (map-reduce)
+
+    The header fields are extracted from the first and last pages, and the invoiced items from chunks of
+    consecutive pages (tables split between chunks keep their header), all concurrently. The items of the chunks
+    are then merged in order.
+
+    Args:
+        document: Document with its text
+        doc_type: document type of the prompts, defaults to document.doc_type
+
+    Returns:
+        the postprocessed extraction, with the invoiced items of all the chunks
+    """
+    fields = prompt_fields(doc_type or document.doc_type, document.has_qr())
+    item_fields = [field for field in fields if field in INVOICE_ITEMS_FIELDS]
+    if not item_fields:  # the header fields are all the fields, the text is only fitted to the prompt
+        return await extract_document(document, doc_type, text=document.get_text())
+    if document.unread_pages():  # the items of the pages skipped by the OCR would be missing
+        logger.info(f"Reading the pages {document.unread_pages()} of {document.doc_id} before the chunked extraction")
+        await read_unread_pages(document)
+    pages = [page for page in document.text if page]
+    chunks = chunk_pages(pages, EXT_CHUNK_TOKENS)
+    if len(chunks) > EXT_MAX_CHUNKS:
+        logger.warning(f"{document.doc_id} has {len(chunks)} chunks, only the first {EXT_MAX_CHUNKS} are extracted")
+        chunks = chunks[:EXT_MAX_CHUNKS]
+    header_fields = [field for field in fields if field not in INVOICE_ITEMS_FIELDS]
+    logger.info(f"Chunked extraction of {document.doc_id}: {len(pages)} pages in {len(chunks)} chunks")
+
+    extraction, *chunk_extractions = await asyncio.gather(
+        extract_document(document, doc_type, fields=header_fields, previous={}, text=header_text(pages)),
+        *[extract_document(document, doc_type, fields=item_fields, previous={}, text=chunk) for chunk in chunks],
+    )
+    if not extraction:  # the postprocessing failed
+        return extraction
+    extraction["invoiced_items"] = merge_invoice_items(
+        [chunk_extraction.get("invoiced_items", []) for chunk_extraction in chunk_extractions]
+    )
+    if not extraction["invoiced_items"]:
+        missing = extraction.get("missing_mandatory_fields", [])
+        extraction["missing_mandatory_fields"] = missing + [field for field in item_fields if field not in missing]
+    return extraction
+
+
+async def extract_incrementally(document: Document) -> dict:
+    """Extract only the fields that are missing or invalid in the previous extraction of the document
+
+    Args:
+        document: Document whose fields hold a previous extraction
+
+    Returns:
+        the previous extraction completed with the new fields, postprocessed
+    """
+    previous = previous_extraction(document.fields)
+    fields = fields_to_extract(document.fields, document.doc_type, document.has_qr())
+    if not fields:
+        logger.info(f"All the fields of the previous extraction of {document.doc_id} are valid")
+        return document.postprocess_extraction_fields(previous)
+    logger.info(f"Incremental extraction of {fields} for {document.doc_id}")
+    return await extract_document(document, fields=fields, previous=previous)
+
+
+async def run_extraction(document: Document, ext_completion: dict | None = None) -> tuple[dict, tuple[str, ...]]:
+    """Extract the fields of a classified document, without changing its fields or saving it
 
+    Args:
+        document: Document with its type (from the classification or the QR code)
+        ext_completion: extraction already made with the document type (e.g. a confirmed speculative extraction)
+
+    Returns:
+        tuple of the postprocessed extraction and the document parts to save ("text" when unread pages were read)
+    """
+    await document.load("text")
+    unread_pages = document.unread_pages()
+    if ext_completion is None:
+        try:
+            if INCREMENTAL_EXTRACTION and has_extraction(
+                document.fields, extraction_source(document.text, document.doc_type)
+            ):
+                ext_completion = await extract_incrementally(document)
+            else:
+                ext_completion = await extract_document(document)
+        except Exception as e:
+            logger.error("Error while extracting extra fields")
+            raise e
+
+    # the chunked extraction reads the unread pages first
+    parts = ("fields",) if document.unread_pages() == unread_pages else ("text", "fields")
+    if ext_completion.get("missing_mandatory_fields") and document.unread_pages():
+        try:
+            ext_completion = await extract_missing_from_unread_pages(document, ext_completion)
+            parts = ("text", "fields")
+        except Exception as e:
+            logger.error("Error while extracting from the pages skipped by the OCR")
+            raise e
+
+    return ext_completion, parts
+
+
+def apply_extraction(document: Document, ext_completion: dict) -> None:
+    """Set the extracted fields of the document, with the source of the extraction for the incremental extraction
+    TODO: THIS MODIFIES THE INPUT OBJECT
+    """
     for field in ext_completion:
         document.fields[field] = ext_completion[field]
+    document.fields[EXTRACTION_SOURCE_FIELD] = extraction_source(document.text, document.doc_type)
+
+
+@timed("extract_fields")
+@single_flight("extract_fields", part="text")
+async def extract_fields_document(document: Document) -> dict:
+    ext_completion, parts = await run_extraction(document)
+
+    apply_extraction(document, ext_completion)
 
     try:
-        await write_blob(document.doc_id, document.fields, BLOB_CONTAINER_MAPPING["fields"])
+        await save_document(document, parts=parts)
     except Exception as e:
         logger.error("Error while writing extraction results")
         raise e
 
     return ext_completion
+
+
+def guess_document_type(document: Document) -> str:
+    """Most likely document type before the classification: from the QR code, the file name or the recent priors"""
+    if document.has_qr():
+        return document.doc_type
+    match = DOC_TYPE_FILENAME_PATTERN.search(PurePosixPath(document.doc_id).name)
+    if match:
+        return match.group(1)
+    if recent_doc_types:
+        return Counter(recent_doc_types).most_common(1)[0][0]
+    return "FT"
+
+
+async def speculative_extraction(document: Document, doc_type: str, usage: TokenUsage) -> dict:
+    token_usage.set(usage)  # the task runs in a copy of the context, the usage of its calls is tracked apart
+    return await extract_document(document, doc_type)
+
+
+async def classify_and_extract_speculatively(document: Document) -> tuple[dict, dict]:
+    """Classify a document while extracting its fields with the most likely document type
+
+    The speculative extraction is kept when the classification agrees with the guess,
+    otherwise it is cancelled (or discarded) and the extraction runs again with the classified type.
+
+    Args:
+        document: Document read, without a QR code
+
+    Returns:
+        tuple of the classification output (see classify_document) and the extraction
+    """
+    guess = guess_document_type(document)
+    usage = TokenUsage()
+    speculation = asyncio.create_task(speculative_extraction(document, guess, usage))
+    logger.info(f"Speculative extraction of {document.doc_id} as {guess}")
+    try:
+        class_completion = await classify_document(document)
+    except Exception as e:
+        speculation.cancel()
+        raise e
+
+    if document.doc_type == guess:
+        speculation_stats.hits += 1
+        try:
+            ext_completion, _ = await run_extraction(document, await speculation)
+        except Exception as e:
+            logger.error("Error while extracting extra fields")
+            raise e
+        return class_completion, ext_completion
+
+    speculation_stats.misses += 1
+    speculation.cancel()
+    try:
+        await speculation
+    except (asyncio.CancelledError, Exception):
+        pass
+    wasted_tokens.inc(usage.total_tokens, process="Extraction")
+    logger.info(f"Speculative extraction discarded, {document.doc_id} is {document.doc_type} and not {guess}")
+    ext_completion, _ = await run_extraction(document)
+    return class_completion, ext_completion
+
+
+@timed("read_classify_and_extract")
+@single_flight("read_classify_and_extract")
+async def read_classify_and_extract_document(document: Document) -> dict:
+    """Read, classify and extract the fields of a document in a single run
+
+    When the QR code fixes the document type, the extraction does not depend on the classification
+    and both run concurrently. Otherwise the extraction runs after the classification, or concurrently
+    with a guessed document type (see SPECULATIVE_EXTRACTION and classify_and_extract_speculatively).
+    Outputs results to blobs named after document.file_path, once at the end.
+
+    Args:
+        document: Document to process
+
+    Returns:
+        dict with the output of read_and_classify_document and of the extraction
+            - extracted_fields: dict of fields extracted in this process
+            - missing_mandatory_fields: list of missing mandatory fields
+            - missing_optional_fields: list of missing optional fields
+    """
+    file_path = document.doc_id
+
+    try:
+        is_scanned = await read_document(document)
+    except Exception as e:
+        logger.error(f"Error while scanning text from document {document.doc_id}")
+        raise e
+
+    if document.has_qr():
+        logger.info(f"Document type {document.doc_type} fixed by the QR code, classifying and extracting concurrently")
+        class_completion, (ext_completion, _) = await asyncio.gather(
+            classify_document(document), run_extraction(document)
+        )
+    elif SPECULATIVE_EXTRACTION:
+        class_completion, ext_completion = await classify_and_extract_speculatively(document)
+    else:
+        class_completion = await classify_document(document)
+        ext_completion, _ = await run_extraction(document)
+
+    # the extraction is applied after the classification, as in the two step flow
+    apply_extraction(document, ext_completion)
+
+    try:
+        await save_document(document, parts=("text", "qr_info", "fields", "comments"))
+    except Exception as e:
+        logger.error(f"Error while writing the results from document {file_path}")
+        raise e
+
+    return {
+        "file_path": file_path,
+        "text": document.text,
+        "scanned_copy": is_scanned,
+        **class_completion,
+        "extracted_fields": ext_completion,
+        "missing_mandatory_fields": ext_completion.get("missing_mandatory_fields", []),
+        "missing_optional_fields": ext_completion.get("missing_optional_fields", []),
+    }
@@ -0,0 +1,165 @@
+"""
+IDR 2024
+
+Latency and usage metrics of the processing stages, in the Prometheus text format,
+and OpenTelemetry spans when the opentelemetry package is installed
+"""
+
+import functools
+import time
+from collections import defaultdict
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager, nullcontext
+
+from idr.cache import CacheStats
+
+try:
+    from opentelemetry import trace
+except ImportError:  # traces are optional, the spans are only measured for the metrics
+    trace = None
+
+tracer = trace.get_tracer("idr") if trace is not None else None
+
+# upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[tuple[tuple[str, str], ...], float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        self.values[tuple(sorted(labels.items()))] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(labels)} {value}" for labels, value in self.values.items()]
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values (e.g. durations) in cumulative buckets, with labels"""
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts: dict[tuple[tuple[str, str], ...], list[int]] = {}
+        self.sums: dict[tuple[tuple[str, str], ...], float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[key] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels((*labels, ('le', str(bound))))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+stage_duration = Histogram("idr_stage_duration_seconds", "Duration of the processing stages")
+llm_tokens = Counter("idr_llm_tokens_total", "Tokens used by the chat completions")
+wasted_tokens = Counter("idr_speculative_wasted_tokens_total", "Tokens of the speculative calls that were discarded")
+coalesced_calls = Counter("idr_coalesced_calls_total", "Calls that awaited an identical call already in flight")
+_cache_stats: dict[str, CacheStats] = {}
+_stage_observers: list[Callable[[str, str, float], None]] = []
+
+
+def observe_stage(stage: str, seconds: float, status: str = "ok") -> None:
+    """Record the duration of a stage in the histogram and pass it to the observers"""
+    stage_duration.observe(seconds, stage=stage, status=status)
+    for observer in _stage_observers:
+        observer(stage, status, seconds)
+
+
+def add_stage_observer(observer: Callable[[str, str, float], None]) -> None:
+    """Receive every stage duration as observer(stage, status, seconds) (e.g. to compute exact percentiles)"""
+    _stage_observers.append(observer)
+
+
+def remove_stage_observer(observer: Callable[[str, str, float], None]) -> None:
+    _stage_observers.remove(observer)
+
+
+@contextmanager
+def span(stage: str, **attributes: str | int) -> Iterator[None]:
+    """Measure a processing stage: with span("ocr"): ...
+
+    The duration is added to the stage histogram with the status "ok" or "error".
+    The attributes are only added to the OpenTelemetry span (they would multiply the metric series).
+
+    Args:
+        stage: name of the stage (e.g. "download", "ocr", "classification")
+        attributes: details of the span (e.g. the blob container)
+    """
+    status = "ok"
+    start = time.perf_counter()
+    with tracer.start_as_current_span(f"idr.{stage}", attributes=attributes) if tracer else nullcontext():
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            observe_stage(stage, time.perf_counter() - start, status)
+
+
+def timed(stage: str) -> Callable[[Callable[..., Awaitable]], Callable[..., Awaitable]]:
+    """Measure every call of an async function as a stage: @timed("read_and_classify")"""
+
+    def decorator(function: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_tokens(process: str, model: str, prompt: int, completion: int, cached: int = 0) -> None:
+    """Add the token usage reported in a chat completion response"""
+    llm_tokens.inc(prompt, process=process, model=model, type="prompt")
+    llm_tokens.inc(completion, process=process, model=model, type="completion")
+    llm_tokens.inc(cached, process=process, model=model, type="cached_prompt")
+
+
+def register_cache_stats(name: str, stats: CacheStats) -> None:
+    """Expose the hits and misses of a cache in the metrics"""
+    _cache_stats[name] = stats
+
+
+def render_metrics() -> str:
+    """All the metrics in the Prometheus text exposition format"""
+    lines = stage_duration.render() + llm_tokens.render() + wasted_tokens.render() + coalesced_calls.render()
+    for suffix, description in (("hits", "Cache hits"), ("misses", "Cache misses")):
+        name = f"idr_cache_{suffix}_total"
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+        for cache_name, stats in _cache_stats.items():
+            lines.append(f"{name}{format_labels((('cache', cache_name),))} {getattr(stats, suffix)}")
+    return "\n".join(lines) + "\n"
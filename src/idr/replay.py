@@ -0,0 +1,465 @@
+"""
+IDR 2024
+
+Offline replay of the Azure services, to benchmark the pipeline without network access
+
+The Document Intelligence results and chat completions are recorded once from the live services,
+with the document files, in a fixtures directory:
+    - documents/<file path>: document files
+    - ocr/<key>.json: AnalyzeResult of each OCR call (key of the file content and pages)
+    - completions/<key>.json: ChatCompletion of each prompt (key of the prompt messages)
+
+The replay stand-ins answer from the fixtures after an injected latency, and the blobs are kept in memory,
+so that read_and_classify_document and extract_fields_document run unchanged with the real PDF, QR and
+prompt processing.
+"""
+
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+from azure.core.exceptions import ResourceNotFoundError
+from loguru import logger
+from openai.types.chat import ChatCompletion
+
+from idr.cache import make_cache_key
+from idr.metrics import add_stage_observer, remove_stage_observer
+
+try:
+    import resource
+except ImportError:  # not available on windows, the peak memory is not reported
+    resource = None
+
+# placeholder settings, so that idr.config can be imported without the Azure credentials
+REPLAY_ENVIRONMENT = {
+    **{
+        f"AZURE_OPENAI_{name}{suffix}": value
+        for suffix in ("_v4o_mini", "_v4o")
+        for name, value in (
+            ("ENDPOINT", "https://replay.openai.azure.com"),
+            ("API_KEY", "replay"),
+            ("VERSION", "2024-10-21"),
+            ("DEPLOYMENT", f"replay{suffix}"),
+        )
+    },
+    "FORM_ENDPOINT": "https://replay.cognitiveservices.azure.com",
+    "FORM_KEY": "replay",
+    "DOC_CONTAINER": "documents",
+    "QR_CONTAINER": "qr-code",
+    "META_CONTAINER": "metadata",
+    "TEXT_CONTAINER": "text",
+    "COMMENTS_CONTAINER": "comments",
+    "CACHE_CONTAINER": "cache",
+    # the replayed services must be called for every document
+    "OCR_CACHE": "none",
+    "LLM_CACHE": "none",
+}
+
+
+def configure_replay_environment() -> None:
+    """Set the placeholder settings that are not already defined (must run before importing idr.config)"""
+    for name, value in REPLAY_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+
+
+def ocr_fixture_key(analyze_request: Any, pages: str | None) -> str:
+    """Key of the file content and pages, the file is sent as a request body (or in an AnalyzeDocumentRequest)"""
+    if hasattr(analyze_request, "read"):
+        content = analyze_request.read()
+        analyze_request.seek(0)
+    else:
+        content = analyze_request.bytes_source
+    return make_cache_key(content, pages or "")
+
+
+def completion_fixture_key(messages: list) -> str:
+    """Key of the prompt messages only, the deployment names may differ between recording and replay"""
+    return make_cache_key(json.dumps(messages, sort_keys=True))
+
+
+class FixtureStore:
+    """Directory with the recorded document files and service responses"""
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+
+    def read(self, kind: str, key: str) -> dict | None:
+        path = self.directory / kind / f"{key}.json"
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())
+
+    def write(self, kind: str, key: str, data: dict) -> None:
+        path = self.directory / kind / f"{key}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(data))
+
+    def read_document(self, file_path: str) -> bytes:
+        return (self.directory / "documents" / file_path).read_bytes()
+
+    def write_document(self, file_path: str, content: bytes) -> None:
+        path = self.directory / "documents" / file_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+    def documents(self) -> list[str]:
+        root = self.directory / "documents"
+        return sorted(path.relative_to(root).as_posix() for path in root.rglob("*") if path.is_file())
+
+
+@dataclass
+class Latency:
+    """Latency injected in the replayed calls: uniform in seconds * (1 +- jitter)"""
+
+    seconds: float = 0.0
+    jitter: float = 0.2
+
+    async def wait(self) -> None:
+        if self.seconds > 0:
+            await asyncio.sleep(self.seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class ReplayPoller:
+    def __init__(self, result: AnalyzeResult):
+        self._result = result
+
+    async def result(self) -> AnalyzeResult:
+        return self._result
+
+
+class ReplayDocumentIntelligenceClient:
+    """Stand-in of the async DocumentIntelligenceClient answering with the recorded AnalyzeResults"""
+
+    def __init__(self, store: FixtureStore, latency: Latency | None = None):
+        self.store = store
+        self.latency = latency or Latency()
+
+    async def begin_analyze_document(self, model_id: str, analyze_request: Any, pages: str | None = None, **kwargs):
+        data = self.store.read("ocr", ocr_fixture_key(analyze_request, pages))
+        if data is None:
+            raise ValueError(f"No recorded OCR result for this document and {pages=}")
+        await self.latency.wait()
+        return ReplayPoller(AnalyzeResult(data))
+
+
+class RecordingDocumentIntelligenceClient:
+    """Wrapper of the live DocumentIntelligenceClient saving every AnalyzeResult in the fixtures"""
+
+    def __init__(self, client: Any, store: FixtureStore):
+        self.client = client
+        self.store = store
+
+    async def begin_analyze_document(self, model_id: str, analyze_request: Any, pages: str | None = None, **kwargs):
+        key = ocr_fixture_key(analyze_request, pages)
+        poller = await self.client.begin_analyze_document(
+            model_id=model_id, analyze_request=analyze_request, pages=pages, **kwargs
+        )
+        result = await poller.result()
+        self.store.write("ocr", key, result.as_dict())
+        return ReplayPoller(result)
+
+
+class ReplayChatCompletions:
+    """Stand-in of the chat completions of AsyncAzureOpenAI answering with the recorded ChatCompletions"""
+
+    def __init__(self, store: FixtureStore, latency: Latency | None = None):
+        self.store = store
+        self.latency = latency or Latency()
+
+    async def create(self, model: str, messages: list, **kwargs) -> ChatCompletion:
+        data = self.store.read("completions", completion_fixture_key(messages))
+        if data is None:
+            raise ValueError("No recorded completion for this prompt")
+        await self.latency.wait()
+        return ChatCompletion.model_validate(data)
+
+
+class RecordingChatCompletions:
+    """Wrapper of the live chat completions saving every ChatCompletion in the fixtures"""
+
+    def __init__(self, completions: Any, store: FixtureStore):
+        self.completions = completions
+        self.store = store
+
+    async def create(self, model: str, messages: list, **kwargs) -> ChatCompletion:
+        completion = await self.completions.create(model=model, messages=messages, **kwargs)
+        self.store.write("completions", completion_fixture_key(messages), completion.model_dump(mode="json"))
+        return completion
+
+
+def chat_client(completions: Any) -> Any:
+    """Object with the chat.completions shape of AsyncAzureOpenAI"""
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+class MemoryBlobStream:
+    def __init__(self, content: bytes, chunk_size: int = 4 * 1024 * 1024):
+        self.content = content
+        self.size = len(content)
+        self.chunk_size = chunk_size
+
+    async def readall(self) -> bytes:
+        return self.content
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        for start in range(0, self.size, self.chunk_size):
+            yield self.content[start : start + self.chunk_size]
+
+
+class MemoryContainerClient:
+    """In-memory stand-in of an async ContainerClient, with the calls used by idr.storage.blobs"""
+
+    def __init__(self, latency: Latency | None = None):
+        self.blobs: dict[str, bytes] = {}
+        self.latency = latency or Latency()
+
+    async def download_blob(self, blob_path: str) -> MemoryBlobStream:
+        await self.latency.wait()
+        if blob_path not in self.blobs:
+            raise ResourceNotFoundError(f"The blob {blob_path} does not exist")
+        return MemoryBlobStream(self.blobs[blob_path])
+
+    async def upload_blob(self, blob_path: str, data: bytes | str, overwrite: bool = False) -> None:
+        await self.latency.wait()
+        self.blobs[blob_path] = data.encode() if isinstance(data, str) else data
+
+    async def list_blobs(self, name_starts_with: str = "") -> AsyncIterator[Any]:
+        for name in sorted(self.blobs):
+            if name.startswith(name_starts_with):
+                yield SimpleNamespace(name=name)
+
+    def get_blob_client(self, blob_path: str) -> Any:
+        async def exists() -> bool:
+            return blob_path in self.blobs
+
+        return SimpleNamespace(exists=exists)
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBlobStorage:
+    """In-memory stand-in of idr.storage.blobs.BlobStorage"""
+
+    def __init__(self, latency: Latency | None = None):
+        self.latency = latency or Latency()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._container_clients: dict[str, MemoryContainerClient] = {}
+
+    async def open(self) -> None:
+        self.loop = asyncio.get_running_loop()
+
+    async def close(self) -> None:
+        pass
+
+    def get_container_client(self, env_container: str) -> MemoryContainerClient:
+        if env_container not in self._container_clients:
+            self._container_clients[env_container] = MemoryContainerClient(self.latency)
+        return self._container_clients[env_container]
+
+
+@contextmanager
+def patched_services(ocr_client: Any, classification_client: Any, extraction_client: Any) -> Iterator[None]:
+    """Replace the service clients of idr.logic and disable its caches"""
+    import idr.logic as logic
+
+    names = ("doc_intelligence_client", "llm_client_class", "llm_client_ext", "ocr_cache", "llm_cache")
+    original = {name: getattr(logic, name) for name in names}
+    replacements = (ocr_client, classification_client, extraction_client, None, None)
+    for name, replacement in zip(names, replacements):
+        setattr(logic, name, replacement)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(logic, name, value)
+
+
+@asynccontextmanager
+async def memory_storage(store: FixtureStore, latency: Latency | None = None) -> AsyncIterator[MemoryBlobStorage]:
+    """Use an in-memory blob storage holding the recorded document files"""
+    from idr.storage import blobs
+
+    storage = MemoryBlobStorage(latency)
+    await storage.open()
+    documents = storage.get_container_client("DOC_CONTAINER")
+    for file_path in store.documents():
+        documents.blobs[file_path] = store.read_document(file_path)
+    await blobs.set_storage(storage)  # type: ignore
+    try:
+        yield storage
+    finally:
+        await blobs.wait_for_pending_writes()
+        await blobs.set_storage(None)
+
+
+async def process_document(file_path: str, stages: tuple[str, ...]) -> None:
+    """Run the stages on a document, as the API endpoints do"""
+    from idr.batch import BATCH_STAGES, STAGE_DOCUMENT_PARTS
+    from idr.storage.blobs import get_document
+
+    for stage in ("read_classify_and_extract", "read_and_classify", "extract_fields"):
+        if stage in stages:
+            await BATCH_STAGES[stage](await get_document(file_path, load=STAGE_DOCUMENT_PARTS[stage]))
+
+
+async def record_fixtures(
+    store: FixtureStore, file_paths: list[str], stages: tuple[str, ...] = ("read_and_classify", "extract_fields")
+) -> None:
+    """Download the documents and record the live service responses of their processing
+
+    The results are written to an in-memory storage, the blob containers are only read.
+
+    Args:
+        store: fixtures directory
+        file_paths: paths of the documents in the documents container
+        stages: stages to run on each document
+    """
+    import idr.logic as logic
+    from idr.storage.blobs import read_blob
+
+    for file_path in file_paths:
+        store.write_document(file_path, await read_blob(file_path))
+
+    with patched_services(
+        RecordingDocumentIntelligenceClient(logic.doc_intelligence_client, store),
+        chat_client(RecordingChatCompletions(logic.llm_client_class.chat.completions, store)),
+        chat_client(RecordingChatCompletions(logic.llm_client_ext.chat.completions, store)),
+    ):
+        async with memory_storage(store):
+            for file_path in file_paths:
+                logger.info(f"Recording {file_path}")
+                await process_document(file_path, stages)
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """p50, p95 and p99 of the samples, in seconds"""
+    if len(samples) == 1:
+        return {"p50": samples[0], "p95": samples[0], "p99": samples[0]}
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p95": quantiles[94], "p99": quantiles[98]}
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process and of its worker processes, in MB
+
+    The worker processes are only counted once they exited: call it after stop_workers.
+    """
+    if resource is None:
+        return None
+    kilobytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kilobytes += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return kilobytes / 1024
+
+
+@dataclass
+class BenchmarkReport:
+    documents: int
+    failed: int
+    seconds: float
+    concurrency: int
+    stages: dict[str, dict[str, float]] = field(default_factory=dict)
+    peak_rss_mb: float | None = None
+
+    @property
+    def documents_per_second(self) -> float:
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "documents": self.documents,
+            "failed": self.failed,
+            "seconds": self.seconds,
+            "documents_per_second": self.documents_per_second,
+            "concurrency": self.concurrency,
+            "stages": self.stages,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+
+async def run_benchmark(
+    store: FixtureStore,
+    concurrency: int = 8,
+    repeat: int = 1,
+    ocr_latency: Latency | None = None,
+    llm_latency: Latency | None = None,
+    blob_latency: Latency | None = None,
+    stages: tuple[str, ...] = ("read_and_classify", "extract_fields"),
+) -> BenchmarkReport:
+    """Replay the recorded documents through the pipeline and measure it
+
+    Args:
+        store: fixtures directory
+        concurrency: maximum number of documents processed at a time
+        repeat: number of times each document is processed (copies under other paths, the concurrent calls
+            for the same path and content would be coalesced)
+        ocr_latency: latency injected in the Document Intelligence calls
+        llm_latency: latency injected in the chat completions
+        blob_latency: latency injected in the blob reads and writes
+        stages: stages to run on each document
+
+    Returns:
+        BenchmarkReport with the throughput and the percentiles of each stage (in seconds),
+        the peak memory is left to the caller, measured with peak_rss_mb after the worker pool is stopped
+    """
+    samples: dict[str, list[float]] = defaultdict(list)
+
+    def observe(stage: str, status: str, seconds: float) -> None:
+        if status == "ok":
+            samples[stage].append(seconds)
+
+    copies = {
+        file_path if copy == 0 else f"repeat-{copy}/{file_path}": file_path
+        for copy in range(repeat)
+        for file_path in store.documents()
+    }
+    file_paths = list(copies)
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def process(file_path: str) -> None:
+        nonlocal failed
+        async with semaphore:
+            document_start = time.perf_counter()
+            try:
+                await process_document(file_path, stages)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error while replaying {file_path}: {e}")
+                return
+            samples["document"].append(time.perf_counter() - document_start)
+
+    completions = ReplayChatCompletions(store, llm_latency)
+    add_stage_observer(observe)
+    try:
+        with patched_services(
+            ReplayDocumentIntelligenceClient(store, ocr_latency), chat_client(completions), chat_client(completions)
+        ):
+            async with memory_storage(store, blob_latency) as storage:
+                documents = storage.get_container_client("DOC_CONTAINER").blobs
+                for file_path, original in copies.items():
+                    documents[file_path] = documents[original]
+                start = time.perf_counter()
+                await asyncio.gather(*[process(file_path) for file_path in file_paths])
+                seconds = time.perf_counter() - start
+    finally:
+        remove_stage_observer(observe)
+
+    return BenchmarkReport(
+        documents=len(file_paths) - failed,
+        failed=failed,
+        seconds=seconds,
+        concurrency=concurrency,
+        stages={stage: {"count": len(values), **percentiles(values)} for stage, values in sorted(samples.items())},
+    )
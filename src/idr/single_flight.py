@@ -0,0 +1,115 @@
+"""
+IDR 2024
+
+Coalescing of identical calls in flight: concurrent duplicates of a document stage (e.g. retries of camunda)
+await the call already running instead of calling the Azure services and writing the same blobs again
+"""
+
+import asyncio
+import copy
+import functools
+import json
+from collections.abc import Awaitable, Callable
+
+from loguru import logger
+
+from idr.cache import make_cache_key
+from idr.document import Document
+from idr.llm.llm_caller import use_llm_cache
+from idr.metrics import coalesced_calls
+
+# attributes of the leader document copied to the documents of the coalesced calls
+COALESCED_ATTRIBUTES = ("is_image", "qr_info", "valid", "doc_type", "fields", "comments")
+
+
+async def content_key(document: Document, part: str) -> str:
+    """Key of the input of a stage: hash of the file content, or of the text and type for the extraction
+
+    Args:
+        document: Document of the call
+        part: "stream" or "text", loaded if needed
+    """
+    await document.load(part)
+    if part == "stream":
+        # hashing a big file takes a while, out of the event loop
+        return await asyncio.to_thread(document.content_hash)
+    return make_cache_key(json.dumps(document.text), document.doc_type)
+
+
+class SingleFlight:
+    """Calls in flight by key, a call with the key of a running call gets the result of that call
+
+    The call runs in its own task, so that it continues (for the other callers) if the first caller is cancelled.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[str, tuple[asyncio.Task, Document]] = {}
+
+    async def run(self, key: str, document: Document, function: Callable[[Document], Awaitable[dict]]) -> dict:
+        """Run function(document), or wait for the call in flight with the same key
+
+        The coalesced calls get a copy of the result, and the results of the document of the first call
+        are copied to their document.
+
+        Args:
+            key: key of the call (stage input)
+            document: document of this call
+            function: stage to run on the document
+
+        Returns:
+            output of the stage
+        """
+        if key in self._calls:
+            task, leader = self._calls[key]
+            coalesced_calls.inc(stage=self.name)
+            logger.info(f"{self.name} of {document.doc_id} is already in flight, waiting for its result")
+            result = await asyncio.shield(task)
+            if document is not leader:
+                copy_results(leader, document)
+                result = copy.deepcopy(result)
+            return result
+
+        task = asyncio.create_task(function(document))
+        self._calls[key] = (task, document)
+
+        def forget(task: asyncio.Task) -> None:
+            if key in self._calls and self._calls[key][0] is task:
+                del self._calls[key]
+
+        task.add_done_callback(forget)
+        return await asyncio.shield(task)
+
+
+def copy_results(leader: Document, document: Document) -> None:
+    """Copy the results of a stage from the document it ran on
+    TODO: THIS MODIFIES THE INPUT OBJECT
+    """
+    for attribute in COALESCED_ATTRIBUTES:
+        setattr(document, attribute, copy.deepcopy(getattr(leader, attribute)))
+    if leader.is_loaded("text"):
+        document.text = copy.deepcopy(leader.text)
+
+
+def single_flight(
+    stage: str, part: str = "stream"
+) -> Callable[[Callable[[Document], Awaitable[dict]]], Callable[[Document], Awaitable[dict]]]:
+    """Coalesce the concurrent calls of a document stage with the same path and input: @single_flight("...")
+
+    Args:
+        stage: name of the stage, in the logs and metrics
+        part: input of the stage, "stream" for the file content or "text" for the text read before
+    """
+    flights = SingleFlight(stage)
+
+    def decorator(function: Callable[[Document], Awaitable[dict]]) -> Callable[[Document], Awaitable[dict]]:
+        @functools.wraps(function)
+        async def wrapper(document: Document) -> dict:
+            key = make_cache_key(document.doc_id, await content_key(document, part))
+            if not use_llm_cache.get():  # not coalesced with a call that may give the cached completions
+                key = make_cache_key(key, "no-cache")
+            return await flights.run(key, document, function)
+
+        return wrapper
+
+    return decorator
@@ -1,105 +1,413 @@
+import asyncio
+import copy
 import json
 import os
+import tempfile
+import weakref
+from collections.abc import Iterable
 
-from azure.storage.blob.aio import BlobServiceClient
+import aiohttp
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from loguru import logger
 
-from idr.config import BLOB_CONTAINER_MAPPING
+from idr.config import (
+    BLOB_BACKGROUND_WRITES,
+    BLOB_CONTAINER_MAPPING,
+    BLOB_POOL_SIZE,
+    STORAGE_CONNECTION_STRING,
+    STREAM_CHUNK_SIZE,
+    STREAM_SPOOL_DIR,
+    STREAM_SPOOL_THRESHOLD,
+)
 from idr.document import Document
+from idr.document.document import LAZY_PARTS, remove_file
+from idr.metrics import span
 
 
-async def validate_credentials(env_conn_str, env_container) -> tuple[str, str]:
-    conn_str = os.getenv(env_conn_str)
-    container = os.getenv(env_container)
+class BlobStorage:
+    """Long-lived connection to the Azure Blob Storage account
 
-    if conn_str is None or container is None:
+    Owns a single BlobServiceClient backed by a pooled aiohttp session, and one ContainerClient per container,
+    so that every storage call reuses already open (TLS) connections instead of creating a new client.
+    """
+
+    def __init__(self, connection_string: str, pool_size: int = BLOB_POOL_SIZE):
+        """
+        Args:
+            connection_string: storage account connection string
+            pool_size: maximum number of simultaneous connections to the storage account
+        """
+        self.connection_string = connection_string
+        self.pool_size = pool_size
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._service_client: BlobServiceClient | None = None
+        self._container_clients: dict[str, ContainerClient] = {}
+
+    async def open(self) -> None:
+        """Creates the connection pool and the service client (must run inside the event loop that uses them)"""
+        self.loop = asyncio.get_running_loop()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        self._service_client = BlobServiceClient.from_connection_string(
+            conn_str=self.connection_string,
+            transport=AioHttpTransport(session=self._session, session_owner=False),
+            # the first request downloads up to the spool threshold, bigger blobs are then read by chunks
+            max_single_get_size=STREAM_SPOOL_THRESHOLD,
+            max_chunk_get_size=STREAM_CHUNK_SIZE,
+        )
+        logger.info(f"Blob storage connection pool opened with {self.pool_size} connections")
+
+    async def close(self) -> None:
+        """Closes all clients and the connection pool"""
+        for container_client in self._container_clients.values():
+            await container_client.close()
+        self._container_clients = {}
+        if self._service_client is not None:
+            await self._service_client.close()
+            self._service_client = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        logger.info("Blob storage connection pool closed")
+
+    def get_container_client(self, env_container: str) -> ContainerClient:
+        """Get the (cached) client for a container
+
+        Args:
+            env_container: name of the environment variable with the container name
+
+        Raises:
+            ValueError: if the storage is not open or the container is not configured
+
+        Returns:
+            client for the container
+        """
+        if env_container not in self._container_clients:
+            container_name = os.getenv(env_container)
+            if self._service_client is None or container_name is None:
+                raise ValueError("Unavailable blob connection")
+            self._container_clients[env_container] = self._service_client.get_container_client(container_name)
+        return self._container_clients[env_container]
+
+
+_storage: BlobStorage | None = None
+# lock of the opening of the shared storage, by event loop (an asyncio.Lock is bound to the loop that uses it)
+_storage_locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = weakref.WeakKeyDictionary()
+
+
+async def open_storage() -> BlobStorage:
+    """Opens the shared blob storage connection (called on the API startup), closing the previous one"""
+    if STORAGE_CONNECTION_STRING is None:
         raise ValueError("Unavailable blob connection")
 
-    return conn_str, container
+    storage = BlobStorage(STORAGE_CONNECTION_STRING)
+    await storage.open()
+    await set_storage(storage)
+    return storage
+
 
+async def close_storage() -> None:
+    """Closes the shared blob storage connection (called on the API shutdown)"""
+    await set_storage(None)
 
-async def get_service_client(env_container: str) -> tuple[BlobServiceClient, str]:
+
+async def close_previous_storage(storage: BlobStorage) -> None:
+    """Close a storage replaced by another one, in the event loop it was opened in if it is still running"""
+    loop = asyncio.get_running_loop()
     try:
-        connection_string, container_name = await validate_credentials("STORAGE_CONNECTION_STRING", env_container)
+        if storage.loop is not None and storage.loop is not loop and storage.loop.is_running():
+            # used by another thread, closed there
+            asyncio.run_coroutine_threadsafe(storage.close(), storage.loop)
+        else:
+            await storage.close()
+    except Exception as e:  # e.g. connections of a closed event loop
+        logger.warning(f"Error while closing the previous blob storage connection: {e}")
 
-        service_client = BlobServiceClient.from_connection_string(conn_str=connection_string)
-        return service_client, container_name
 
-    except Exception as e:
-        logger.error("Error while connecting to Azure Services")
-        raise e
+async def set_storage(storage: BlobStorage | None) -> None:
+    """Replace the shared blob storage connection, closing the previous one
+    (e.g. by the in-memory storage of the replay benchmarks)
+    """
+    global _storage
+
+    previous, _storage = _storage, storage
+    if previous is not None and previous is not storage:
+        await close_previous_storage(previous)
+
+
+async def get_storage() -> BlobStorage:
+    """Get the shared blob storage connection, opening it if needed
+
+    Outside of the API (scripts, notebooks, tests) the connection is opened on first use,
+    and reopened when called from a new event loop (e.g. consecutive asyncio.run calls).
+    Concurrent first calls share the same connection.
+    """
+    loop = asyncio.get_running_loop()
+    if _storage is not None and _storage.loop is loop:
+        return _storage
+    lock = _storage_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        if _storage is not None and _storage.loop is loop:  # opened while waiting for the lock
+            return _storage
+        try:
+            return await open_storage()
+        except Exception as e:
+            logger.error("Error while connecting to Azure Services")
+            raise e
+
+
+async def get_container_client(env_container: str) -> ContainerClient:
+    storage = await get_storage()
+    return storage.get_container_client(env_container)
 
 
 async def get_blob_list(relative_path: str, env_container: str = "DOC_CONTAINER") -> list[str]:
-    service_client, container_name = await get_service_client(env_container)
+    container_client = await get_container_client(env_container)
     blob_list = []
-    async with service_client:
-        container_client = service_client.get_container_client(container_name)
-        async for blob in container_client.list_blobs(name_starts_with=relative_path):
-            blob_list.append(blob.name)
+    async for blob in container_client.list_blobs(name_starts_with=relative_path):
+        blob_list.append(blob.name)
 
     return blob_list
 
 
 async def check_blob(blob_path: str, env_container: str = "DOC_CONTAINER") -> bool:
     try:
-        service_client, container_name = await get_service_client(env_container)
-        async with service_client:
-            blob_client = service_client.get_blob_client(container_name, blob_path)
-            return await blob_client.exists()
+        container_client = await get_container_client(env_container)
+        return await container_client.get_blob_client(blob_path).exists()
     except Exception as e:
         logger.error(f"Error while connecting to Azure Blob Container {env_container}")
         raise e
 
 
+def blob_read_stage(env_container: str) -> str:
+    """Name of the metrics stage of a blob read: download of the document file, or read of a sidecar"""
+    return "download" if env_container == "DOC_CONTAINER" else "blob_read"
+
+
 async def read_blob(blob_path: str, env_container: str = "DOC_CONTAINER") -> bytes:
     try:
-        service_client, container_name = await get_service_client(env_container)
-        async with service_client:
-            container_client = service_client.get_container_client(container_name)
-            async with container_client:
-                blob_client = container_client.get_blob_client(blob_path)
-                async with blob_client:
-                    stream = await blob_client.download_blob()
-                    data = await stream.readall()
+        container_client = await get_container_client(env_container)
+        with span(blob_read_stage(env_container), container=env_container):
+            stream = await container_client.download_blob(blob_path)
+            data = await stream.readall()
         return data
     except Exception as e:
         logger.error(f"Error while reading a blob {blob_path} in the container {env_container}")
         raise e
 
 
+async def read_blob_if_exists(blob_path: str, env_container: str = "DOC_CONTAINER") -> bytes | None:
+    """Read a blob in a single round trip, without checking if it exists first
+
+    Args:
+        blob_path: path to the blob inside the container
+        env_container: name of the environment variable with the container name
+
+    Returns:
+        blob content, or None if the blob does not exist
+    """
+    try:
+        container_client = await get_container_client(env_container)
+        with span(blob_read_stage(env_container), container=env_container):
+            try:
+                stream = await container_client.download_blob(blob_path)
+            except ResourceNotFoundError:  # an absent sidecar is a normal read, not a failed one
+                return None
+            return await stream.readall()
+    except Exception as e:
+        logger.error(f"Error while reading a blob {blob_path} in the container {env_container}")
+        raise e
+
+
+async def spool_to_file(stream) -> str:
+    """Write a blob download to a temporary file, chunk by chunk
+
+    Args:
+        stream: StorageStreamDownloader of the blob
+
+    Returns:
+        path of the temporary file, deleting it is up to the caller
+    """
+    file = tempfile.NamedTemporaryFile(prefix="idr-", dir=STREAM_SPOOL_DIR, delete=False)
+    try:
+        with file:
+            async for chunk in stream.chunks():
+                await asyncio.to_thread(file.write, chunk)
+    except BaseException:
+        remove_file(file.name)
+        raise
+    return file.name
+
+
+async def read_blob_spooled(
+    blob_path: str, env_container: str = "DOC_CONTAINER", spool_threshold: int = STREAM_SPOOL_THRESHOLD
+) -> bytes | str | None:
+    """Read a blob in memory, or by chunks to a temporary file when it is big (so memory use stays bounded)
+
+    Args:
+        blob_path: path to the blob inside the container
+        env_container: name of the environment variable with the container name
+        spool_threshold: size in bytes above which the blob is written to a temporary file, 0 to always read in memory
+
+    Returns:
+        blob content, path of the temporary file with the content (deleting it is up to the caller),
+        or None if the blob does not exist
+    """
+    try:
+        container_client = await get_container_client(env_container)
+        with span(blob_read_stage(env_container), container=env_container):
+            try:
+                stream = await container_client.download_blob(blob_path)
+            except ResourceNotFoundError:
+                return None
+            if not spool_threshold or stream.size <= spool_threshold:
+                return await stream.readall()
+            logger.info(f"Spooling the blob {blob_path} of {stream.size} bytes to a temporary file")
+            return await spool_to_file(stream)
+    except Exception as e:
+        logger.error(f"Error while reading a blob {blob_path} in the container {env_container}")
+        raise e
+
+
 async def write_blob(blob_path: str, content: dict | list | str, env_container: str = "DOC_CONTAINER") -> bool:
     try:
-        service_client, container_name = await get_service_client(env_container)
-        async with service_client:
-            container_client = service_client.get_container_client(container_name)
-            async with container_client:
-                blob_client = container_client.get_blob_client(blob_path)
-                async with blob_client:
-                    json_data = json.dumps(content)
-                    await blob_client.upload_blob(json_data, overwrite=True)
+        container_client = await get_container_client(env_container)
+        json_data = json.dumps(content)
+        with span("blob_write", container=env_container):
+            await container_client.upload_blob(blob_path, json_data, overwrite=True)
         return True
     except Exception as e:
         logger.error(f"Error while writing a blob {blob_path} in the container {env_container}")
         raise e
 
 
-async def get_document(file_id: str, url: str = "") -> Document:
-    """Get document from blob storage"""
-    doc = Document(file_id, url=url)
+_pending_writes: dict[str, set[asyncio.Task]] = {}
+
+
+async def save_document(
+    document: Document,
+    parts: Iterable[str] = ("text", "qr_info", "fields", "comments"),
+    background: bool = BLOB_BACKGROUND_WRITES,
+) -> None:
+    """Persist document sidecars to their blob containers, all uploads run concurrently
+
+    Args:
+        document: document to persist, blobs are named after document.doc_id
+        parts: Document attributes to persist (keys of BLOB_CONTAINER_MAPPING), duplicates are written once
+        background: if True the uploads are scheduled as a background task and this returns immediately
+            (errors are only logged). get_document waits for the pending uploads of the same document.
+    """
+    file_path = document.doc_id
+    # snapshot the contents now, the document can be modified while the uploads run
+    # (parts that were never loaded did not change, they are not written)
+    contents = {
+        part: copy.deepcopy(getattr(document, part)) for part in dict.fromkeys(parts) if document.is_loaded(part)
+    }
+
+    async def upload() -> None:
+        await asyncio.gather(
+            *[write_blob(file_path, content, BLOB_CONTAINER_MAPPING[part]) for part, content in contents.items()]
+        )
+
+    if not background:
+        await upload()
+        return
+
+    async def upload_in_background() -> None:
+        try:
+            await upload()
+        except Exception as e:
+            logger.error(f"Error while writing {list(contents)} in the background for document {file_path}: {e}")
+
+    task = asyncio.create_task(upload_in_background())
+    pending = _pending_writes.setdefault(file_path, set())
+    pending.add(task)
+
+    def forget(task: asyncio.Task) -> None:
+        pending.discard(task)
+        if not pending and _pending_writes.get(file_path) is pending:
+            del _pending_writes[file_path]
+
+    task.add_done_callback(forget)
+
 
-    if await check_blob(file_id):
-        doc.stream = await read_blob(file_id)
+async def wait_for_pending_writes(file_path: str | None = None) -> None:
+    """Wait for background uploads started by save_document
+
+    Args:
+        file_path: only wait for the uploads of this document, all of them if None
+    """
+    if file_path is None:
+        tasks = [task for pending in _pending_writes.values() for task in pending]
     else:
+        tasks = list(_pending_writes.get(file_path, ()))
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+def set_document_part(document: Document, part: str, content: bytes | str | None) -> None:
+    """Set a part of a document from the content of its blob (a path for a spooled file content)"""
+    if part == "stream":
+        if content is None:
+            raise ValueError("File not found")
+        if isinstance(content, str):
+            document.set_stream_file(content, temporary=True)
+        else:
+            document.stream = content
+        return
+
+    value = json.loads(content) if content is not None else getattr(Document(""), part)
+    if part == "text" and isinstance(value, dict):
+        value = list(value.values())
+    setattr(document, part, value)
+
+
+async def load_document_part(document: Document, part: str) -> None:
+    """Download a part of a document on first use (loader of the documents of get_document)"""
+    if part == "stream":
+        content = await read_blob_spooled(document.doc_id, BLOB_CONTAINER_MAPPING[part])
+    else:
+        content = await read_blob_if_exists(document.doc_id, BLOB_CONTAINER_MAPPING[part])
+    set_document_part(document, part, content)
+
+
+async def get_document(file_id: str, url: str = "", load: Iterable[str] = LAZY_PARTS) -> Document:
+    """Get document from blob storage
+
+    The small sidecars (qr_info, fields, comments) and the parts in `load` are downloaded concurrently,
+    a missing sidecar is simply left empty. The other parts (file content or text) are only downloaded
+    when a stage needs them (see Document.load). A big file is spooled to a temporary file, deleted with the document.
+
+    Args:
+        file_id: path of the file in the documents container
+        url: url of the file
+        load: parts of LAZY_PARTS to download now (e.g. only the text for the extraction)
+
+    Raises:
+        ValueError: if the file does not exist
+    """
+    doc = Document(file_id, url=url, loader=load_document_part)
+
+    await wait_for_pending_writes(file_id)
+
+    load = set(load)
+    datatypes = [datatype for datatype in BLOB_CONTAINER_MAPPING if datatype not in LAZY_PARTS or datatype in load]
+
+    async def read(datatype: str) -> bytes | str | None:
+        if datatype == "stream":
+            return await read_blob_spooled(file_id, BLOB_CONTAINER_MAPPING[datatype])
+        return await read_blob_if_exists(file_id, BLOB_CONTAINER_MAPPING[datatype])
+
+    # without the file content, only check that it exists
+    exists = check_blob(file_id) if "stream" not in load else None
+    contents = await asyncio.gather(*[read(datatype) for datatype in datatypes], *([exists] if exists else []))
+    if exists is not None and not contents.pop():
         raise ValueError("File not found")
-    for datatype, env_container in list(BLOB_CONTAINER_MAPPING.items())[1:]:
-        if await check_blob(file_id, env_container):
-            data = await read_blob(file_id, env_container)
-            setattr(doc, datatype, json.loads(data))
-
-    if doc.text:
-        if isinstance(doc.text, dict):
-            doc.text = list(doc.text.values())
+    for datatype, content in zip(datatypes, contents):
+        set_document_part(doc, datatype, content)
+
     if "document_type" in doc.fields:
         doc.doc_type = doc.fields["document_type"]
     if "valid_document" in doc.fields:
@@ -108,9 +416,12 @@ async def get_document(file_id: str, url: str = "") -> Document:
 
 
 def get_document_from_file(path: str) -> Document:
-    """simple method to load from file, no validation"""
+    """simple method to load from file, no validation (a big file is read from disk when needed)"""
 
     doc = Document(id=path, url="")
+    if STREAM_SPOOL_THRESHOLD and os.path.getsize(path) > STREAM_SPOOL_THRESHOLD:
+        doc.set_stream_file(path)
+        return doc
     with open(path, "rb") as file:
         doc.stream = file.read()
 
@@ -0,0 +1,33 @@
+import json
+import time
+
+from idr.cache import Cache
+from idr.storage.blobs import read_blob_if_exists, write_blob
+
+
+class BlobCache(Cache):
+    """Cache stored as json blobs under a "<name>/" prefix of a container (CACHE_CONTAINER by default, the
+    containers of the document sidecars have their own lifecycle)
+
+    The size of the cache is not limited here, old entries should be removed with a lifecycle management
+    policy on the storage account.
+    """
+
+    def __init__(self, name: str, env_container: str = "CACHE_CONTAINER", ttl: float | None = None):
+        super().__init__(name, ttl)
+        self.env_container = env_container
+
+    def _blob_path(self, key: str) -> str:
+        return f"{self.name}/{key}.json"
+
+    async def _get(self, key: str) -> dict | list | str | None:
+        data = await read_blob_if_exists(self._blob_path(key), self.env_container)
+        if data is None:
+            return None
+        entry = json.loads(data)
+        if self._expired(entry["created"]):
+            return None
+        return entry["value"]
+
+    async def _set(self, key: str, value: dict | list | str) -> None:
+        await write_blob(self._blob_path(key), {"created": time.time(), "value": value}, self.env_container)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from idr.cache import DiskCache, MemoryCache, make_cache, make_cache_key
+from idr.document import Document, async_classify
+from idr.llm import call_chat_completions
+
+
+def test_cache_key():
+    assert make_cache_key(b"abc", "prebuilt-layout") == make_cache_key(b"abc", "prebuilt-layout")
+    assert make_cache_key(b"abc", "prebuilt-layout") != make_cache_key(b"abd", "prebuilt-layout")
+    # parts are delimited
+    assert make_cache_key("ab", "c") != make_cache_key("a", "bc")
+
+
+def test_memory_cache_lru():
+    cache = MemoryCache("test", max_entries=2)
+
+    async def run():
+        await cache.set("a", {"content": "A"})
+        await cache.set("b", {"content": "B"})
+        assert await cache.get("a") == {"content": "A"}  # "a" is now the most recently used
+        await cache.set("c", {"content": "C"})
+        assert await cache.get("b") is None
+        assert await cache.get("a") == {"content": "A"}
+        assert await cache.get("c") == {"content": "C"}
+
+    asyncio.run(run())
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+    assert cache.stats.hit_rate == 0.75
+
+
+def test_memory_cache_ttl():
+    cache = MemoryCache("test", ttl=0.01)
+
+    async def run():
+        await cache.set("a", "A")
+        assert await cache.get("a") == "A"
+        time.sleep(0.02)
+        assert await cache.get("a") is None
+
+    asyncio.run(run())
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache("test", tmp_path, max_entries=2)
+
+    async def run():
+        await cache.set("a", {"content": "A", "qr_data": {}})
+        assert await cache.get("a") == {"content": "A", "qr_data": {}}
+        # a new instance reads the same directory
+        assert await DiskCache("test", tmp_path).get("a") == {"content": "A", "qr_data": {}}
+        await cache.set("b", "B")
+        await cache.set("c", "C")
+        assert len(list(tmp_path.glob("*.json"))) == 2
+
+    asyncio.run(run())
+
+
+def test_make_cache():
+    assert make_cache("none", "test") is None
+    assert isinstance(make_cache("memory", "test"), MemoryCache)
+    # the blob entries are kept apart from the document sidecars
+    assert make_cache("blob", "test").env_container == "CACHE_CONTAINER"
+
+
+class FakeCompletions:
+    def __init__(self, content: str = '{"document_type": "FT"}'):
+        self.content = content
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        message = SimpleNamespace(content=self.content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_completion_cache():
+    completions = FakeCompletions()
+    llm_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    cache = MemoryCache("test")
+    prompt = [{"role": "user", "content": "classify"}]
+
+    async def call(llm_model="model", use_cache=True):
+        return await call_chat_completions(llm_client, llm_model, "", prompt, "Test", cache=cache, use_cache=use_cache)
+
+    async def run():
+        assert await call() == '{"document_type": "FT"}'
+        assert await call() == '{"document_type": "FT"}'
+        assert completions.calls == 1
+        await call(use_cache=False)
+        assert completions.calls == 2
+        await call(llm_model="other")
+        assert completions.calls == 3
+
+    asyncio.run(run())
+
+
+def test_completion_cache_bypass():
+    completions = FakeCompletions("Sorry, I can not classify this document")
+    llm_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    cache = MemoryCache("test")
+    document = Document("invoice.pdf")
+    document.text = ["Fatura"]
+
+    async def classify(use_cache=True):
+        return await async_classify(document, llm_client, "model", cache=cache, use_cache=use_cache)
+
+    async def run():
+        # a completion without a json object is not cached, the retries call the LLM again
+        assert await classify() == {} and await classify() == {}
+        assert completions.calls == 2
+        completions.content = '{"document_type": "FT"}'
+        assert await classify() == {"document_type": "FT"}
+        assert await classify() == {"document_type": "FT"}
+        assert completions.calls == 3
+        # the bypass is passed through to the call
+        await classify(use_cache=False)
+        assert completions.calls == 4
+
+    asyncio.run(run())
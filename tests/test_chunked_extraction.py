@@ -0,0 +1,56 @@
+import asyncio
+import re
+
+import idr.logic as logic
+from idr.document import Document
+from idr.document.incremental import merge_extraction
+
+
+async def fake_extract(document, text=None, fields=None, previous=None, **kwargs):
+    if "unit_price" in fields:  # the items of the chunk, one per "Artigo" line
+        items = re.findall(r"^Artigo (\d+)$", text, re.MULTILINE)
+        completion = {
+            "invoiced_items_description": [f"Artigo {number}" for number in items],
+            "invoiced_items_quantity": [1.0] * len(items),
+            "unit_price": [float(number) for number in items],
+            "missing_mandatory_fields": [] if items else list(fields),
+            "missing_optional_fields": [],
+        }
+    else:
+        completion = {"document_issue_date": "19/03/2024", "missing_mandatory_fields": []}
+    return document.postprocess_extraction_fields(merge_extraction(previous or {}, completion, fields))
+
+
+def test_chunked_extraction_without_items(monkeypatch):
+    monkeypatch.setattr(logic, "async_extract", fake_extract)
+    monkeypatch.setattr(logic, "EXT_CHUNK_TOKENS", 300)
+    document = Document("invoice.pdf")
+    document.text = ["Fatura\n" + "Linha sem artigos\n" * 200 for _ in range(3)]
+    document.doc_type = "FT"
+    extraction = asyncio.run(logic.extract_in_chunks(document))
+
+    assert extraction["document_issue_date"] == "19/03/2024" and extraction["invoiced_items"] == []
+    missing = extraction["missing_mandatory_fields"]
+    assert all(missing.count(field) == 1 for field in ("invoiced_items_description", "unit_price")), missing
+
+
+def test_chunked_extraction_merges_items(monkeypatch):
+    def page(number: int) -> str:
+        return "\n".join(["Fatura FT 1FA.2024L/1409"] + [f"Artigo {number * 100 + row}" for row in range(60)])
+
+    async def fake_read_ocr(document, client, cache, pages):
+        return {number: page(number) for number in pages}, None
+
+    monkeypatch.setattr(logic, "async_extract", fake_extract)
+    monkeypatch.setattr(logic, "async_read_ocr", fake_read_ocr)
+    monkeypatch.setattr(logic, "EXT_CHUNK_TOKENS", 300)
+    document = Document("invoice.pdf")
+    # the third page was skipped by the OCR page selection
+    document.text = [page(1), page(2), None, page(4)]
+    document.doc_type = "FT"
+    extraction = asyncio.run(logic.extract_in_chunks(document))
+
+    # the items of all the chunks are merged in order, including those of the page read before chunking
+    expected = [f"Artigo {number * 100 + row}" for number in range(1, 5) for row in range(60)]
+    assert [item["description"] for item in extraction["invoiced_items"]] == expected
+    assert document.unread_pages() == [] and extraction["document_issue_date"] == "19/03/2024"
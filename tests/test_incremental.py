@@ -0,0 +1,93 @@
+import asyncio
+
+import idr.logic as logic
+from idr.document import Document
+from idr.document.incremental import (
+    extraction_source,
+    fields_to_extract,
+    has_extraction,
+    merge_extraction,
+    previous_extraction,
+)
+from idr.llm.prompt_formatting import make_extraction_prompt
+
+
+def extracted_fields() -> dict:
+    document = Document("invoice.pdf")
+    completion = {
+        "document_issue_date": "19/03/2024",
+        "document_due_date": "<missing>",
+        "currency": "euros",
+        "total_tax_amount": "23.00",
+        "document_total_with_tax": "123.00",
+        "invoiced_items_description": ["Serviço"],
+        "invoiced_items_quantity": [1],
+        "unit_price": [100.0],
+        "iban": "<missing>",
+        "missing_mandatory_fields": ["document_due_date"],
+        "missing_optional_fields": ["iban"],
+    }
+    return document.postprocess_extraction_fields(completion)
+
+
+def test_fields_to_extract():
+    fields = extracted_fields()
+    assert fields_to_extract(fields, "FT", False) == ["document_due_date", "currency"]
+
+    fields["invoiced_items"] = []
+    asked = fields_to_extract(fields, "FT", False)
+    assert asked == [
+        "document_due_date",
+        "currency",
+        "invoiced_items_description",
+        "invoiced_items_quantity",
+        "unit_price",
+    ]
+
+    content = make_extraction_prompt("Fatura", "FT", False, fields=["document_due_date", "currency"])[1]["content"]
+    assert ' - "document_due_date"' in content and ' - "currency"' in content
+    assert ' - "document_issue_date"' not in content and ' - "iban"' not in content
+
+
+def test_merge_extraction():
+    fields = extracted_fields()
+    previous = previous_extraction(fields)
+    completion = {"document_due_date": "18/04/2024", "missing_mandatory_fields": [], "missing_optional_fields": []}
+    merged = merge_extraction(previous, completion, ["document_due_date", "currency"])
+
+    # currency was left out of the completion, it keeps its previous value
+    assert merged["document_due_date"] == "18/04/2024" and merged["currency"] == "euros"
+    assert merged["missing_mandatory_fields"] == [] and merged["missing_optional_fields"] == ["iban"]
+
+    out = Document("invoice.pdf").postprocess_extraction_fields(merged)
+    assert out["document_issue_date"] == "19/03/2024" and out["iban"] == ""
+    assert out["invoiced_items"] == [{"description": "Serviço", "quantity": 1, "unit_price": 100.0}]
+
+
+def test_extraction_of_replaced_file(monkeypatch):
+    asked = []
+
+    async def fake_extract(document, fields=None, previous=None, **kwargs):
+        asked.append(fields)
+        if fields is None:
+            return extracted_fields()
+        return document.postprocess_extraction_fields(merge_extraction(previous, {}, fields))
+
+    monkeypatch.setattr(logic, "async_extract", fake_extract)
+    monkeypatch.setattr(logic, "INCREMENTAL_EXTRACTION", True)
+    monkeypatch.setattr(logic, "CHUNKED_EXTRACTION", False)
+    document = Document("invoice.pdf")
+    document.text = ["Fatura"]
+    document.doc_type = "FT"
+    logic.apply_extraction(document, extracted_fields())
+    assert has_extraction(document.fields, extraction_source(["Fatura"], "FT"))
+
+    asyncio.run(logic.run_extraction(document))
+    assert asked[-1] == ["document_due_date", "currency"]
+    # the file was replaced, or classified with another type: the stored extraction is not reused
+    document.text = ["Fatura nova"]
+    asyncio.run(logic.run_extraction(document))
+    document.text = ["Fatura"]
+    document.doc_type = "NC"
+    asyncio.run(logic.run_extraction(document))
+    assert asked[1:] == [None, None]
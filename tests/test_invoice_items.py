@@ -1,4 +1,4 @@
-from idr.document.invoice_items import format_invoice_items
+from idr.document.invoice_items import format_invoice_items, merge_invoice_items
 
 sample_extraction = {
     "document_due_date": "01/05/2024",
@@ -80,3 +80,41 @@ def test_invoice_items_format():
     invoiced_items: list[dict[str, str]] = formatted["invoiced_items"]  # type: ignore
     assert len(invoiced_items) == 16
     assert set(invoiced_items[0].keys()) == {"description", "quantity", "unit_price"}
+
+
+def test_merge_invoice_items():
+    def item(description: str, price: str = "10.00") -> dict:
+        return {"description": description, "quantity": "1", "unit_price": price}
+
+    header = {"description": "Descrição", "quantity": "Qtd.", "unit_price": "Preço"}
+    chunks = [
+        [header, item("A"), item("B"), item("Transporte", "20.00")],
+        [header, item("A transportar", "20.00"), item("B"), item("C")],
+        [],
+        [item("D"), item("D")],
+    ]
+    merged = merge_invoice_items(chunks)
+    # the repeated header and carried-over rows are dropped, the same article billed on consecutive rows is kept
+    # across chunks (B) and within a chunk (D)
+    assert [entry["description"] for entry in merged] == ["A", "B", "B", "C", "D", "D"]
+
+    chunks = [
+        [item("A"), item("Transporte de mercadorias Lisboa-Porto", "45,00"), item("Portes", ""), item("B")],
+        [item("C", "1.234,50"), item("Transporte", "1.299,50"), item("Transporte", "5,00"), item("E")],
+    ]
+    merged = merge_invoice_items(chunks)
+    # a freight item and an item without price inside a chunk are kept, as is a "Transporte" row on a page break
+    # that does not carry the subtotal over (A + freight + B + C = 1299.50)
+    assert [entry["description"] for entry in merged] == [
+        "A",
+        "Transporte de mercadorias Lisboa-Porto",
+        "Portes",
+        "B",
+        "C",
+        "Transporte",
+        "E",
+    ]
+    assert merged[5]["unit_price"] == "5,00"
+
+    uneven = format_invoice_items({"invoiced_items_description": ["A", "B"], "invoiced_items_quantity": [1]})
+    assert uneven["invoiced_items"][1] == {"description": "B", "quantity": "", "unit_price": ""}
@@ -0,0 +1,111 @@
+import asyncio
+
+from idr.jobs import JobWorkers, SQLiteJobStore, jobs_enabled, make_job_store, start_jobs, stop_jobs
+
+
+def test_job_store(tmp_path):
+    async def run():
+        store = SQLiteJobStore(tmp_path / "jobs.sqlite")
+        job, created = await store.submit("extract_fields", "invoices/a.pdf", callback_url="http://camunda/callback")
+        duplicate, duplicate_created = await store.submit("extract_fields", "invoices/a.pdf")
+        other, _ = await store.submit("read_and_classify", "invoices/a.pdf")
+        assert created and not duplicate_created and duplicate.job_id == job.job_id
+        assert other.job_id != job.job_id
+
+        claimed = await store.claim("extract_fields")
+        assert claimed.job_id == job.job_id and claimed.status == "running"
+        assert await store.claim("extract_fields") is None
+        await store.close()
+
+        # the running job is queued again after a restart
+        store = SQLiteJobStore(tmp_path / "jobs.sqlite")
+        assert await store.requeue_running() == 1
+        assert (await store.claim("extract_fields")).job_id == job.job_id
+        done = await store.finish(job.job_id, result={"currency": "EUR"})
+        assert done.status == "done" and (await store.get(job.job_id)).result == {"currency": "EUR"}
+        assert done.callback_url == "http://camunda/callback"
+
+        # a finished job does not block a new submission
+        _, created = await store.submit("extract_fields", "invoices/a.pdf")
+        assert created
+        assert await store.delete_finished(older_than=0) == 1
+        assert await store.get(job.job_id) is None
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_job_workers(tmp_path):
+    processed = []
+
+    async def process(file_path, stage, file_url):
+        processed.append(file_path)
+        await asyncio.sleep(0.01)
+        if file_path == "invoices/broken.pdf":
+            raise ValueError("File not found")
+        return {"file_path": file_path, "stage": stage}
+
+    async def run():
+        store = SQLiteJobStore(tmp_path / "jobs.sqlite")
+        workers = JobWorkers(store, {"extract_fields": 2}, process=process, poll_interval=0.05)
+        workers.start()
+        jobs = [(await store.submit("extract_fields", f"invoices/{name}.pdf"))[0] for name in ("a", "b", "broken")]
+        workers.notify("extract_fields")
+        for _ in range(100):
+            finished = [await store.get(job.job_id) for job in jobs]
+            if all(job.status in ("done", "failed") for job in finished):
+                break
+            await asyncio.sleep(0.02)
+        await workers.stop()
+        await store.close()
+        return finished
+
+    a, b, broken = asyncio.run(run())
+    assert sorted(processed) == ["invoices/a.pdf", "invoices/b.pdf", "invoices/broken.pdf"]
+    assert a.status == b.status == "done" and a.result == {"file_path": "invoices/a.pdf", "stage": "extract_fields"}
+    assert broken.status == "failed" and broken.error == "ValueError: File not found"
+
+
+def test_job_workers_survive_store_errors(tmp_path):
+    async def process(file_path, stage, file_url):
+        return {"file_path": file_path}
+
+    async def run():
+        store = SQLiteJobStore(tmp_path / "jobs.sqlite")
+        finish, failures = store.finish, []
+
+        async def broken_finish(job_id, **kwargs):
+            if len(failures) < 2:  # the output and then the error of the first job cannot be saved
+                failures.append(job_id)
+                raise RuntimeError("database is locked")
+            return await finish(job_id, **kwargs)
+
+        store.finish = broken_finish
+        # a long poll interval: the second job is only processed if the worker is alive and woken up
+        workers = JobWorkers(store, {"extract_fields": 1}, process=process, poll_interval=60)
+        workers.start()
+        first, _ = await store.submit("extract_fields", "invoices/a.pdf")
+        workers.notify("extract_fields")
+        while len(failures) < 2:
+            await asyncio.sleep(0.01)
+        second, _ = await store.submit("extract_fields", "invoices/b.pdf")
+        workers.notify("extract_fields")
+        for _ in range(100):
+            if (await store.get(second.job_id)).status == "done":
+                break
+            await asyncio.sleep(0.02)
+        await workers.stop()
+        statuses = (await store.get(first.job_id)).status, (await store.get(second.job_id)).status
+        await store.close()
+        return statuses
+
+    assert asyncio.run(run()) == ("running", "done")
+
+
+def test_jobs_disabled():
+    async def run():
+        assert make_job_store("none") is None
+        assert await start_jobs() is None and not jobs_enabled()  # JOB_QUEUE defaults to none
+        await stop_jobs()
+
+    asyncio.run(run())
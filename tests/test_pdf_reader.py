@@ -0,0 +1,41 @@
+import asyncio
+
+from idr.document import Document, async_read_filetype
+from idr.document.pdf_reader import garbled_ratio, is_text_layer_usable, mentions_atcud, read_pdf, read_pdf_pages
+from idr.document.workers import start_workers, stop_workers
+
+path_ = "tests/data/77807_MONERIS - SERVIÇOS DE GESTÃO, SA - FT 1FA.2024L_1409.pdf"
+
+
+def test_text_layer():
+    with open(path_, "rb") as file:
+        pages = read_pdf(file.read())
+
+    assert is_text_layer_usable(pages, min_length=300, max_garbled_ratio=0.05)
+    assert not is_text_layer_usable(pages, min_length=100000, max_garbled_ratio=0.05)
+    assert mentions_atcud(pages)
+
+
+def test_garbled_ratio():
+    assert garbled_ratio("") == 0.0
+    assert garbled_ratio("Fatura FT 1FA.2024L/1409") == 0.0
+    assert garbled_ratio("��ab") == 0.5
+    assert garbled_ratio("(cid:12)(cid:3)") == 1.0
+    assert not is_text_layer_usable(["(cid:12)(cid:3)" * 100], min_length=300, max_garbled_ratio=0.05)
+
+
+def test_async_read_filetype():
+    with open(path_, "rb") as file:
+        stream = file.read()
+
+    assert read_pdf_pages(stream, 0, 20) == (read_pdf(stream), 1)
+
+    document = Document(path_)
+    document.stream = stream
+    start_workers(2, pool="thread")
+    try:
+        asyncio.run(async_read_filetype(document))
+    finally:
+        stop_workers()
+    assert document.text == read_pdf(stream)
+    assert not document.is_image
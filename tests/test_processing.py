@@ -0,0 +1,46 @@
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+from idr.document import Document
+from idr.document.processing import format_page_ranges, select_ocr_pages, split_ocr_pages
+from idr.llm.tokens import count_tokens
+
+
+def test_format_page_ranges():
+    assert format_page_ranges([1]) == "1"
+    assert format_page_ranges([5, 1, 2, 3]) == "1-3,5"
+    assert format_page_ranges([1, 3, 4, 7, 8, 9]) == "1,3-4,7-9"
+
+
+def test_select_ocr_pages():
+    document = Document("test.pdf")
+    document.text = ["Fatura FT 1FA.2024L/1409 " * 500] * 6
+    tokens = count_tokens(document.text[0])
+    # 2 pages fill the budget, plus a margin page
+    assert select_ocr_pages(document, max_tokens=2 * tokens) == [1, 2, 3]
+    assert select_ocr_pages(document, max_tokens=2 * tokens, qr_page=5) == [1, 2, 3, 6]
+    # scanned pages have no text, their tokens are estimated
+    document.text = [""] * 20
+    assert select_ocr_pages(document, max_tokens=8000, min_page_tokens=800) == list(range(1, 12))
+    # all pages fit
+    document.text = ["Fatura"] * 3
+    assert select_ocr_pages(document, max_tokens=8000) is None
+
+
+def test_split_ocr_pages_and_set_text():
+    ocr_result = AnalyzeResult(
+        {
+            "content": "page 1\n<!-- PageBreak -->\npage 3",
+            "pages": [{"pageNumber": 1, "spans": []}, {"pageNumber": 3, "spans": []}],
+        }
+    )
+    page_texts = split_ocr_pages(ocr_result)
+    assert page_texts == {1: "page 1", 3: "page 3"}
+
+    document = Document("test.pdf")
+    document.set_ocr_text(page_texts, page_count=4)
+    assert document.text == ["page 1", None, "page 3", None]
+    assert document.unread_pages() == [2, 4]
+    assert document.get_text() == "page 1\fpage 3"
+
+    document.set_ocr_text({2: "page 2", 4: "page 4"})
+    assert document.unread_pages() == []
@@ -1,4 +1,12 @@
-from idr.document.qr_codes import qr_code_to_dict, validate_qr_code
+from types import SimpleNamespace
+
+import pypdf
+from PIL import Image
+
+from idr.document import qr_codes
+from idr.document.qr_codes import decode_qr_from_file, qr_candidate_pages, qr_code_to_dict, validate_qr_code
+
+path_ = "tests/data/77807_MONERIS - SERVIÇOS DE GESTÃO, SA - FT 1FA.2024L_1409.pdf"
 
 
 def test_qr_code():
@@ -26,3 +34,65 @@ def test_qr_code():
     assert not validate_qr_code("valvaefmearkofea")
     # remove required field
     assert not validate_qr_code(qr_code_string[12:])
+
+
+def test_qr_candidate_pages():
+    assert qr_candidate_pages(1, 2) == [0]
+    assert qr_candidate_pages(5, 3) == [0, 4, 1]
+    assert qr_candidate_pages(4, 10) == [0, 3, 1, 2]
+
+
+def test_decode_qr_from_pdf(monkeypatch):
+    qr_code_string = "A:509104720*B:508453488*C:PT*D:FT*E:N*F:20240319*G:FT 2024A4/1*H:JJJRJ85C-1*I1:PT*Q:PqIU*R:0006"
+    decoded_sizes = []
+
+    def fake_zbar_decode(image, symbols):
+        decoded_sizes.append(image.size)
+        # only the square embedded image holds the QR code
+        if image.size[0] == image.size[1]:
+            return [SimpleNamespace(data=qr_code_string.encode())]
+        return []
+
+    monkeypatch.setattr(qr_codes, "zbar_decode", fake_zbar_decode)
+    monkeypatch.setattr(qr_codes, "ZBarSymbol", SimpleNamespace(QRCODE="QRCODE"), raising=False)
+    with open(path_, "rb") as file:
+        qr_data, qr_page = decode_qr_from_file(file.read(), is_image=False)
+
+    assert qr_data == qr_code_to_dict(qr_code_string)
+    assert qr_page == 0
+    assert len(decoded_sizes) == 1
+
+
+def test_decode_qr_from_rendered_pdf(monkeypatch):
+    qr_code_string = "A:509104720*B:508453488*C:PT*D:FT*E:N*F:20240319*G:FT 2024A4/1*H:JJJRJ85C-1*I1:PT*Q:PqIU*R:0006"
+    rendered = Image.new("L", (1000, 1400))
+
+    def fake_zbar_decode(image, symbols):
+        # the code is drawn as vector graphics, it is only in the rendered page
+        return [SimpleNamespace(data=qr_code_string.encode())] if image is rendered else []
+
+    class FakePdfDocument:
+        def __init__(self, file):
+            self.pages = len(pypdf.PdfReader(file).pages)
+            self.closed = False
+
+        def __len__(self):
+            return self.pages
+
+        def __getitem__(self, index):
+            bitmap = SimpleNamespace(to_pil=lambda: rendered)
+            return SimpleNamespace(render=lambda scale, grayscale: bitmap)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(qr_codes, "zbar_decode", fake_zbar_decode)
+    monkeypatch.setattr(qr_codes, "ZBarSymbol", SimpleNamespace(QRCODE="QRCODE"), raising=False)
+    with open(path_, "rb") as file:
+        content = file.read()
+
+    monkeypatch.setattr(qr_codes, "pypdfium2", None)
+    assert decode_qr_from_file(content, is_image=False) == ({}, None)
+
+    monkeypatch.setattr(qr_codes, "pypdfium2", SimpleNamespace(PdfDocument=FakePdfDocument))
+    assert decode_qr_from_file(content, is_image=False) == (qr_code_to_dict(qr_code_string), 0)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from idr.llm import call_chat_completions
+from idr.llm.rate_limiter import RateLimiter
+from idr.llm.tokens import count_prompt_tokens, count_tokens
+
+
+def rate_limit_error(retry_after_ms: str) -> openai.RateLimitError:
+    request = httpx.Request("POST", "https://example.openai.azure.com")
+    response = httpx.Response(429, headers={"retry-after-ms": retry_after_ms}, request=request)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class RateLimitedCompletions:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise rate_limit_error("50")
+        message = SimpleNamespace(content='{"document_type": "FT"}')
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message)],
+            usage=SimpleNamespace(prompt_tokens=8, completion_tokens=2, total_tokens=10),
+        )
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("Fatura") > 0
+    assert count_prompt_tokens([{"role": "user", "content": "Fatura"}]) > count_tokens("Fatura")
+
+
+def test_rate_limiter_waits():
+    rate_limiter = RateLimiter(tokens_per_minute=600)
+
+    async def run():
+        assert await rate_limiter.acquire(600) < 0.1
+        # the bucket is empty, 5 tokens take 0.5s to refill at 10 tokens per second
+        return await rate_limiter.acquire(5)
+
+    assert 0.4 < asyncio.run(run()) < 1
+
+
+def test_rate_limited_call_is_retried():
+    completions = RateLimitedCompletions(failures=2)
+    llm_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    prompt = [{"role": "user", "content": "classify"}]
+
+    async def call(max_retries, rate_limiter=None):
+        return await call_chat_completions(
+            llm_client, "model", "", prompt, "Test", rate_limiter=rate_limiter or RateLimiter(), max_retries=max_retries
+        )
+
+    start = time.monotonic()
+    assert asyncio.run(call(max_retries=2)) == '{"document_type": "FT"}'
+    assert completions.calls == 3
+    assert time.monotonic() - start >= 0.1  # waited the Retry-After of both errors
+
+    completions = RateLimitedCompletions(failures=2)
+    llm_client.chat.completions = completions
+    assert asyncio.run(call(max_retries=1)) is None
+    assert completions.calls == 2
+
+    # the tokens reserved by the rate limited attempts are given back, only the usage of the last one is kept
+    completions = RateLimitedCompletions(failures=2)
+    llm_client.chat.completions = completions
+    rate_limiter = RateLimiter(tokens_per_minute=6000)
+
+    async def run():
+        assert await call(max_retries=2, rate_limiter=rate_limiter) == '{"document_type": "FT"}'
+        return await rate_limiter.acquire(5980)
+
+    assert asyncio.run(run()) < 0.1
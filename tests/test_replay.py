@@ -0,0 +1,379 @@
+import asyncio
+import gc
+import hashlib
+import json
+import os
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+from openai.types.chat import ChatCompletion
+
+from idr.cache import make_cache_key
+from idr.document.pdf_reader import read_pdf
+from idr.document.workers import run_in_worker, start_workers, stop_workers
+from idr.metrics import wasted_tokens
+from idr.replay import (
+    FixtureStore,
+    Latency,
+    RecordingChatCompletions,
+    RecordingDocumentIntelligenceClient,
+    ReplayPoller,
+    chat_client,
+    configure_replay_environment,
+    memory_storage,
+    patched_services,
+    peak_rss_mb,
+    process_document,
+    run_benchmark,
+)
+
+path_ = "tests/data/77807_MONERIS - SERVIÇOS DE GESTÃO, SA - FT 1FA.2024L_1409.pdf"
+
+classification = {
+    "original_copy": "Y",
+    "has_atcud": "Y",
+    "supplier_country": "PT",
+    "supplier_vat": "PT123456789",
+    "supplier_name": "MONERIS - SERVIÇOS DE GESTÃO, SA",
+    "acquirer_vat": "PT987654321",
+    "acquirer_name": "Acquirer",
+    "document_type": "FT",
+    "document_number": "FT 1FA.2024L/1409",
+    "valid_document": "Y",
+    "classification_comments": "",
+}
+
+
+class LiveDocumentIntelligence:
+    async def begin_analyze_document(self, **kwargs):
+        return ReplayPoller(AnalyzeResult({"content": "Fatura FT 1FA.2024L/1409", "pages": [{"pageNumber": 1}]}))
+
+
+class LiveCompletions:
+    async def create(self, model, messages, **kwargs):
+        content = classification if "classify" in messages[1]["content"].lower() else {"currency": "EUR"}
+        return ChatCompletion.model_validate(
+            {
+                "id": "completion",
+                "object": "chat.completion",
+                "created": 0,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": json.dumps(content)},
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+            }
+        )
+
+
+def test_record_and_replay(tmp_path):
+    configure_replay_environment()
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        store.write_document("invoices/invoice.pdf", file.read())
+
+    async def record():
+        completions = chat_client(RecordingChatCompletions(LiveCompletions(), store))
+        with patched_services(
+            RecordingDocumentIntelligenceClient(LiveDocumentIntelligence(), store), completions, completions
+        ):
+            async with memory_storage(store):
+                await process_document("invoices/invoice.pdf", ("read_and_classify", "extract_fields"))
+
+    start_workers(2, pool="thread")
+    try:
+        asyncio.run(record())
+        assert len(list((tmp_path / "ocr").iterdir())) == 1
+        assert len(list((tmp_path / "completions").iterdir())) == 2
+
+        report = asyncio.run(run_benchmark(store, concurrency=2, repeat=3, llm_latency=Latency(0.01)))
+    finally:
+        stop_workers()
+
+    assert report.documents == 3 and report.failed == 0
+    assert report.documents_per_second > 0
+    for stage in ("download", "pdf_parsing", "ocr", "classification", "extraction", "document"):
+        assert report.stages[stage]["count"] >= 3
+    assert report.stages["classification"]["p50"] >= 0.008
+
+
+def test_read_classify_and_extract_with_qr(tmp_path, monkeypatch):
+    configure_replay_environment()
+    import idr.logic as logic
+    from idr.logic import read_classify_and_extract_document
+    from idr.storage.blobs import get_document
+
+    local_decodings = []
+
+    async def fake_read_qr_code(document, max_pages):
+        local_decodings.append(document.doc_id)
+        return {}, None
+
+    monkeypatch.setattr(logic, "async_read_qr_code", fake_read_qr_code)
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        store.write_document("invoices/invoice.pdf", file.read())
+    qr_code = "A:509104720*B:508453488*C:PT*D:FT*E:N*F:20240319*G:FT 2024A4/1*H:JJJRJ85C-1*I1:PT*Q:PqIU*R:0006"
+    barcode = {"kind": "QRCode", "value": qr_code, "polygon": [], "span": {"offset": 0, "length": 0}, "confidence": 1}
+
+    class QRDocumentIntelligence:
+        async def begin_analyze_document(self, **kwargs):
+            pages = [{"pageNumber": 1, "barcodes": [barcode]}]
+            return ReplayPoller(AnalyzeResult({"content": "Fatura FT 2024A4/1", "pages": pages}))
+
+    class ConcurrentCompletions(LiveCompletions):
+        running = 0
+        peak = 0
+
+        async def create(self, model, messages, **kwargs):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            await asyncio.sleep(0.05)
+            self.running -= 1
+            return await super().create(model, messages, **kwargs)
+
+    completions = ConcurrentCompletions()
+
+    async def run():
+        with patched_services(QRDocumentIntelligence(), chat_client(completions), chat_client(completions)):
+            async with memory_storage(store):
+                return await read_classify_and_extract_document(await get_document("invoices/invoice.pdf"))
+
+    start_workers(2, pool="thread")
+    try:
+        out = asyncio.run(run())
+    finally:
+        stop_workers()
+
+    assert completions.peak == 2  # classification and extraction ran concurrently
+    assert local_decodings == []  # every page is read by the OCR, which reads the QR code
+    assert out["document_type"] == "FT" and out["document_number"] == "FT 2024A4/1"
+    assert out["extracted_fields"]["currency"] == "EUR"
+    assert out["all_fields"]["currency"] == "EUR"
+
+
+def test_read_results_saved_when_classification_fails(tmp_path, monkeypatch):
+    configure_replay_environment()
+    import idr.logic as logic
+    from idr.storage.blobs import get_document
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        store.write_document("invoices/invoice.pdf", file.read())
+
+    async def failing_classification(document):
+        raise RuntimeError("classification failed")
+
+    monkeypatch.setattr(logic, "classify_document", failing_classification)
+
+    async def run():
+        with patched_services(LiveDocumentIntelligence(), chat_client(LiveCompletions()), chat_client(None)):
+            async with memory_storage(store) as storage:
+                try:
+                    await logic.read_and_classify_document(await get_document("invoices/invoice.pdf"))
+                    raise AssertionError("the classification did not fail")
+                except RuntimeError:
+                    pass
+                return storage.get_container_client("TEXT_CONTAINER").blobs
+
+    start_workers(2, pool="thread")
+    try:
+        texts = asyncio.run(run())
+    finally:
+        stop_workers()
+
+    # the OCR text is kept for the retry
+    assert json.loads(texts["invoices/invoice.pdf"]) == ["Fatura FT 1FA.2024L/1409"]
+
+
+def test_speculative_extraction(tmp_path):
+    configure_replay_environment()
+    from idr.logic import classify_and_extract_speculatively, guess_document_type, speculation_stats
+    from idr.storage.blobs import get_document
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        store.write_document("invoices/FT 1FA.2024L_1409.pdf", file.read())
+
+    class TypedCompletions(LiveCompletions):
+        def __init__(self, doc_type):
+            self.doc_type = doc_type
+            self.extraction_types = []
+
+        async def create(self, model, messages, **kwargs):
+            content = messages[1]["content"]
+            if "classify" in content.lower():
+                classification["document_type"] = self.doc_type
+                await asyncio.sleep(0.05)
+            else:
+                # the associated invoice number is only asked for credit notes
+                self.extraction_types.append("NC" if "associated_invoice_number" in content else "FT")
+            return await super().create(model, messages, **kwargs)
+
+    async def run(completions):
+        with patched_services(LiveDocumentIntelligence(), chat_client(completions), chat_client(completions)):
+            async with memory_storage(store):
+                document = await get_document("invoices/FT 1FA.2024L_1409.pdf")
+                document.text = ["Fatura"]
+                assert guess_document_type(document) == "FT"
+                return await classify_and_extract_speculatively(document)
+
+    hits, misses = speculation_stats.hits, speculation_stats.misses
+    wasted = sum(wasted_tokens.values.values())
+    agreeing = TypedCompletions("FT")
+    class_completion, ext_completion = asyncio.run(run(agreeing))
+    assert class_completion["document_type"] == "FT" and ext_completion["currency"] == "EUR"
+    assert agreeing.extraction_types == ["FT"]
+    assert (speculation_stats.hits, speculation_stats.misses) == (hits + 1, misses)
+
+    disagreeing = TypedCompletions("NC")
+    class_completion, ext_completion = asyncio.run(run(disagreeing))
+    classification["document_type"] = "FT"
+    assert class_completion["document_type"] == "NC"
+    assert disagreeing.extraction_types == ["FT", "NC"]  # the speculation finished first and was discarded
+    assert (speculation_stats.hits, speculation_stats.misses) == (hits + 1, misses + 1)
+    assert sum(wasted_tokens.values.values()) == wasted + 110
+
+
+def test_spooled_document(tmp_path):
+    configure_replay_environment()
+    from idr.document import Document, async_read_filetype, async_read_ocr
+    from idr.storage.blobs import read_blob_spooled
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        content = file.read()
+    store.write_document("invoices/invoice.pdf", content)
+
+    async def run():
+        async with memory_storage(store):
+            spooled = await read_blob_spooled("invoices/invoice.pdf", spool_threshold=1000)
+            in_memory = await read_blob_spooled("invoices/invoice.pdf")
+            missing = await read_blob_spooled("invoices/missing.pdf", spool_threshold=1000)
+        document = Document("invoices/invoice.pdf")
+        document.set_stream_file(spooled, temporary=True)
+        await async_read_filetype(document)
+        client = RecordingDocumentIntelligenceClient(LiveDocumentIntelligence(), store)
+        await async_read_ocr(document, client)
+        return spooled, in_memory, missing, document
+
+    start_workers(2, pool="thread")
+    try:
+        spooled, in_memory, missing, document = asyncio.run(run())
+    finally:
+        stop_workers()
+
+    assert in_memory == content and missing is None
+    with open(spooled, "rb") as file:
+        assert file.read() == content
+    assert document.text == read_pdf(content)
+    assert document.content_hash() == hashlib.sha256(content).hexdigest()
+    # the file was streamed to the OCR as the request body
+    assert store.read("ocr", make_cache_key(content, "")) is not None
+
+    del document
+    gc.collect()
+    assert not os.path.exists(spooled)
+
+
+def test_lazy_document(tmp_path):
+    configure_replay_environment()
+    from idr.storage.blobs import get_document, save_document
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        content = file.read()
+    store.write_document("invoices/invoice.pdf", content)
+
+    async def run():
+        async with memory_storage(store) as storage:
+            storage.get_container_client("TEXT_CONTAINER").blobs["invoices/invoice.pdf"] = b'["Fatura"]'
+            document = await get_document("invoices/invoice.pdf", load=("text",))
+            assert document.text == ["Fatura"] and not document.is_loaded("stream")
+            try:
+                document.stream
+                raise AssertionError("the file content was not loaded")
+            except ValueError:
+                pass
+            await document.load("stream")
+            assert document.stream == content
+            # the view shares the content
+            assert document.view.obj is document.stream and document.view[:4] == b"%PDF"
+
+            metadata = await get_document("invoices/invoice.pdf", load=())
+            metadata.fields["currency"] = "EUR"
+            await save_document(metadata, parts=("text", "fields"), background=False)
+            assert storage.get_container_client("TEXT_CONTAINER").blobs["invoices/invoice.pdf"] == b'["Fatura"]'
+            assert json.loads(storage.get_container_client("META_CONTAINER").blobs["invoices/invoice.pdf"]) == {
+                "currency": "EUR"
+            }
+
+            try:
+                await get_document("invoices/missing.pdf", load=())
+                raise AssertionError("a missing file was loaded")
+            except ValueError:
+                pass
+
+    asyncio.run(run())
+
+
+def test_coalesced_calls(tmp_path):
+    configure_replay_environment()
+    from idr.logic import read_and_classify_document
+    from idr.metrics import coalesced_calls
+    from idr.storage.blobs import get_document
+
+    store = FixtureStore(tmp_path)
+    with open(path_, "rb") as file:
+        store.write_document("invoices/invoice.pdf", file.read())
+
+    class SlowCompletions(LiveCompletions):
+        calls = 0
+
+        async def create(self, model, messages, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            return await super().create(model, messages, **kwargs)
+
+    completions = SlowCompletions()
+
+    async def run():
+        with patched_services(LiveDocumentIntelligence(), chat_client(completions), chat_client(completions)):
+            async with memory_storage(store):
+                documents = [await get_document("invoices/invoice.pdf", load=("stream",)) for _ in range(3)]
+                outputs = await asyncio.gather(*[read_and_classify_document(document) for document in documents])
+                return documents, outputs
+
+    coalesced = sum(coalesced_calls.values.values())
+    start_workers(2, pool="thread")
+    try:
+        documents, outputs = asyncio.run(run())
+    finally:
+        stop_workers()
+
+    assert completions.calls == 1
+    assert sum(coalesced_calls.values.values()) == coalesced + 2
+    assert outputs[0] == outputs[1] == outputs[2] and outputs[1] is not outputs[0]
+    assert all(document.doc_type == "FT" and document.fields == documents[0].fields for document in documents)
+    assert documents[1].text == documents[0].text
+
+
+def allocate(megabytes: int) -> int:
+    return len(bytearray(megabytes * 1024 * 1024))
+
+
+def test_peak_rss_of_stopped_workers():
+    before = peak_rss_mb()
+    if before is None:  # not available on windows
+        return
+    start_workers(1, pool="process")
+    try:
+        asyncio.run(run_in_worker(allocate, 256))
+    finally:
+        stop_workers()
+    # the memory of the worker process is counted once it exited
+    assert peak_rss_mb() - before >= 200, (before, peak_rss_mb())
@@ -0,0 +1,33 @@
+import json
+import time
+
+from idr.document.utils import ResponseParseError, find_json_object, parse_json_object, parse_response_json
+
+completion = {"document_type": "FT", "notes": 'a "quoted" {brace} and \\ backslash', "items": [{"a": [1, {"b": 2}]}]}
+
+
+def test_parse_response_json():
+    text = json.dumps(completion)
+    assert parse_json_object(text) == completion
+    assert parse_json_object(f"```json\n{json.dumps(completion, indent=2)}\n```") == completion
+    # text with braces after the object
+    assert parse_json_object(f"{text}\nNote: {{not json}}") == completion
+    assert find_json_object(f"Result: {text} {{other}}") == text
+
+    for invalid in (None, "", "no json", "[1, 2]", text[:-10], '{"a": "unclosed}'):
+        try:
+            parse_json_object(invalid)
+        except ResponseParseError:
+            pass
+        else:
+            raise AssertionError(f"{invalid!r} was parsed")
+        # the default parser logs the error and returns an empty extraction
+        assert parse_response_json(invalid) == {}
+
+
+def test_parse_unclosed_nested_objects():
+    # the previous regex backtracked exponentially on unclosed nested objects
+    text = '{"a": ' + '{"b": [1, {"c": ' * 1000
+    start = time.perf_counter()
+    assert parse_response_json(text) == {}
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+from idr.document import Document
+from idr.metrics import add_stage_observer, remove_stage_observer
+from idr.replay import Latency, MemoryBlobStorage
+from idr.storage import blobs
+
+CONNECTION_STRING = "DefaultEndpointsProtocol=https;AccountName=acct;AccountKey=a2V5;EndpointSuffix=core.windows.net"
+
+
+def test_shared_storage(monkeypatch):
+    monkeypatch.setattr(blobs, "STORAGE_CONNECTION_STRING", CONNECTION_STRING)
+    opened = []
+    open_storage = blobs.BlobStorage.open
+
+    async def counted_open(storage):
+        opened.append(storage)
+        await asyncio.sleep(0.01)  # the other first calls arrive while the connection is opening
+        await open_storage(storage)
+
+    monkeypatch.setattr(blobs.BlobStorage, "open", counted_open)
+
+    async def first_loop():
+        storages = await asyncio.gather(*[blobs.get_storage() for _ in range(5)])
+        # a single connection pool, reused by the next calls and by every container
+        assert len(opened) == 1 and all(storage is storages[0] for storage in storages)
+        assert await blobs.get_storage() is storages[0]
+        assert (await blobs.get_container_client("DOC_CONTAINER")) is storages[0].get_container_client("DOC_CONTAINER")
+        return storages[0]
+
+    async def second_loop(previous):
+        storage = await blobs.get_storage()
+        # the connection of the previous event loop is closed when replaced
+        assert storage is not previous and previous._session is None and len(opened) == 2
+        await blobs.close_storage()
+        assert storage._session is None and blobs._storage is None
+
+    previous = asyncio.run(first_loop())
+    asyncio.run(second_loop(previous))
+
+
+def test_get_document():
+    statuses = []
+
+    def observe(stage: str, status: str, seconds: float) -> None:
+        statuses.append((stage, status))
+
+    async def run():
+        # every blob read takes 50 ms
+        storage = MemoryBlobStorage(Latency(0.05, jitter=0))
+        await storage.open()
+        await blobs.set_storage(storage)
+        try:
+            storage.get_container_client("DOC_CONTAINER").blobs["invoices/a.pdf"] = b"%PDF-1.4"
+            storage.get_container_client("TEXT_CONTAINER").blobs["invoices/a.pdf"] = b'["Fatura"]'
+            storage.get_container_client("META_CONTAINER").blobs["invoices/a.pdf"] = b'{"document_type": "FT"}'
+
+            # a missing blob is read in a single round trip, without an exception nor a failed read in the metrics
+            add_stage_observer(observe)
+            try:
+                assert await blobs.read_blob_if_exists("invoices/missing.pdf", "TEXT_CONTAINER") is None
+                assert await blobs.read_blob_spooled("invoices/missing.pdf", "DOC_CONTAINER") is None
+            finally:
+                remove_stage_observer(observe)
+            assert statuses == [("blob_read", "ok"), ("download", "ok")], statuses
+            assert await blobs.read_blob_if_exists("invoices/a.pdf", "TEXT_CONTAINER") == b'["Fatura"]'
+
+            start = time.perf_counter()
+            document = await blobs.get_document("invoices/a.pdf", load=("stream", "text"))
+            elapsed = time.perf_counter() - start
+            try:
+                await blobs.get_document("invoices/missing.pdf")
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("A missing file was loaded")
+        finally:
+            await blobs.set_storage(None)
+        return document, elapsed
+
+    document, elapsed = asyncio.run(run())
+    # the five blobs are read concurrently
+    assert elapsed < 0.15, elapsed
+    assert document.stream == b"%PDF-1.4" and document.text == ["Fatura"] and document.doc_type == "FT"
+    # the missing sidecars are left empty
+    assert document.qr_info == {} and document.comments == []
+
+
+def test_save_document():
+    async def run():
+        storage = MemoryBlobStorage(Latency(0.05, jitter=0))
+        await storage.open()
+        await blobs.set_storage(storage)
+        uploads = []
+        for env_container in ("TEXT_CONTAINER", "QR_CONTAINER", "META_CONTAINER", "COMMENTS_CONTAINER"):
+            container = storage.get_container_client(env_container)
+            upload = container.upload_blob
+
+            async def counted_upload(blob_path, data, overwrite=False, env_container=env_container, upload=upload):
+                uploads.append(env_container)
+                await upload(blob_path, data, overwrite)
+
+            container.upload_blob = counted_upload
+        try:
+            document = Document("invoices/a.pdf")
+            document.text, document.qr_info, document.fields = ["Fatura"], {"A": "123456789"}, {"currency": "EUR"}
+            start = time.perf_counter()
+            await blobs.save_document(document, parts=("text", "qr_info", "fields", "qr_info", "comments"))
+            elapsed = time.perf_counter() - start
+
+            # in the background the uploads do not block, a later read of the document waits for them
+            document.fields = {"currency": "USD"}
+            start = time.perf_counter()
+            await blobs.save_document(document, parts=("fields",), background=True)
+            background_elapsed = time.perf_counter() - start
+            text = await blobs.read_blob_if_exists("invoices/a.pdf", "TEXT_CONTAINER")
+            await blobs.wait_for_pending_writes("invoices/a.pdf")
+            fields = await blobs.read_blob_if_exists("invoices/a.pdf", "META_CONTAINER")
+        finally:
+            await blobs.set_storage(None)
+        return uploads, elapsed, background_elapsed, text, fields
+
+    uploads, elapsed, background_elapsed, text, fields = asyncio.run(run())
+    # each part is written once, concurrently
+    assert sorted(uploads[:4]) == ["COMMENTS_CONTAINER", "META_CONTAINER", "QR_CONTAINER", "TEXT_CONTAINER"]
+    assert elapsed < 0.1, elapsed
+    assert background_elapsed < 0.01 and uploads[4:] == ["META_CONTAINER"]
+    assert text == b'["Fatura"]' and fields == b'{"currency": "USD"}'
@@ -0,0 +1,103 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from openai.types import CompletionUsage
+
+from idr.cache import MemoryCache
+from idr.document import Document
+from idr.llm import stream_chat_completions
+from idr.llm.json_stream import JsonStreamParser
+from idr.llm.llm_caller import TokenUsage, token_usage
+from idr.logic import early_classification_fields
+
+completion = {
+    "document_type": "FT",
+    "supplier_vat": "PT123456789",
+    "notes": 'a "quoted" {text}, with commas',
+    "items": [{"a": 1}, {"b": [2, 3]}],
+    "valid_document": "Y",
+}
+
+
+def test_json_stream_parser():
+    text = "```json\n" + json.dumps(completion, indent=2) + "\n```"
+    parser = JsonStreamParser()
+    completed = []
+    for char in text:
+        completed += list(parser.feed(char).items())
+
+    # each member is given once, as soon as it is closed
+    assert completed == list(completion.items())
+    assert parser.members == completion and parser.text == text
+
+    parser = JsonStreamParser()
+    assert parser.feed('{"document_type": "F') == {}
+    assert parser.feed('T", "supplier_vat": ') == {"document_type": "FT"}
+    assert parser.feed('"PT1"}') == {"supplier_vat": "PT1"}
+
+    # a long member received in many chunks
+    items = [f"Artigo {number}" for number in range(2000)]
+    text = json.dumps({"items": items, "valid_document": "Y"})
+    parser = JsonStreamParser()
+    completed = {}
+    for start in range(0, len(text), 7):
+        completed.update(parser.feed(text[start : start + 7]))
+    assert completed == {"items": items, "valid_document": "Y"} and parser.text == text
+
+
+class FakeStreamCompletions:
+    def __init__(self, chunks: list[str]):
+        self.chunks = chunks
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        assert kwargs["stream"]
+        self.calls += 1
+        usage = CompletionUsage(
+            prompt_tokens=100, completion_tokens=len(self.chunks), total_tokens=100 + len(self.chunks)
+        )
+
+        async def stream():
+            yield SimpleNamespace(choices=[])  # content filter results of the prompt
+            for chunk in self.chunks:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+            if kwargs.get("stream_options", {}).get("include_usage"):
+                yield SimpleNamespace(choices=[], usage=usage)
+
+        return stream()
+
+
+def test_stream_chat_completions():
+    chunks = ['{"document_type":', ' "FT", "valid', '_document": "Y"}']
+    completions = FakeStreamCompletions(chunks)
+    llm_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    cache = MemoryCache("test")
+    prompt = [{"role": "user", "content": "classify"}]
+
+    async def call() -> list[str]:
+        return [chunk async for chunk in stream_chat_completions(llm_client, "model", "", prompt, "Test", cache=cache)]
+
+    async def run():
+        usage = TokenUsage()
+        token_usage.set(usage)
+        assert await call() == chunks
+        # the usage of the last chunk is recorded, not a local count
+        assert (usage.prompt_tokens, usage.completion_tokens) == (100, 3)
+        # the whole completion is cached, and given at once
+        assert await call() == ["".join(chunks)]
+        assert completions.calls == 1
+
+    asyncio.run(run())
+
+
+def test_early_classification_fields():
+    document = Document("invoice.pdf")
+    assert early_classification_fields(document, {}) == {}
+    fields = {"document_type": "FR", "supplier_name": "MONERIS", "valid_document": "N"}
+    assert early_classification_fields(document, fields) == {"document_type": "FR", "valid_document": False}
+
+    # the QR code has precedence over the classification
+    document.qr_info = {"A": "123456789", "D": "FT"}
+    assert early_classification_fields(document, {}) == {"document_type": "FT", "supplier_vat": "PT123456789"}
+    assert early_classification_fields(document, fields)["document_type"] == "FT"
@@ -0,0 +1,101 @@
+from idr.llm.chunking import chunk_pages, header_text, split_page
+from idr.llm.prompt_formatting import (
+    extraction_prompt_stats,
+    get_extraction_prompt,
+    make_classification_prompt,
+    make_extraction_prompt,
+)
+from idr.llm.token_budget import TokenBudget, fit_text, remove_repeated_lines, truncate_to_tokens
+from idr.llm.tokens import count_prompt_tokens, count_tokens
+
+header = "MONERIS - SERVIÇOS DE GESTÃO, SA\nNIF 123456789"
+footer = "Processado por programa certificado n.º 1234/AT"
+
+
+def make_page(number: int) -> str:
+    return f'{header}\n<!-- PageNumber="{number}" -->\n| 1 | Serviço | 10,00 |\nPágina {number}\n{footer}'
+
+
+def test_remove_repeated_lines():
+    text = "\f".join(make_page(number) for number in range(1, 4))
+    reduced = remove_repeated_lines(text)
+    pages = reduced.split("\f")
+
+    assert len(pages) == 3
+    assert pages[0].count("MONERIS") == 1 and footer in pages[0]
+    assert "MONERIS" not in pages[1] and footer not in pages[2]
+    assert all("| 1 | Serviço | 10,00 |" in page for page in pages)  # table rows are kept
+    assert "Página 3" in pages[2]
+    assert "PageNumber" not in reduced
+    # single page documents are unchanged
+    assert remove_repeated_lines(make_page(1).replace('<!-- PageNumber="1" -->\n', "")) == make_page(1).replace(
+        '<!-- PageNumber="1" -->\n', ""
+    )
+
+
+def test_fit_text():
+    text = "\f".join(make_page(number) for number in range(1, 200))
+    assert truncate_to_tokens("Fatura", 100) == "Fatura"
+
+    fitted, tokens = fit_text(text, 100)
+    assert tokens <= 100
+    assert fitted.startswith(header)
+    assert count_tokens(fitted) == tokens
+
+    # a text within the budget keeps its repeated lines
+    text = "\f".join(make_page(number) for number in range(1, 4))
+    assert fit_text(text, 10000) == (text, count_tokens(text))
+    assert len(fit_text(text, 100)[0]) < len(text)
+
+
+def test_prompt_budget():
+    text = "Fatura FT 1FA.2024L/1409\n" * 10000
+    budget = TokenBudget(context_tokens=4000, output_tokens=1000)
+
+    prompt = make_classification_prompt(text, False, {}, budget)
+    assert count_prompt_tokens(prompt) <= 3000
+    assert "Fatura FT 1FA.2024L/1409" in prompt[1]["content"]
+
+    prompt = make_extraction_prompt(text, "FT", False, budget)
+    assert count_prompt_tokens(prompt) <= 3000
+    assert "Fatura FT 1FA.2024L/1409" in prompt[1]["content"]
+
+
+def test_extraction_prompt_index():
+    prompt = get_extraction_prompt("FT", True)
+    assert get_extraction_prompt("FT", True) is prompt
+    assert prompt.messages("{text}")[1]["content"].count("{text}") == 1
+    assert prompt.user_prefix != get_extraction_prompt("FT", False).user_prefix
+    assert prompt.user_prefix != get_extraction_prompt("NC", True).user_prefix
+
+    hits = extraction_prompt_stats.hits
+    get_extraction_prompt("XX", False)
+    assert extraction_prompt_stats.hits == hits and extraction_prompt_stats.misses >= 1
+
+    # the documents of the same type share the whole prompt before the text
+    prefix = get_extraction_prompt("FT", False).user_prefix
+    assert make_extraction_prompt("Fatura 1", "FT", False)[1]["content"].startswith(prefix + "Fatura 1")
+    assert make_extraction_prompt("Fatura 2", "FT", False)[1]["content"].startswith(prefix + "Fatura 2")
+
+
+def test_split_tables():
+    rows = "\n".join(f"<tr><td>Artigo {number}</td><td>{number},00</td></tr>" for number in range(200))
+    page = f"Fatura 1\n<table>\n<tr><th>Descrição</th><th>Preço</th></tr>\n{rows}\n</table>\nTotal 19900,00"
+    parts = split_page(page, 500)
+
+    assert len(parts) > 1 and all(count_tokens(part) <= 500 for part in parts)
+    # each part is a whole table with its header, and no row is lost or split
+    assert all(part.count("<table>") == part.count("</table>") == 1 for part in parts)
+    assert all("<th>Descrição</th>" in part for part in parts)
+    assert sum(part.count("<td>Artigo") for part in parts) == 200
+    assert parts[0].startswith("Fatura 1") and parts[-1].endswith("Total 19900,00")
+
+    rows = "\n".join(f"| Artigo {number} | {number},00 |" for number in range(200))
+    parts = split_page(f"| Descrição | Preço |\n| --- | --- |\n{rows}\nTotal", 500)
+    assert len(parts) > 1 and all(part.startswith("| Descrição | Preço |\n| --- | --- |\n| Artigo") for part in parts)
+
+    pages = ["Página 1", "Página 2", page, "Página 4"]
+    chunks = chunk_pages(pages, 500)
+    # the short pages are grouped with the parts of the long page
+    assert chunks[0].startswith("Página 1\fPágina 2\fFatura 1") and chunks[-1].endswith("\fPágina 4")
+    assert header_text(pages) == "Página 1\fPágina 4" and header_text(pages[:1]) == "Página 1"
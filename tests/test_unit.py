@@ -0,0 +1,48 @@
+import asyncio
+
+from idr.cache import CacheStats
+from idr.concurrency import StageLimits
+from idr.metrics import register_cache_stats, render_metrics, span, timed
+
+
+def test_stage_limits():
+    stage_limits = StageLimits({"ocr": 2})
+    running = {"ocr": 0, "other": 0}
+    peak = {"ocr": 0, "other": 0}
+
+    async def call(stage: str):
+        async with stage_limits(stage):
+            running[stage] += 1
+            peak[stage] = max(peak[stage], running[stage])
+            await asyncio.sleep(0.01)
+            running[stage] -= 1
+
+    async def run():
+        await asyncio.gather(*[call("ocr") for _ in range(5)], *[call("other") for _ in range(5)])
+
+    asyncio.run(run())
+    # semaphores are recreated for a new event loop
+    asyncio.run(run())
+    assert peak == {"ocr": 2, "other": 5}
+
+
+def test_metrics():
+    stats = CacheStats(hits=3, misses=1)
+    register_cache_stats("test", stats)
+
+    @timed("test_stage")
+    async def stage():
+        await asyncio.sleep(0.01)
+
+    asyncio.run(stage())
+    try:
+        with span("test_stage"):
+            raise ValueError("failed")
+    except ValueError:
+        pass
+
+    metrics = render_metrics()
+    assert 'idr_stage_duration_seconds_count{stage="test_stage",status="ok"} 1' in metrics
+    assert 'idr_stage_duration_seconds_count{stage="test_stage",status="error"} 1' in metrics
+    assert 'idr_stage_duration_seconds_bucket{stage="test_stage",status="ok",le="+Inf"} 1' in metrics
+    assert 'idr_cache_hits_total{cache="test"} 3' in metrics